@@ -21,43 +21,66 @@
 #
 #
 #
+import sys
+import time
+import shlex
 import argparse
-from admin import *
-from lambdafunction import *
+import importlib
+import subprocess
 
 DEFAULT_STACKNAME = 'tide-guage'
 DEFAULT_REGION = 'us-west-2'
 
-if __name__ == '__main__':
+
+def helper_parser():
+    """
+    Builds the argument parser for all commands. Command handlers are
+    referenced by "<module>:<function>" strings and only imported
+    when the command runs (see helper_run).
+    """
 
     argsParser = argparse.ArgumentParser()
-    subParser = argsParser.add_subparsers()
+    subParser = argsParser.add_subparsers(dest='command')
+
+    # Options for profiling any of the commands
+    argsParser.add_argument('--profile', help="Profile the command: cpu, memory, or cpu,memory")
+    argsParser.add_argument('--profile-dir', default='profiles')
+    argsParser.add_argument('--profile-format', default='pstats', choices=['pstats', 'speedscope', 'both'])
+    argsParser.add_argument('--profile-top', type=int, default=20)
 
     # The stack-deploy command
     parser_stackDeploy = subParser.add_parser('stack-deploy', help="Deploy AWS CloudFormation stack")
-    parser_stackDeploy.set_defaults(func=command_stackDeploy)
+    parser_stackDeploy.set_defaults(func='admin.stack:command_stackDeploy')
     parser_stackDeploy.add_argument('--name', default=DEFAULT_STACKNAME)
+    parser_stackDeploy.add_argument('--names', help="Deploy several stacks, e.g. a,b,c")
     parser_stackDeploy.add_argument('--region', default=DEFAULT_REGION)
+    parser_stackDeploy.add_argument('--numpy-layer', help="The ARN of a lambda layer that provides NumPy")
 
     # The stack-delete command
     parser_stackDelete = subParser.add_parser('stack-delete', help="Delete AWS CloudFormation stack")
-    parser_stackDelete.set_defaults(func=command_stackDelete)
+    parser_stackDelete.set_defaults(func='admin.stack:command_stackDelete')
     parser_stackDelete.add_argument('--name', default=DEFAULT_STACKNAME)
+    parser_stackDelete.add_argument('--names', help="Delete several stacks, e.g. a,b,c")
+    parser_stackDelete.add_argument('--all', action='store_true', help="Delete every tide gauge stack")
 
     # The stack-update command
     parser_stackUpdate = subParser.add_parser('stack-update', help="Update AWS Cloudformation stack")
-    parser_stackUpdate.set_defaults(func=command_stackUpdate)
+    parser_stackUpdate.set_defaults(func='admin.stack:command_stackUpdate')
     parser_stackUpdate.add_argument('--name', default=DEFAULT_STACKNAME)
+    parser_stackUpdate.add_argument('--names', help="Update several stacks, e.g. a,b,c")
+    parser_stackUpdate.add_argument('--all', action='store_true', help="Update every tide gauge stack")
     parser_stackUpdate.add_argument('--region', default=DEFAULT_REGION)
+    parser_stackUpdate.add_argument('--numpy-layer', help="The ARN of a lambda layer that provides NumPy, or '' for none")
 
     # The db-data command
     parser_dbData = subParser.add_parser('db-data', help="Manage the data table")
-    parser_dbData.set_defaults(func=command_dbData)
+    parser_dbData.set_defaults(func='lambdafunction.commands:command_dbData')
     parser_dbData.add_argument('--name', default=DEFAULT_STACKNAME)
     parser_dbData.add_argument('--device', required=True)
     parser_dbData.add_argument('--timestamp')
     parser_dbData.add_argument('--limit', type=int)  # used in GET only
     parser_dbData.add_argument('--data')             # used in POST only
+    parser_dbData.add_argument('--format', default='table', choices=['table', 'ndjson', 'csv'])
     # TODO: make mutually exclusive
     parser_dbData.add_argument('--post', action='store_true')
     parser_dbData.add_argument('--get', action='store_true')
@@ -65,38 +88,218 @@ if __name__ == '__main__':
 
     # The db-config command
     parser_dbConfig = subParser.add_parser('db-config', help="Manage the config table")
-    parser_dbConfig.set_defaults(func=command_dbConfig)
+    parser_dbConfig.set_defaults(func='lambdafunction.commands:command_dbConfig')
     parser_dbConfig.add_argument('--name', default=DEFAULT_STACKNAME)
     parser_dbConfig.add_argument('--device')
     parser_dbConfig.add_argument('--data')             # used in POST only
+    parser_dbConfig.add_argument('--version', type=int)  # used in POST only
+    parser_dbConfig.add_argument('--since-version', type=int)
     parser_dbConfig.add_argument('--post', action='store_true')
     parser_dbConfig.add_argument('--get', action='store_true')
     parser_dbConfig.add_argument('--delete', action='store_true')
 
+    # The db-coverage command
+    parser_dbCoverage = subParser.add_parser('db-coverage', help="Show the gaps in a device's data")
+    parser_dbCoverage.set_defaults(func='lambdafunction.commands:command_dbCoverage')
+    parser_dbCoverage.add_argument('--name', default=DEFAULT_STACKNAME)
+    parser_dbCoverage.add_argument('--device', required=True)
+    parser_dbCoverage.add_argument('--from', dest='start', type=int)
+    parser_dbCoverage.add_argument('--to', dest='end', type=int)
+
+    # The db-calibration command
+    parser_dbCalibration = subParser.add_parser('db-calibration', help="Manage a device's calibration")
+    parser_dbCalibration.set_defaults(func='lambdafunction.commands:command_dbCalibration')
+    parser_dbCalibration.add_argument('--name', default=DEFAULT_STACKNAME)
+    parser_dbCalibration.add_argument('--device', required=True)
+    parser_dbCalibration.add_argument('--post', action='store_true')
+    parser_dbCalibration.add_argument('--effective-from', type=int)     # used in POST only
+    parser_dbCalibration.add_argument('--mount-height', type=float)     # used in POST only
+    parser_dbCalibration.add_argument('--datum-offset', type=float, default=0)
+    parser_dbCalibration.add_argument('--temperature', type=float)
+
+    # The db-cache command
+    parser_dbCache = subParser.add_parser('db-cache', help="Manage the local data cache")
+    parser_dbCache.set_defaults(func='admin.cache:command_dbCache')
+    parser_dbCache.add_argument('--name', default=DEFAULT_STACKNAME)
+    parser_dbCache.add_argument('--device', required=True)
+    parser_dbCache.add_argument('--cache-dir')
+    parser_dbCache.add_argument('--sync', action='store_true')
+    parser_dbCache.add_argument('--clear', action='store_true')
+    parser_dbCache.add_argument('--info', action='store_true')
+
+    # The db-schedule command
+    parser_dbSchedule = subParser.add_parser('db-schedule', help="Plan a device's sampling schedule")
+    parser_dbSchedule.set_defaults(func='admin.schedule:command_dbSchedule')
+    parser_dbSchedule.add_argument('--name', default=DEFAULT_STACKNAME)
+    parser_dbSchedule.add_argument('--device', required=True)
+    parser_dbSchedule.add_argument('--cache-dir')
+    parser_dbSchedule.add_argument('--days', type=int, default=30)         # history to fit the tide model to
+    parser_dbSchedule.add_argument('--hours', type=int, default=24)        # length of the schedule
+    parser_dbSchedule.add_argument('--resolution', type=float, default=20) # mm between samples
+    parser_dbSchedule.add_argument('--window', type=int, default=45)       # minutes around high & low water
+    parser_dbSchedule.add_argument('--post', action='store_true')
+
     # TODO: The lambda-invoke command
     parser_lambdaInvoke = subParser.add_parser('lambda-invoke', help="Call the lambda function")
-    parser_lambdaInvoke.set_defaults(func=command_lambdaInvoke)
+    parser_lambdaInvoke.set_defaults(func='admin.lambdafunction:command_lambdaInvoke')
     parser_lambdaInvoke.add_argument('--name', default=DEFAULT_STACKNAME)
     parser_lambdaInvoke.add_argument('--device')
     parser_lambdaInvoke.add_argument('--timestamp')
     parser_lambdaInvoke.add_argument('--limit', type=int)  # used in GET only
     parser_lambdaInvoke.add_argument('--data')             # used in POST only
+    parser_lambdaInvoke.add_argument('--format', default='table', choices=['table', 'ndjson', 'csv'])
     # TODO: make mutually exclusive
     parser_lambdaInvoke.add_argument('--post', action='store_true')
     parser_lambdaInvoke.add_argument('--get', action='store_true')
     parser_lambdaInvoke.add_argument('--config', action='store_true')
+    parser_lambdaInvoke.add_argument('--latest', action='store_true')
+
+    # The local-serve command
+    parser_localServe = subParser.add_parser('local-serve', help="Serve the API locally")
+    parser_localServe.set_defaults(func='admin.server:command_localServe')
+    parser_localServe.add_argument('--name', default=DEFAULT_STACKNAME)
+    parser_localServe.add_argument('--host', default='127.0.0.1')
+    parser_localServe.add_argument('--port', type=int, default=8080)
+    parser_localServe.add_argument('--workers', type=int, default=8)
+    parser_localServe.add_argument('--apikey', action='append')      # may be repeated
+    parser_localServe.add_argument('--rate', type=float)             # e.g. 2 as in RestUsagePlan
+    parser_localServe.add_argument('--burst', type=int)              # e.g. 10 as in RestUsagePlan
+    parser_localServe.add_argument('--quota', type=int)              # e.g. 3000 as in RestUsagePlan
+
+    # The ingest-coalesce command
+    parser_ingestCoalesce = subParser.add_parser('ingest-coalesce', help="Merge device publishes into batches")
+    parser_ingestCoalesce.set_defaults(func='admin.coalesce:command_ingestCoalesce')
+    parser_ingestCoalesce.add_argument('--queue-url')                # reads stdin if not given
+    parser_ingestCoalesce.add_argument('--url')
+    parser_ingestCoalesce.add_argument('--apikey')
+    parser_ingestCoalesce.add_argument('--quota', type=int, default=3000)
+    parser_ingestCoalesce.add_argument('--rate', type=float, default=2)
+    parser_ingestCoalesce.add_argument('--burst', type=int, default=10)
+    parser_ingestCoalesce.add_argument('--max-bytes', type=int, default=256*1024)
 
     # The aws-apikey command
     parser_awsApikey = subParser.add_parser('aws-apikey', help="Manage AWS API Keys")
-    parser_awsApikey.set_defaults(func=command_awsApikey)
+    parser_awsApikey.set_defaults(func='admin.api:command_awsApikey')
     parser_awsApikey.add_argument('--name', default=DEFAULT_STACKNAME)
     group_awsApikey = parser_awsApikey.add_mutually_exclusive_group()
     group_awsApikey.add_argument('--list', action='store_true')
     group_awsApikey.add_argument('--new',  action='store')
     group_awsApikey.add_argument('--remove',  action='store')
 
+    # The batch command
+    parser_batch = subParser.add_parser('batch', help="Run many commands in one process")
+    parser_batch.set_defaults(func=command_batch)
+    parser_batch.add_argument('file', nargs='?', default='-')
+    parser_batch.add_argument('--stop-on-error', action='store_true')
+
+    # The startup-bench command
+    parser_startupBench = subParser.add_parser('startup-bench', help="Measure import cost per command")
+    parser_startupBench.set_defaults(func=command_startupBench)
+    parser_startupBench.add_argument('--repeat', type=int, default=5)
+
+    return argsParser
+
+
+def helper_run(args):
+    """
+    Runs the command selected by the parsed arguments, importing
+    its module first if needed. Runs under the profiler if asked.
+    """
+    func = args.func
+    if isinstance(func, str):
+        moduleName, funcName = func.split(':')
+        func = getattr(importlib.import_module(moduleName), funcName)
 
+    if not args.profile:
+        func(args)
+    else:
+        from lambdafunction.lambdafunction import helper_profile, helper_parseProfileModes
+        modes = helper_parseProfileModes(args.profile)
+        with helper_profile(modes, label=args.command, outDir=args.profile_dir,
+                            fmt=args.profile_format, top=args.profile_top):
+            func(args)
 
-    args = argsParser.parse_args()
-    args.func(args)
 
+def command_batch(args):
+    """
+    Runs a sequence of commands in a single process so that imports
+    and AWS clients are only set up once. Each line holds the
+    arguments of one command, e.g. "db-data --device x --get
+    --timestamp >0". Blank lines & lines starting with "#" are
+    skipped. Reads from stdin if the file is "-", with a prompt when
+    stdin is a terminal.
+
+    Params:
+        args.file = the file of commands to run, or "-" for stdin
+        args.stop_on_error = stop at the first failed command
+    """
+    argsParser = helper_parser()
+    interactive = args.file == '-' and sys.stdin.isatty()
+    f = sys.stdin if args.file == '-' else open(args.file)
+
+    numFailed = 0
+    while True:
+        if interactive: print("tide-gauge> ", end='', flush=True)
+        line = f.readline()
+        if not line: break
+        line = line.strip()
+        if not line or line.startswith('#'): continue
+
+        # Both argparse and the command handlers exit on errors,
+        # which should only end the current command.
+        try:
+            lineArgs = argsParser.parse_args(shlex.split(line))
+            if lineArgs.command == 'batch': raise SystemExit("Error: batch cannot be nested")
+            helper_run(lineArgs)
+        except SystemExit as e:
+            if e.code in [None, 0]: continue
+            if isinstance(e.code, str): print(e.code, file=sys.stderr)
+            numFailed += 1
+            if args.stop_on_error: break
+
+    if f is not sys.stdin: f.close()
+    if numFailed: sys.exit(f"Error: {numFailed} command(s) failed")
+
+
+def command_startupBench(args):
+    """
+    Measures the startup cost of each command: the time to import the
+    module that implements it, in a fresh interpreter, plus the time
+    for "admin.py --help". The best of several runs is reported.
+
+    Params:
+        args.repeat = the number of runs per command
+    """
+    def best(code):
+        times = []
+        for _ in range(args.repeat):
+            res = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True)
+            if res.returncode != 0: return None
+            times.append(float(res.stdout))
+        return min(times)
+
+    # Find the module behind each lazily loaded command
+    timer = "import time, importlib; t = time.perf_counter(); importlib.import_module({!r}); print(time.perf_counter() - t)"
+    commands = {}
+    for action in helper_parser()._subparsers._group_actions:
+        for command, parser in action.choices.items():
+            func = parser.get_default('func')
+            if isinstance(func, str): commands[command] = timer.format(func.split(':')[0])
+
+    # The --help case times a full run of the script instead of an import
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        subprocess.run([sys.executable, sys.argv[0], '--help'], capture_output=True)
+    helpTime = (time.perf_counter() - start) / args.repeat
+
+    print(f"{'command':<20}  {'time (ms)':>10}")
+    print(f"{'-'*20}  {'-'*10}")
+    print(f"{'--help (total run)':<20}  {helpTime*1000:>10.1f}")
+    for command, code in commands.items():
+        t = best(code)
+        print(f"{command:<20}  {'failed' if t is None else f'{t*1000:.1f}':>10}")
+
+
+if __name__ == '__main__':
+    args = helper_parser().parse_args()
+    helper_run(args)
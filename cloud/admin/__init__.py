@@ -9,6 +9,20 @@
 # Author: Bryce Kellogg (bryce@kellogg.org)
 # Copyright: 2023 Bryce Kellogg
 # License: GPLv3
-from .stack import *
-from .api import *
-from .lambdafunction import *
+#
+# The submodules import boto3 & friends, which is slow, so they are
+# only imported the first time one of their names is used. Importing
+# a submodule directly (e.g. admin.stack) only loads that submodule.
+import importlib
+
+_SUBMODULES = ['stack', 'api', 'lambdafunction', 'output', 'cache', 'throttle', 'server', 'coalesce', 'schedule']
+
+def __getattr__(name):
+    # Star imports ask for __all__, which needs every submodule
+    if name == '__all__':
+        return [_ for m in _SUBMODULES for _ in dir(importlib.import_module(f'.{m}', __name__)) if not _.startswith('_')]
+
+    for m in _SUBMODULES:
+        module = importlib.import_module(f'.{m}', __name__)
+        if hasattr(module, name): return getattr(module, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
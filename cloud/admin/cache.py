@@ -0,0 +1,200 @@
+#  _______ _     _         _____
+# |__   __(_)   | |       / ____|
+#    | |   _  __| | ___  | |  __  __ _ _   _  __ _  ___
+#    | |  | |/ _` |/ _ \ | | |_ |/ _` | | | |/ _` |/ _ \
+#    | |  | | (_| |  __/ | |__| | (_| | |_| | (_| |  __/
+#    |_|  |_|\__,_|\___|  \_____|\__,_|\__,_|\__, |\___|
+#                                             __/ |
+#                                            |___/
+# Author: Bryce Kellogg (bryce@kellogg.org)
+# Copyright: 2023 Bryce Kellogg
+# License: GPLv3
+#
+# A local cache of each device's time series. Each series is stored
+# as a set of append-only binary column files (one per field) plus a
+# small JSON file of metadata:
+#
+#     <cache dir>/<stack name>/<device name>/
+#         meta.json       {"count": <int>, "watermark": <int>}
+#         timestamp.bin   int64 Unix timestamps
+#         distance.bin    float64 distance in mm
+#         battery.bin     float64 battery percent
+#
+# The metadata is only updated after the columns have been written,
+# so the record count in it is always safe to read up to. Syncing
+# only asks the database for records newer than the watermark (the
+# newest cached timestamp), and reading memory-maps the columns.
+import os
+import json
+import shutil
+import numpy as np
+
+from lambdafunction.lambdafunction import iterData
+
+DEFAULT_CACHE_DIR = os.path.join('~', '.cache', 'tide-gauge')
+
+# The cached columns, as a mapping of column
+# name to (data table attribute, numpy dtype).
+CACHE_COLUMNS = {
+    'timestamp': ('timestamp', '<i8'),
+    'distance':  ('distance', '<f8'),
+    'battery':   ('battery-percent', '<f8'),
+}
+
+
+def command_dbCache(args):
+    """
+    Command handler for managing the local time series cache.
+
+    Params:
+       args.name = the name of the CloudFormation stack
+       args.device = the name of the device
+       args.sync = fetch any new records into the cache
+       args.clear = delete the cached series of the device
+       args.info = print a summary of the cached series
+       args.cache_dir = the directory of the cache
+    """
+    stackName = args.name
+    deviceName = args.device
+
+    if args.clear:
+        clearCache(stackName, deviceName, args.cache_dir)
+        print(f"Cleared cache for {deviceName}")
+
+    if args.sync:
+        numNew = syncCache(stackName, deviceName, args.cache_dir)
+        print(f"Fetched {numNew} new records for {deviceName}")
+
+    if args.info:
+        meta = helper_readMeta(helper_cachePath(stackName, deviceName, args.cache_dir))
+        series = loadSeries(stackName, deviceName, args.cache_dir)
+        print(f"Device:    {deviceName}")
+        print(f"Path:      {helper_cachePath(stackName, deviceName, args.cache_dir)}")
+        print(f"Records:   {meta['count']}")
+        if meta['count']:
+            print(f"First:     {series['timestamp'][0]}")
+            print(f"Last:      {series['timestamp'][-1]}")
+
+
+def syncCache(stackName, deviceName, cacheDir=None, pageSize=None):
+    """
+    Fetches records newer than the cached ones and appends them to
+    the cache. Each page is written as soon as it is read.
+
+    Params:
+       stackName = the name of the CloudFormation stack
+       deviceName = the name of the device
+       cacheDir = the directory of the cache
+       pageSize = the maximum number of records per query
+
+    Returns: the number of new records
+    """
+    path = helper_cachePath(stackName, deviceName, cacheDir)
+    os.makedirs(path, exist_ok=True)
+    meta = helper_readMeta(path)
+
+    # Drop anything past the recorded count left by an interrupted sync
+    for column, (_, dtype) in CACHE_COLUMNS.items():
+        filename = os.path.join(path, f'{column}.bin')
+        with open(filename, 'ab') as f:
+            f.truncate(meta['count'] * np.dtype(dtype).itemsize)
+
+    numNew = 0
+    for page in iterData(stackName, deviceName, meta['watermark'], '>', pageSize=pageSize):
+        for column, (attribute, dtype) in CACHE_COLUMNS.items():
+            values = np.array([helper_toNumber(_.get(attribute)) for _ in page], dtype=dtype)
+            with open(os.path.join(path, f'{column}.bin'), 'ab') as f:
+                f.write(values.tobytes())
+
+        numNew += len(page)
+        meta['count'] += len(page)
+        meta['watermark'] = page[-1]['timestamp']
+        helper_writeMeta(path, meta)
+
+    return numNew
+
+
+def loadSeries(stackName, deviceName, cacheDir=None):
+    """
+    Gets the cached series of a device without copying it.
+
+    Params:
+       stackName = the name of the CloudFormation stack
+       deviceName = the name of the device
+       cacheDir = the directory of the cache
+
+    Returns: a dict of read-only numpy arrays, one per column
+             in CACHE_COLUMNS, memory-mapped from the cache
+    """
+    path = helper_cachePath(stackName, deviceName, cacheDir)
+    count = helper_readMeta(path)['count']
+
+    series = {}
+    for column, (_, dtype) in CACHE_COLUMNS.items():
+        if count == 0:
+            series[column] = np.empty(0, dtype=dtype)  # can't map an empty file
+        else:
+            series[column] = np.memmap(os.path.join(path, f'{column}.bin'), dtype=dtype, mode='r', shape=(count,))
+    return series
+
+
+def loadDataFrame(stackName, deviceName, cacheDir=None):
+    """
+    Gets the cached series of a device as a pandas DataFrame
+    indexed by timestamp, backed by the memory-mapped columns.
+    """
+    import pandas as pd
+    series = loadSeries(stackName, deviceName, cacheDir)
+    index = pd.Index(series.pop('timestamp'), name='timestamp')
+    return pd.DataFrame(series, index=index, copy=False)
+
+
+def clearCache(stackName, deviceName=None, cacheDir=None):
+    """
+    Deletes the cached series of a device, or of every
+    device in the stack if no device name is given.
+    """
+    path = helper_cachePath(stackName, deviceName, cacheDir)
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def helper_cachePath(stackName, deviceName=None, cacheDir=None):
+    """
+    Returns the directory holding a device's cached series.
+    """
+    cacheDir = cacheDir or os.environ.get('TIDEGAUGE_CACHE', DEFAULT_CACHE_DIR)
+    path = os.path.join(os.path.expanduser(cacheDir), stackName)
+    return os.path.join(path, deviceName) if deviceName else path
+
+
+def helper_readMeta(path):
+    """
+    Reads the metadata of a cached series. A series
+    that hasn't been synced yet is empty.
+    """
+    try:
+        with open(os.path.join(path, 'meta.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'count': 0, 'watermark': 0}
+
+
+def helper_writeMeta(path, meta):
+    """
+    Atomically replaces the metadata of a cached series.
+    """
+    filename = os.path.join(path, 'meta.json')
+    with open(f'{filename}.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(f'{filename}.tmp', filename)
+
+
+def helper_toNumber(value):
+    """
+    Converts an attribute value (stored as a string) to a float,
+    using NaN for missing or non-numeric values.
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
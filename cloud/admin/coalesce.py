@@ -0,0 +1,385 @@
+#  _______ _     _         _____
+# |__   __(_)   | |       / ____|
+#    | |   _  __| | ___  | |  __  __ _ _   _  __ _  ___
+#    | |  | |/ _` |/ _ \ | | |_ |/ _` | | | |/ _` |/ _ \
+#    | |  | | (_| |  __/ | |__| | (_| | |_| | (_| |  __/
+#    |_|  |_|\__,_|\___|  \_____|\__,_|\__,_|\__, |\___|
+#                                             __/ |
+#                                            |___/
+# Author: Bryce Kellogg (bryce@kellogg.org)
+# Copyright: 2023 Bryce Kellogg
+# License: GPLv3
+#
+# Ingest coalescing. Every device publish posted straight to the API
+# costs one request of the usage plan (RestUsagePlan allows 3000 per
+# day at 2 per second), so a handful of devices can use up the quota.
+# Instead, device publishes can be sent to a queue that is drained by
+# a Coalescer, which merges them into multi-device batches and posts
+# them at a pace that spreads the remaining quota over the rest of
+# the day.
+#
+#  +-------------+       +-------+       +-----------+       +-------------+
+#  |             |       |       |       |           |       |             |
+#  | Particle.io |------>| Queue |------>| Coalescer |------>| API Gateway |
+#  |             |       |       |       |           |       |             |
+#  +-------------+       +-------+       +-----------+       +-------------+
+#
+import sys
+import json
+import time
+import queue
+import threading
+
+from .throttle import TokenBucket, DailyQuota
+from lambdafunction.lambdafunction import helper_decodeRecords
+
+# The largest batch to post, in bytes of JSON. This is well
+# under the 6 MB limit on lambda function request payloads.
+DEFAULT_MAX_BYTES = 256 * 1024
+
+# How long a received SQS message stays hidden from other receivers,
+# in seconds. Messages waiting in the buffer are extended by this
+# much whenever half of it has passed.
+VISIBILITY_TIMEOUT = 300
+
+
+def command_ingestCoalesce(args):
+    """
+    Command handler for running the ingest coalescer.
+
+    Params:
+       args.queue_url = the URL of the SQS queue to drain, or None
+                        to read one publish per line from stdin
+       args.url = the base URL of the API
+       args.apikey = the API key to post with
+       args.quota, args.rate, args.burst = the usage plan limits
+       args.max_bytes = the largest batch to post
+    """
+    from tidegauge import Client
+
+    if args.queue_url:
+        source = SqsSource(args.queue_url)
+    else:
+        source = LocalSource()
+        def readStdin():
+            for line in sys.stdin:
+                if line.strip(): source.put(line)
+            source.close()
+        threading.Thread(target=readStdin, daemon=True).start()
+
+    with Client(args.url, args.apikey, retries=0) as client:
+        coalescer = Coalescer(client.postBatch, args.quota, args.rate, args.burst, args.max_bytes)
+        coalescer.run(source)
+
+
+class Coalescer:
+    """
+    Buffers device publishes and posts them as multi-device batches.
+
+    A batch is posted when the usage plan allows it (see TokenBucket &
+    DailyQuota) and either the buffer holds max bytes of data or the
+    oldest buffered publish has waited as long as the pacing interval.
+    The pacing interval is the time left in the day divided by the
+    requests left in the quota, less a reserve for other API users,
+    so the quota lasts until it resets no matter how many devices
+    are publishing. Records are deduplicated by device & timestamp.
+
+    Params:
+        post = a function that posts a batch, given a list of
+               {'name': <device name>, 'data': dataList} dicts
+        quota, rate, burst = the usage plan limits
+        maxBytes = the size of batch that is posted right away
+        reserve = the fraction of the quota left for other uses
+        clock = a function returning the current Unix time
+    """
+
+    def __init__(self, post, quota=3000, rate=2, burst=10, maxBytes=DEFAULT_MAX_BYTES, reserve=0.1, clock=time.time):
+        self.post = post
+        self.quota = DailyQuota(quota, clock=clock)
+        self.bucket = TokenBucket(rate, burst, clock=clock)
+        self.maxBytes = maxBytes
+        self.reserve = reserve
+        self.clock = clock
+
+        self.buffer = {}    # device name -> {timestamp: attributes}
+        self.acks = []      # called once the buffered publishes are posted
+        self.deadLetters = []   # (publish or device batch, error) that were dropped
+        self.pending = []   # the device names of each batch left to post
+        self.numBytes = 0
+        self.oldest = None
+        self.failures = 0
+        self.retryAt = 0
+
+    def add(self, publish, ack=None):
+        """
+        Adds a device publish to the buffer.
+
+        Params:
+            publish = a POST /data body, either as a dict or JSON
+            ack = a function to call once the publish has been posted
+
+        Raises: ValueError, KeyError or TypeError if the publish is
+                malformed, in which case nothing is added
+        """
+        if isinstance(publish, (str, bytes)): publish = json.loads(publish)
+        if not isinstance(publish, dict): raise TypeError("publish is not an object")
+
+        # Parse the whole publish before buffering any of it
+        parsed = []
+        for device in publish.get('devices', [publish]):
+            dataList = device['data']
+            if isinstance(dataList, str): dataList = helper_decodeRecords(dataList)
+            dataList = [(int(timestamp), dict(attributes)) for timestamp, attributes in dataList]  # the firmware sends strings
+            parsed.append((str(device['name']), dataList))
+
+        for deviceName, dataList in parsed:
+            records = self.buffer.setdefault(deviceName, {})
+            for timestamp, attributes in dataList:
+                if timestamp not in records:
+                    self.numBytes += len(json.dumps([timestamp, attributes])) + 1
+                records[timestamp] = attributes
+
+        if ack: self.acks.append(ack)
+        if self.oldest is None: self.oldest = self.clock()
+
+    def interval(self):
+        """
+        Returns: the number of seconds between posts that spreads
+                 the remaining quota over the rest of the day
+        """
+        remaining = self.quota.remaining() * (1 - self.reserve)
+        if remaining < 1: return self.quota.secondsLeft()
+        return max(1 / self.bucket.rate, self.quota.secondsLeft() / remaining)
+
+    def due(self):
+        """
+        Returns: True if the buffer should be posted now
+        """
+        if not self.buffer or self.clock() < self.retryAt: return False
+        full = self.numBytes >= self.maxBytes
+        waited = self.clock() - self.oldest >= self.interval()
+        return full or waited
+
+    def flush(self, force=False):
+        """
+        Posts the buffer as a single batch if it is due (or forced) and
+        the usage plan allows it. A batch the API rejects (a 4xx error
+        other than 429) is split in half and each half posted, down to
+        a single device, whose records are then dropped to deadLetters.
+        The halves are held to the usage plan like any other post, and
+        those still pending when it runs out are posted by the next
+        flushes. Publishes are only acknowledged once the whole buffer
+        is posted. Other failed posts are kept in the buffer and
+        retried with exponential backoff.
+
+        Returns: True if a batch was posted
+        """
+        if not self.buffer or not (force or self.due()): return False
+        if not self.allowed(): return False
+
+        # A new batch of the whole buffer, unless halves of a
+        # rejected batch are still waiting to be posted
+        if not self.pending: self.pending = [list(self.buffer)]
+        posted = []
+        try:
+            self.postPending(posted)
+        except Exception as e:
+            self.recount()
+            self.failures += 1
+            self.retryAt = self.clock() + min(300, 2**self.failures)
+            print(f"Error: posting batch failed ({e}), retrying in {self.retryAt - self.clock():.0f} s")
+            return False
+
+        numRecords = sum(len(_['data']) for _ in posted)
+        if self.buffer:
+            self.recount()
+            print(f"Posted {numRecords} records from {len(posted)} devices, {len(self.buffer)} devices left to post")
+            return True
+
+        print(f"Posted {numRecords} records from {len(posted)} devices ({self.numBytes} bytes)")
+        for ack in self.acks: ack()
+        self.buffer, self.acks, self.numBytes, self.oldest = {}, [], 0, None
+        self.failures = 0
+        return True
+
+    def postPending(self, posted):
+        """
+        Posts the pending batches, splitting a batch the API rejects
+        into two pending halves. Each post waits for the usage plan,
+        and once it runs out the rest stay pending. Devices are
+        removed from the buffer once posted or dropped.
+
+        Params:
+            posted = a list the posted devices are added to
+
+        Raises: the error of a post that failed for any other reason,
+                whose batch is left pending
+        """
+        while self.pending and self.allowed():
+            names = self.pending.pop(0)
+            devices = [{'name': _, 'data': sorted(self.buffer[_].items())} for _ in names]
+            self.bucket.take()
+            self.quota.take()
+            try:
+                self.post(devices)
+            except Exception as e:
+                status = helper_statusCode(e)
+                if status is None or status == 429 or not 400 <= status < 500:
+                    self.pending.insert(0, names)
+                    raise
+                if len(names) > 1:
+                    half = len(names) // 2
+                    self.pending[:0] = [names[:half], names[half:]]
+                    continue
+                print(f"Error: dropping {len(devices[0]['data'])} records of {names[0]} rejected by the API ({e})")
+                self.deadLetters.append((devices[0], str(e)))
+                devices = []
+
+            posted.extend(devices)
+            for name in names:
+                del self.buffer[name]
+
+    def allowed(self):
+        """
+        Returns: True if the usage plan allows a post now
+        """
+        return self.bucket.delay() == 0 and self.quota.remaining() >= 1
+
+    def recount(self):
+        """
+        Recounts the bytes of JSON in the buffer.
+        """
+        self.numBytes = sum(len(json.dumps(_)) + 1 for records in self.buffer.values() for _ in records.items())
+
+    def run(self, source, poll=1):
+        """
+        Drains a source of publishes until it is closed, posting
+        batches as they come due. Anything left is posted at the end.
+
+        Params:
+            source = a LocalSource or SqsSource
+            poll = the longest time to wait for a publish, in seconds
+        """
+        while not source.closed:
+            for body, ack in source.receive(poll):
+                try:
+                    self.add(body, ack)
+                except (ValueError, KeyError, TypeError, AttributeError) as e:
+                    print(f"Error: dropping malformed publish ({e!r})")
+                    self.deadLetters.append((body, repr(e)))
+                    if ack: ack()
+            self.flush()
+        while self.buffer and not self.flush(force=True):
+            time.sleep(min(300, 2**self.failures))
+
+
+def helper_statusCode(error):
+    """
+    Returns: the HTTP status code of a failed post, or None if
+             the post did not get a response
+    """
+    response = getattr(error, 'response', None)
+    return getattr(response, 'status_code', None)
+
+
+class LocalSource:
+    """
+    A local stand-in for the device publish queue, backed by an
+    in-process queue.Queue. Publishes are acknowledged immediately.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.closed = False
+
+    def put(self, body):
+        self.queue.put(body)
+
+    def close(self):
+        self.queue.put(None)
+
+    def receive(self, timeout):
+        """
+        Returns: a list of (body, ack) tuples, waiting up to the
+                 timeout for the first one
+        """
+        messages = []
+        try:
+            body = self.queue.get(timeout=timeout)
+            while True:
+                if body is None:
+                    self.closed = True
+                    break
+                messages.append((body, None))
+                body = self.queue.get_nowait()
+        except queue.Empty:
+            pass
+        return messages
+
+
+class SqsSource:
+    """
+    A device publish queue in AWS SQS. Messages are deleted from
+    the queue once the batch they were merged into is posted.
+
+    Messages can wait in the buffer for much longer than a visibility
+    timeout, so the visibility of held messages is extended while they
+    wait. A message that is received again anyway (SQS caps the total
+    at 12 hours) is not returned twice; its newer receipt handle is
+    kept so the ack still deletes it.
+    """
+
+    def __init__(self, queueUrl, clock=time.monotonic):
+        import boto3
+        self.sqs = boto3.client('sqs')
+        self.queueUrl = queueUrl
+        self.clock = clock
+        self.closed = False
+        self.held = {}  # message id -> [receipt handle, time of last extension]
+
+    def receive(self, timeout):
+        """
+        Returns: a list of (body, ack) tuples, long polling up to
+                 the timeout for the first one
+        """
+        self.extend()
+        res = self.sqs.receive_message(
+                QueueUrl=self.queueUrl,
+                MaxNumberOfMessages=10,
+                VisibilityTimeout=VISIBILITY_TIMEOUT,
+                WaitTimeSeconds=int(timeout))
+
+        messages = []
+        for message in res.get('Messages', []):
+            messageId = message['MessageId']
+            if messageId in self.held:
+                self.held[messageId] = [message['ReceiptHandle'], self.clock()]
+                continue
+            self.held[messageId] = [message['ReceiptHandle'], self.clock()]
+            messages.append((message['Body'], self.acker(messageId)))
+        return messages
+
+    def extend(self):
+        """
+        Extends the visibility of held messages that are halfway
+        to becoming visible again.
+        """
+        due = [messageId for messageId, (handle, extended) in self.held.items() if self.clock() - extended >= VISIBILITY_TIMEOUT / 2]
+        for i in range(0, len(due), 10):
+            entries = [
+                {'Id': str(n), 'ReceiptHandle': self.held[messageId][0], 'VisibilityTimeout': VISIBILITY_TIMEOUT}
+                for n, messageId in enumerate(due[i:i+10])
+            ]
+            self.sqs.change_message_visibility_batch(QueueUrl=self.queueUrl, Entries=entries)
+            for messageId in due[i:i+10]:
+                self.held[messageId][1] = self.clock()
+
+    def acker(self, messageId):
+        """
+        Returns: a function that deletes a held message, using its
+                 latest receipt handle. Only the first call deletes.
+        """
+        def ack():
+            held = self.held.pop(messageId, None)
+            if held: self.sqs.delete_message(QueueUrl=self.queueUrl, ReceiptHandle=held[0])
+        return ack
@@ -15,9 +15,13 @@
 import json
 import boto3
 import sys
-from tabulate import tabulate
 
 from pprint import pprint
+from .output import helper_emit
+
+# The number of records requested per invocation
+# when reading data without an overall limit.
+DEFAULT_PAGE_SIZE = 1000
 
 def command_lambdaInvoke(args):
     """
@@ -31,6 +35,7 @@ def command_lambdaInvoke(args):
     if args.post:   method, path = ('POST', '/data')
     if args.get:    method, path = ('GET', '/data')
     if args.config: method, path = ('GET', '/config')
+    if args.latest: method, path = ('GET', '/data/latest')
     if path is None: sys.exit("ERROR: invalid action")
 
     # Build the event
@@ -54,19 +59,40 @@ def command_lambdaInvoke(args):
     if args.post: event['body'] = args.data
     if args.get: event['queryStringParameters'] ={'name': args.device, 'limit': args.limit, f'timestamp_{op}': timestamp}
     if args.config: event['queryStringParameters'] = None
+    if args.latest: event['queryStringParameters'] = {'name': args.device} if args.device else None
 
     # Make the actual invokation
     functionName = f"{stackName}-lambda-function"
-    res = boto3.client('lambda').invoke(FunctionName=functionName,
-                                        InvocationType='RequestResponse',
-                                        Payload=json.dumps(event))
+    client = boto3.client('lambda')
+    def invoke(event):
+        res = client.invoke(FunctionName=functionName,
+                            InvocationType='RequestResponse',
+                            Payload=json.dumps(event))
+        return json.loads(res['Payload'].read())
 
-    # Parse the response if we did a GET operation
+    # A GET on /data returns one page per invocation, so keep invoking
+    # with the cursor of the previous page & print each page as it comes.
     if args.get:
-        payload = res['Payload']
-        data = json.loads(json.loads(payload.read())['body'])
-        if len(data) == 0: return # skip printing or deleting if there's no data
-        print(tabulate(data, headers='keys'))
+        def pages():
+            limit = args.limit
+            params = event['queryStringParameters']
+            while limit is None or limit > 0:
+                params['limit'] = min(limit or DEFAULT_PAGE_SIZE, DEFAULT_PAGE_SIZE)
+                res = invoke(event)
+                data = json.loads(res['body'])
+                if data: yield data
+                if limit is not None: limit -= len(data)
+
+                params['cursor'] = (res.get('headers') or {}).get('X-Next-Cursor')
+                if not params['cursor']: break
+        helper_emit(pages(), args.format)
+        return
+
+    res = invoke(event)
+
+    # Parse the response if we did a GET operation
+    if args.latest:
+        helper_emit([json.loads(res['body'])], args.format)
     
     # Parse the response if we did a POST operation
     # if args.post:
@@ -0,0 +1,102 @@
+#  _______ _     _         _____
+# |__   __(_)   | |       / ____|
+#    | |   _  __| | ___  | |  __  __ _ _   _  __ _  ___
+#    | |  | |/ _` |/ _ \ | | |_ |/ _` | | | |/ _` |/ _ \
+#    | |  | | (_| |  __/ | |__| | (_| | |_| | (_| |  __/
+#    |_|  |_|\__,_|\___|  \_____|\__,_|\__,_|\__, |\___|
+#                                             __/ |
+#                                            |___/
+# Author: Bryce Kellogg (bryce@kellogg.org)
+# Copyright: 2023 Bryce Kellogg
+# License: GPLv3
+#
+# Output formatting shared by the commands that print records.
+import sys
+import csv
+import json
+import itertools
+
+OUTPUT_FORMATS = ['table', 'ndjson', 'csv']
+
+# The number of records the "csv" format reads ahead to find its
+# columns, as some keys (e.g. water-level or the sample statistics)
+# only appear on some records
+CSV_LOOKAHEAD = 1000
+
+
+def helper_emit(pages, fmt='table', out=sys.stdout):
+    """
+    Prints pages of records in the given format.
+
+    The "ndjson" format prints each page as soon as it arrives and
+    only ever holds one page in memory, so the output can be piped
+    into other tools while a large query is running. The "csv" format
+    does the same once it has read ahead far enough to pick its
+    columns (see helper_emitCsv); as they are fixed from then on,
+    "ndjson" is the format that always keeps every key. The "table"
+    format has to see every record to size its columns, so it
+    collects all pages before printing anything.
+
+    Params:
+        pages = an iterable of lists of records (dicts)
+        fmt = one of OUTPUT_FORMATS
+        out = the file to print to
+
+    Returns: the number of records printed
+    """
+    numRecords = 0
+
+    if fmt == 'table':
+        from tabulate import tabulate
+        data = [_ for page in pages for _ in page]
+        if data: print(tabulate(data, headers='keys'), file=out)
+        return len(data)
+
+    if fmt == 'csv':
+        return helper_emitCsv(pages, out)
+
+    for page in pages:
+        for record in page: out.write(json.dumps(record) + '\n')
+        out.flush()
+        numRecords += len(page)
+
+    return numRecords
+
+
+def helper_emitCsv(pages, out):
+    """
+    Prints pages of records as CSV.
+
+    The columns are the keys of the first CSV_LOOKAHEAD records: the
+    devicename & timestamp first, then the other keys in the order
+    they appear. Pages are held back until then. Keys first seen
+    after the header is printed have no column, so they are left
+    out with a warning on stderr.
+
+    Returns: the number of records printed
+    """
+    pages = iter(pages)
+    held, numHeld = [], 0
+    for page in pages:
+        held.append(page)
+        numHeld += len(page)
+        if numHeld >= CSV_LOOKAHEAD: break
+    if not numHeld: return 0
+
+    keys = ['devicename', 'timestamp'] + [k for page in held for record in page for k in record]
+    fieldnames = list(dict.fromkeys(keys))
+    writer = csv.DictWriter(out, fieldnames=fieldnames, restval='', extrasaction='ignore')
+    writer.writeheader()
+
+    numRecords, missing = 0, set(fieldnames)
+    for page in itertools.chain(held, pages):
+        new = {k for record in page for k in record} - missing
+        if new:
+            missing |= new
+            print(f"Warning: leaving out the {', '.join(sorted(new))} keys, first seen after the CSV header "
+                  f"was printed (use --format ndjson to keep every key)", file=sys.stderr)
+        writer.writerows(page)
+        out.flush()
+        numRecords += len(page)
+
+    return numRecords
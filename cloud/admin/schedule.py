@@ -0,0 +1,288 @@
+#  _______ _     _         _____
+# |__   __(_)   | |       / ____|
+#    | |   _  __| | ___  | |  __  __ _ _   _  __ _  ___
+#    | |  | |/ _` |/ _ \ | | |_ |/ _` | | | |/ _` |/ _ \
+#    | |  | | (_| |  __/ | |__| | (_| | |_| | (_| |  __/
+#    |_|  |_|\__,_|\___|  \_____|\__,_|\__,_|\__, |\___|
+#                                             __/ |
+#                                            |___/
+# Author: Bryce Kellogg (bryce@kellogg.org)
+# Copyright: 2023 Bryce Kellogg
+# License: GPLv3
+#
+# Tide-phase aware sampling schedules. A harmonic tide model is
+# fitted to a device's recent series and used to plan its polling
+# period over the coming hours: dense around high & low water, where
+# the timing of the turning point is decided, and where the level
+# changes quickly, and sparse in between. The plan is stored in the
+# device's config as a compact "sensorSchedule" string:
+#
+#     <start>;<minutes>x<period>,<minutes>x<period>,...
+#
+# where <start> is a Unix timestamp and each entry polls every
+# <period> seconds for <minutes> minutes. After the last entry the
+# device goes back to its "sensorPollingPeriod". A day of schedule
+# is around 15 entries, well within the 622 byte limit of a Particle
+# function argument.
+import sys
+import time
+import numpy as np
+
+from .cache import syncCache, loadSeries
+from lambdafunction.lambdafunction import postConfig
+
+# The main tidal constituents and their periods in hours, most
+# important first. Two constituents can only be told apart by a
+# series longer than 1 / |f1 - f2| (the Rayleigh criterion), about
+# 14.8 days for M2 & S2 and 13.7 days for K1 & O1, so fits to shorter
+# series drop the less important of each such pair.
+CONSTITUENTS = {
+    'M2': 12.4206012,
+    'S2': 12.0,
+    'K1': 23.9344696,
+    'O1': 25.8193417,
+}
+
+# The polling periods a schedule may use, in seconds. Keeping to a
+# few steps makes runs of the same period longer & schedules shorter.
+PERIOD_STEPS = [30, 60, 120, 300, 600]
+
+
+def command_dbSchedule(args):
+    """
+    Command handler for planning a device's sampling schedule.
+
+    Params:
+       args.name = the name of the CloudFormation stack
+       args.device = the name of the device
+       args.days = the days of history to fit the tide model to
+       args.hours = the length of the schedule in hours
+       args.resolution = the change in level between samples, in mm
+       args.window = the dense window around turning points, in minutes
+       args.post = save the schedule to the device's config
+       args.cache_dir = the directory of the local data cache
+    """
+    if args.hours <= 0: sys.exit("Error: --hours must be positive")
+
+    # Fit the model to the recent, cached series
+    syncCache(args.name, args.device, args.cache_dir)
+    series = loadSeries(args.name, args.device, args.cache_dir)
+    timestamps, distances = series['timestamp'], series['distance']
+    recent = (timestamps >= timestamps[-1] - args.days*86400) if len(timestamps) else []
+    if np.count_nonzero(recent) < 100: sys.exit(f"Error: not enough data for {args.device} to fit a tide model")
+
+    model = fitTideModel(timestamps[recent], distances[recent])
+    dropped = [_ for _ in CONSTITUENTS if _ not in model['constituents']]
+    if dropped:
+        span = (timestamps[recent][-1] - timestamps[recent][0]) / 86400
+        print(f"Warning: {span:.1f} days of data can't separate {', '.join(dropped)} from the other constituents, "
+              f"leaving them out (fit at least 15 days for all of them)")
+    start = int(time.time()) // 60 * 60
+    entries, turningPoints = planSchedule(model, start, args.hours*3600, args.resolution, args.window*60)
+    schedule = helper_encodeSchedule(start, entries)
+
+    # Show the plan
+    utc = lambda _: time.strftime('%Y-%m-%d %H:%M', time.gmtime(_))
+    print(f"Tide model ({', '.join(model['constituents'])}) fit to {np.count_nonzero(recent)} records, rms error {model['rms']:.0f} mm")
+    print("Turning points: " + ', '.join(utc(_) for _ in turningPoints))
+    for entryStart, (minutes, period) in zip(helper_entryStarts(start, entries), entries):
+        print(f"\t{utc(entryStart)}  {minutes:>4} min  every {period:>3} s")
+
+    numSamples = sum(minutes * 60 // period for minutes, period in entries)
+    numFixed = args.hours * 3600 // PERIOD_STEPS[0]
+    print(f"{numSamples} samples instead of {numFixed} ({numFixed / max(numSamples, 1):.1f}x fewer)")
+    print(f"sensorSchedule={schedule} ({len(schedule)} bytes)")
+
+    if args.post:
+        res = postConfig(args.name, args.device, {'sensorSchedule': schedule})
+        if res['statusCode'] != 200: sys.exit(f"ERROR: query error {res}")
+
+
+def fitTideModel(timestamps, levels):
+    """
+    Fits a harmonic tide model (a mean plus a cosine & sine term for
+    each of CONSTITUENTS) to a series by least squares. NaN levels
+    are ignored. Constituents the series is too short to separate
+    from a more important one are left out (see CONSTITUENTS).
+
+    Params:
+        timestamps = an array of Unix timestamps
+        levels = an array of water levels or sensor distances
+
+    Returns: a dict with the 'constituents' used, the 'mean', the
+             'coefficients' (an array of [cos, sin] pairs in the
+             order of the constituents) and the 'rms' error of the fit
+    """
+    t = np.asarray(timestamps, dtype='f8')
+    y = np.asarray(levels, dtype='f8')
+    valid = np.isfinite(y)
+    t, y = t[valid], y[valid]
+
+    span = t.max() - t.min() if len(t) else 0
+    constituents = []
+    for name, hours in CONSTITUENTS.items():
+        frequency = 1 / (hours * 3600)
+        if all(span * abs(frequency - 1 / (CONSTITUENTS[_] * 3600)) >= 1 for _ in constituents):
+            constituents.append(name)
+
+    design = helper_design(t, constituents)
+    solution, *_ = np.linalg.lstsq(design, y, rcond=None)
+    residuals = y - design @ solution
+    return {
+        'constituents': constituents,
+        'mean': solution[0],
+        'coefficients': solution[1:].reshape(-1, 2),
+        'rms': float(np.sqrt(np.mean(residuals**2))),
+    }
+
+
+def predictTide(model, timestamps):
+    """
+    Evaluates a tide model.
+
+    Returns: a tuple of (levels, rates) arrays, the rates being
+             the change in level per second
+    """
+    t = np.asarray(timestamps, dtype='f8')
+    omega = helper_omega(model['constituents'])
+    phase = np.outer(t, omega)
+    a, b = model['coefficients'][:, 0], model['coefficients'][:, 1]
+    levels = model['mean'] + np.cos(phase) @ a + np.sin(phase) @ b
+    rates = np.cos(phase) @ (b * omega) - np.sin(phase) @ (a * omega)
+    return levels, rates
+
+
+def planSchedule(model, start, duration, resolution=20, window=45*60):
+    """
+    Plans the polling periods for a span of time from a tide model.
+
+    Each minute gets the longest of PERIOD_STEPS that keeps the
+    predicted change between samples under the resolution, except
+    that minutes within the window of a high or low water get the
+    shortest period. Runs of the same period are then merged, with
+    runs shorter than 10 minutes taking the denser of their
+    neighbours' periods, to keep the schedule compact.
+
+    Params:
+        model = a tide model from fitTideModel
+        start = the Unix timestamp the schedule starts at
+        duration = the length of the schedule in seconds
+        resolution = the largest change in level between samples
+        window = how far either side of a turning point to sample
+                 densely, in seconds
+
+    Returns: a tuple of (entries, turningPoints), where entries is
+             a list of (minutes, period) tuples and turningPoints is
+             a list of the predicted high & low water timestamps
+    """
+    minutes = start + 60 * np.arange(duration // 60)
+    levels, rates = predictTide(model, minutes)
+
+    # High & low water are where the rate changes sign. The search
+    # goes a window past either end so nearby turning points count.
+    margin = -(-window // 60)
+    around = start + 60 * np.arange(-margin, duration // 60 + margin)
+    _, aroundRates = predictTide(model, around)
+    crossings = np.nonzero(np.diff(np.sign(aroundRates)) != 0)[0]
+    r0, r1 = aroundRates[crossings], aroundRates[crossings + 1]
+    turningPoints = around[crossings] + 60 * r0 / (r0 - r1)
+
+    # Longest period that keeps the change under the resolution
+    steps = np.array(PERIOD_STEPS)
+    with np.errstate(divide='ignore'):
+        wanted = resolution / np.abs(rates)
+    periods = steps[np.maximum(np.searchsorted(steps, wanted, side='right') - 1, 0)]
+
+    for tp in turningPoints:
+        periods[np.abs(minutes - tp) <= window] = steps[0]
+
+    entries = helper_runs(periods)
+    return helper_mergeRuns(entries, minRun=10), turningPoints.astype('i8').tolist()
+
+
+def helper_design(t, constituents):
+    """
+    Builds the least squares design matrix of a harmonic model.
+    """
+    phase = np.outer(t, helper_omega(constituents))
+    columns = [np.ones_like(t)]
+    for i in range(phase.shape[1]):
+        columns += [np.cos(phase[:, i]), np.sin(phase[:, i])]
+    return np.column_stack(columns)
+
+
+def helper_omega(constituents):
+    """
+    Returns: the angular speeds of the named constituents in
+             radians per second
+    """
+    return 2 * np.pi / (np.array([CONSTITUENTS[_] for _ in constituents]) * 3600)
+
+
+def helper_runs(periods):
+    """
+    Run-length encodes an array of per-minute periods.
+
+    Returns: a list of (minutes, period) tuples
+    """
+    edges = np.flatnonzero(np.diff(periods)) + 1
+    starts = np.concatenate([[0], edges])
+    lengths = np.diff(np.concatenate([starts, [len(periods)]]))
+    return [(int(n), int(periods[s])) for s, n in zip(starts, lengths)]
+
+
+def helper_mergeRuns(entries, minRun):
+    """
+    Folds runs shorter than minRun minutes into a neighbour, using
+    the denser of the two periods so no planned sample is lost,
+    then merges neighbours with the same period.
+    """
+    entries = list(entries)
+    while True:
+        short = [i for i, (n, _) in enumerate(entries) if n < minRun]
+        if not short or len(entries) == 1: break
+        i = short[0]
+        j = i + 1 if i == 0 or (i + 1 < len(entries) and entries[i + 1][1] <= entries[i - 1][1]) else i - 1
+        n = entries[i][0] + entries[j][0]
+        period = min(entries[i][1], entries[j][1])
+        entries[min(i, j)] = (n, period)
+        del entries[max(i, j)]
+
+        # Neighbours with the same period become one run
+        merged = []
+        for n, period in entries:
+            if merged and merged[-1][1] == period:
+                merged[-1] = (merged[-1][0] + n, period)
+            else:
+                merged.append((n, period))
+        entries = merged
+    return entries
+
+
+def helper_entryStarts(start, entries):
+    """
+    Returns: the start timestamp of each schedule entry
+    """
+    starts = []
+    for minutes, _ in entries:
+        starts.append(start)
+        start += minutes * 60
+    return starts
+
+
+def helper_encodeSchedule(start, entries):
+    """
+    Encodes a schedule as a compact "sensorSchedule" string.
+    """
+    return f"{int(start)};" + ','.join(f"{n}x{period}" for n, period in entries)
+
+
+def helper_decodeSchedule(schedule):
+    """
+    Decodes a "sensorSchedule" string.
+
+    Returns: a tuple of (start, entries)
+    """
+    start, entries = schedule.split(';')
+    entries = [tuple(map(int, _.split('x'))) for _ in entries.split(',') if _]
+    return int(start), entries
@@ -0,0 +1,237 @@
+#  _______ _     _         _____
+# |__   __(_)   | |       / ____|
+#    | |   _  __| | ___  | |  __  __ _ _   _  __ _  ___
+#    | |  | |/ _` |/ _ \ | | |_ |/ _` | | | |/ _` |/ _ \
+#    | |  | | (_| |  __/ | |__| | (_| | |_| | (_| |  __/
+#    |_|  |_|\__,_|\___|  \_____|\__,_|\__,_|\__, |\___|
+#                                             __/ |
+#                                            |___/
+# Author: Bryce Kellogg (bryce@kellogg.org)
+# Copyright: 2023 Bryce Kellogg
+# License: GPLv3
+#
+# A local stand-in for API Gateway. HTTP requests are turned into the
+# same AWS_PROXY events that API Gateway sends to the lambda function
+# and passed to process() on a pool of worker threads, so the real
+# request path can be load tested & profiled without deploying. The
+# lambda function still talks to the stack's DynamoDB tables.
+#
+#  +--------+       +--------------+       +-----------+       +----------+
+#  |        |       |              |       |           |       |          |
+#  | Client |<----->| local-serve  |<----->| process() |<----->| DynamoDB |
+#  |        |       |  (asyncio)   |       | (threads) |       |          |
+#  +--------+       +--------------+       +-----------+       +----------+
+#
+import os
+import json
+import time
+import asyncio
+import boto3
+from http import HTTPStatus
+from urllib.parse import urlsplit, parse_qsl
+from concurrent.futures import ThreadPoolExecutor
+
+from .throttle import TokenBucket, DailyQuota
+
+# The largest request body accepted, the same as API Gateway
+MAX_BODY_SIZE = 10 * 1024 * 1024
+
+
+def command_localServe(args):
+    """
+    Command handler for running the local API server.
+
+    Params:
+       args.name = the name of the CloudFormation stack to use
+       args.host = the address to listen on
+       args.port = the port to listen on
+       args.workers = the number of threads running process()
+       args.apikey = the accepted API keys (no check if not given)
+       args.rate = the usage plan's RateLimit per API key
+       args.burst = the usage plan's BurstLimit per API key
+       args.quota = the usage plan's Quota per API key per day
+    """
+    # The lambda function finds its tables through the stack name
+    os.environ['StackName'] = args.name
+    from lambdafunction.lambdafunction import process
+    helper_warmBoto3()
+
+    server = LocalServer(process, args.workers, args.apikey, args.rate, args.burst, args.quota)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+class LocalServer:
+    """
+    An asyncio HTTP server that dispatches requests to a lambda
+    handler, enforcing API keys and usage plan limits if set.
+
+    Params:
+        handler = the lambda handler, called as handler(event, context)
+        workers = the number of worker threads
+        apikeys = a list of accepted API keys, or None to accept all
+        rate, burst = the usage plan throttle, or None for no throttle
+        quota = the usage plan's daily quota, or None for no quota
+    """
+
+    def __init__(self, handler, workers=8, apikeys=None, rate=None, burst=None, quota=None):
+        self.handler = handler
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.apikeys = set(apikeys) if apikeys else None
+        self.rate = rate
+        self.burst = burst or rate
+        self.quota = quota
+        self.buckets = {}
+        self.quotas = {}
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handleConnection, host, port)
+        print(f"Serving on http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+    async def handleConnection(self, reader, writer):
+        """
+        Handles requests on a connection until it is closed.
+        Connections are kept alive unless the client asks not to.
+        """
+        try:
+            while True:
+                request = await helper_readRequest(reader)
+                if request is None: break
+
+                method, target, headers, body = request
+                start = time.perf_counter()
+                status, resHeaders, resBody = await self.handleRequest(method, target, headers, body)
+
+                keepAlive = headers.get('connection', '').lower() != 'close'
+                helper_writeResponse(writer, status, resHeaders, resBody, keepAlive)
+                await writer.drain()
+                print(f"{method} {target} {status} {(time.perf_counter() - start)*1000:.1f} ms")
+                if not keepAlive: break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except ValueError:
+            helper_writeResponse(writer, 400, {}, json.dumps({'message': 'Bad Request'}), False)
+        finally:
+            writer.close()
+
+    async def handleRequest(self, method, target, headers, body):
+        """
+        Applies the API key check & usage plan limits, then runs
+        the lambda handler on a worker thread.
+
+        Returns: a tuple of (status code, headers, body)
+        """
+        apikey = headers.get('x-api-key')
+        if self.apikeys is not None and apikey not in self.apikeys:
+            return 403, {}, json.dumps({'message': 'Forbidden'})
+
+        if self.quota is not None:
+            quota = self.quotas.setdefault(apikey, DailyQuota(self.quota))
+            if not quota.take():
+                return 429, {}, json.dumps({'message': 'Limit Exceeded'})
+
+        if self.rate is not None:
+            bucket = self.buckets.setdefault(apikey, TokenBucket(self.rate, self.burst))
+            if not bucket.take():
+                return 429, {}, json.dumps({'message': 'Too Many Requests'})
+
+        url = urlsplit(target)
+
+        # The login resource is a mock integration in API Gateway
+        if url.path == '/login' and method == 'POST':
+            return 200, {}, ''
+
+        event = helper_proxyEvent(method, url.path, dict(parse_qsl(url.query)), headers, body)
+        loop = asyncio.get_running_loop()
+        try:
+            res = await loop.run_in_executor(self.executor, self.handler, event, None)
+        except Exception as e:
+            # API Gateway hides lambda errors behind a 502
+            print(f"Error: {e!r}")
+            return 502, {}, json.dumps({'message': 'Internal server error'})
+
+        return res['statusCode'], res.get('headers') or {}, res.get('body') or ''
+
+
+def helper_warmBoto3():
+    """
+    Loads the lazily loaded parts of boto3's default session (the
+    credentials, endpoint data & the service models the lambda
+    function uses) on the main thread. process() makes its clients
+    from the default session on every worker thread, and loading
+    these from several threads at once races.
+    """
+    boto3.client('dynamodb')
+    boto3.resource('dynamodb')
+    boto3.client('sqs')
+
+
+def helper_proxyEvent(method, path, params, headers, body):
+    """
+    Builds the event that API Gateway sends to a lambda function
+    with an AWS_PROXY integration.
+    """
+    return {
+        'resource': path,
+        'path': path,
+        'httpMethod': method,
+        'headers': headers or None,
+        'queryStringParameters': params or None,
+        'body': body or None,
+        'isBase64Encoded': False,
+        'requestContext': {
+            'path': path,
+            'httpMethod': method,
+            'stage': 'local',
+            'requestTimeEpoch': int(time.time() * 1000),
+            'identity': {'apiKey': headers.get('x-api-key')},
+        },
+    }
+
+
+async def helper_readRequest(reader):
+    """
+    Reads an HTTP/1.1 request from a stream.
+
+    Returns: a tuple of (method, target, headers, body), where the
+             header names are lowercase, or None if the connection
+             was closed before a new request
+    """
+    line = await reader.readline()
+    if not line: return None
+    method, target, _ = line.decode('latin-1').split(' ', 2)
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in [b'\r\n', b'\n', b'']: break
+        name, value = line.decode('latin-1').split(':', 1)
+        headers[name.strip().lower()] = value.strip()
+
+    length = int(headers.get('content-length', 0))
+    if length > MAX_BODY_SIZE: raise ValueError("request body too large")
+    body = (await reader.readexactly(length)).decode('utf-8') if length else ''
+    return method, target, headers, body
+
+
+def helper_writeResponse(writer, status, headers, body, keepAlive):
+    """
+    Writes an HTTP/1.1 response to a stream.
+    """
+    body = body.encode('utf-8') if isinstance(body, str) else body
+    headers = {'Content-Type': 'application/json', **headers}
+    headers['Content-Length'] = str(len(body))
+    headers['Connection'] = 'keep-alive' if keepAlive else 'close'
+
+    try:
+        reason = HTTPStatus(status).phrase
+    except ValueError:
+        reason = ''
+
+    lines = [f"HTTP/1.1 {status} {reason}"]
+    lines += [f"{k}: {v}" for k,v in headers.items()]
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
@@ -15,201 +15,311 @@
 import sys
 import os
 import io
-from zipfile import ZipFile
+import time
+import base64
+import hashlib
+import threading
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import uuid
-from urllib import request
 import boto3
 from pprint import pprint
-from botocore.exceptions import ClientError
+from botocore.exceptions import ClientError, WaiterError
+
+# The files that make up the lambda function code,
+# as a mapping of name in the zipfile to local path.
+LAMBDA_FILES = {
+    'lambdafunction.py': 'lambdafunction/lambdafunction.py',
+}
 
 
 def command_stackDeploy(args):
     """
-    The function for creating/deploying the CloudFormation stack.
+    The function for creating/deploying CloudFormation stacks.
 
-    The process for deploying the stack consists of:
+    The process for deploying a stack consists of:
        - validating inputs & templates
        - creating an S3 bucket
        - uploading template files to the S3 bucket
        - zipping the lambda function code
        - uploading the zipfile to the S3 bucket
        - creating the stack
-       - cleaning up & deleting the S3 bucket
+
+    When several stacks are given, they are deployed concurrently
+    (see helper_runStacks), so deploying a fleet takes about as
+    long as the slowest stack.
 
     Params:
        args.name = the name of the CloudFormation stack
-       args.region = the AWS region this stack will be deployed in
+       args.names = a comma separated list of stacks, if given
+       args.region = the AWS region the stacks will be deployed in
+       args.numpy_layer = the ARN of a lambda layer providing NumPy, if any
     """
-    stackName = args.name
-    region = args.region
+    stackNames = helper_stackNames(args)
+
+    # The template & zipfile are shared by every stack
+    templateBody = helper_readTemplate()
+    lambdaZip = helper_lambdaZip()
+
+    deploy = lambda stackName, step: helper_deployStack(stackName, args.region, templateBody, lambdaZip, step, args.numpy_layer)
+    results = helper_runStacks(stackNames, deploy)
+    if len(results) < len(stackNames): sys.exit("Error: not all stacks were deployed")
+
 
-    # Filenames for the various files that need to be uploaded
+def helper_deployStack(stackName, region, templateBody, lambdaZip, step, numpyLayer=None):
+    """
+    Deploys a single stack. Runs on a worker thread of helper_runStacks.
+
+    Params:
+       stackName = the name of the CloudFormation stack
+       region = the AWS region the stack will be deployed in
+       templateBody = the template as a string
+       lambdaZip = the zipped lambda function code
+       step = a function that reports the current step
+       numpyLayer = the ARN of a lambda layer providing NumPy, if any
+    """
     templateFilename = 'templates/template.yaml'
-    lambdaFilename = 'lambdafunction/lambdafunction.py'
-    lambdaArcname = 'lambdafunction.py'
     lambdaZipFilename = f'lambda-{uuid.uuid4()}.zip'
 
-    # Pre-declare boto3 clients needed to deploy
-    cloudformation = boto3.client('cloudformation')
-    s3 = boto3.client('s3')
+    # boto3 clients are not safe to create across threads,
+    # so each stack gets its own session.
+    session = boto3.session.Session()
+    cloudformation = session.client('cloudformation')
+    s3 = session.client('s3')
 
     # Validate that the to-deploy stack does not already exist. Describe the stack
     # using boto3 and expect it to throw a ClientError with code "ValidationError".
+    step("validating")
     try:
-        res = cloudformation.describe_stacks(StackName=stackName)
+        cloudformation.describe_stacks(StackName=stackName)
     except ClientError as e:
         if e.response['Error']['Code'] != 'ValidationError':
-            sys.exit(f"Error: unexpected error describing stack {e}")
+            raise StackError(f"unexpected error describing stack {e}")
     else:
-        sys.exit(f"Error: stack {stackName} already exists")
-
-    # Validate each template exists, is readable, and is valid
-    if not os.access(templateFilename, os.R_OK):
-        sys.exit(f"Error: could not read template file {templateFilename}")
-
-    # We pass the template body as a string to multiple future functions, so we read it in here.
-    with open(templateFilename) as f:
-        templateBody = f.read()
-
-    # Zip the python file of the lambda function into an in-memory zipfile
-    zipBuffer = io.BytesIO()
-    with ZipFile(zipBuffer, mode='a') as archive: archive.write(lambdaFilename, arcname=lambdaArcname)
+        raise StackError(f"stack {stackName} already exists")
 
     # Validate the template itself via CloudFormation. If we don't
     # get an exception here, it means the tamplate is valid.
     try:
         cloudformation.validate_template(TemplateBody=templateBody)
     except ClientError as e:
-        sys.exit(f"Error: {e.response['Error']['Message']}")
+        raise StackError(e.response['Error']['Message'])
 
     # Create an S3 bucket to store CloudFormation template files & lambda function code in
+    step("creating bucket")
     bucketName = f'{stackName}-{uuid.uuid4()}'
     bucketConfiguration = {'LocationConstraint': region}
     try:
         s3.create_bucket(Bucket=bucketName, CreateBucketConfiguration=bucketConfiguration)
     except ClientError as e:
-        sys.exit(f"Error: unexpected error creating bucket {e}")
+        raise StackError(f"unexpected error creating bucket {e}")
 
     # Upload all the CloudFormation templates to the AWS S3 bucket
+    step("uploading")
     try:
-        s3.put_object(Bucket=bucketName, Body=templateBody,         Key=templateFilename)
-        s3.put_object(Bucket=bucketName, Body=zipBuffer.getvalue(), Key=lambdaZipFilename)
+        with ThreadPoolExecutor() as executor:
+            uploads = [
+                executor.submit(s3.put_object, Bucket=bucketName, Body=templateBody, Key=templateFilename),
+                executor.submit(s3.put_object, Bucket=bucketName, Body=lambdaZip, Key=lambdaZipFilename),
+            ]
+            for _ in uploads: _.result()
     except ClientError as e:
         # TODO: clean up AWS S3 bucket
-        sys.exit(f"Error: unexpected error uploading templates {e}")  # TODO: may leak S3 bucket
+        raise StackError(f"unexpected error uploading templates {e}")  # TODO: may leak S3 bucket
 
     # Create the stack itself
+    step("creating stack")
     templateURL = f'https://s3.amazonaws.com/{bucketName}/{templateFilename}'
     parameters = [
         {'ParameterKey': 'bucketName',  'ParameterValue': bucketName},
         {'ParameterKey': 'zipfileName', 'ParameterValue': lambdaZipFilename},
     ]
+    if numpyLayer: parameters.append({'ParameterKey': 'numpyLayer', 'ParameterValue': numpyLayer})
     cloudformation.create_stack(
             StackName=stackName,
             TemplateURL=templateURL,
             Capabilities=['CAPABILITY_NAMED_IAM'],
             Parameters=parameters)
 
-    # Wait for stack creation to complete & continue to cleanup even if it fails
+    # Wait for stack creation to complete
+    step("waiting for stack")
     try:
         waiter = cloudformation.get_waiter('stack_create_complete')
         waiter.wait(StackName=stackName)
-    except ClientError as e:
-        print(f"Error: unexpected error deploying {e}")
-
+    except (ClientError, WaiterError) as e:
+        raise StackError(f"unexpected error deploying {e}")
 
 
 def command_stackUpdate(args):
     """
-    The function for updating an existing stack.
+    The function for updating existing stacks.
+
+    Only artifacts that have changed are uploaded. The lambda function
+    code is compared to the deployed function's CodeSha256 and the
+    template to the template the stack was last deployed with, so a
+    cancelled or rolled back update is tried again next time. The
+    previous lambda zipfile is only deleted once the update succeeds,
+    and the new one is deleted if the update is cancelled. Stack
+    parameters other than the bucket & zipfile keep their values.
+    Independent AWS calls run concurrently.
+
+    With several stacks, the change sets of all of them are prepared
+    concurrently, confirmed together, and then executed concurrently.
 
     Params:
         args.name = the name of the CloudFormation stack
+        args.names = a comma separated list of stacks, if given
+        args.all = update every tide gauge stack
+        args.numpy_layer = the ARN of a lambda layer providing NumPy,
+                           or "" for none (default: leave as it is)
+    """
+    stackNames = helper_stackNames(args)
+
+    # The template & zipfile are shared by every stack
+    templateBody = helper_readTemplate()
+    lambdaZip = helper_lambdaZip()
+
+    prepare = lambda stackName, step: helper_prepareUpdate(stackName, templateBody, lambdaZip, step, args.numpy_layer)
+    results = helper_runStacks(stackNames, prepare)
+    failed = len(results) < len(stackNames)
+
+    # Stacks without a change set are already up to date
+    changeSets = {k: v for k,v in results.items() if v is not None}
+    for stackName in sorted(results.keys() - changeSets.keys()):
+        print(f"Stack {stackName} is up to date")
+    if not changeSets:
+        if failed: sys.exit("Error: not all stacks were updated")
+        return
+
+    # Get confirmation
+    for stackName, changeSet in sorted(changeSets.items()):
+        print(f"Updating stack {stackName} with the following changes:")
+        for c in changeSet['changes']:
+            print(f"\t{c['ResourceChange']['Action']:<40}  {c['ResourceChange']['ResourceType']:<25}")
+
+    res = input("Continue? [y/N] ")
+    if res != 'y':
+        cloudformation = boto3.client('cloudformation')
+        s3 = boto3.client('s3')
+        for stackName, changeSet in changeSets.items():
+            cloudformation.delete_change_set(
+                StackName=stackName,
+                ChangeSetName='update')
+            if changeSet['newZipfile']:
+                s3.delete_object(Bucket=changeSet['bucketName'], Key=changeSet['newZipfile'])
+        sys.exit("Cancelling update")
+
+    execute = lambda stackName, step: helper_executeUpdate(stackName, changeSets[stackName], step)
+    results = helper_runStacks(sorted(changeSets), execute)
+    if failed or len(results) < len(changeSets): sys.exit("Error: not all stacks were updated")
+
+
+def helper_prepareUpdate(stackName, templateBody, lambdaZip, step, numpyLayer=None):
     """
-    stackName = args.name
+    Uploads the changed artifacts of a stack and creates a change set
+    for them. Runs on a worker thread of helper_runStacks.
 
-    # Filenames for the various files that need to be uploaded
+    Params:
+        stackName = the name of the CloudFormation stack
+        templateBody = the template as a string
+        lambdaZip = the zipped lambda function code
+        step = a function that reports the current step
+        numpyLayer = the ARN of a NumPy lambda layer, "" for none,
+                     or None to keep the stack's current layer
+
+    Returns: a dict with the 'changes' in the change set, the stack's
+             'bucketName', and the 'newZipfile' & 'oldZipfile' names
+             if the lambda function code changed (else None), or None
+             if the stack is already up to date
+    """
     templateFilename = 'templates/template.yaml'
-    lambdaFilename = 'lambdafunction/lambdafunction.py'
-    lambdaArcname = 'lambdafunction.py'
     lambdaZipFilename = f'lambda-{uuid.uuid4()}.zip'
 
-    # Pre-declare boto3 clients needed to update
-    cloudformation = boto3.client('cloudformation')
-    s3 = boto3.client('s3')
-    lambdaClient = boto3.client('lambda')
-    
+    # boto3 clients are not safe to create across threads,
+    # so each stack gets its own session.
+    session = boto3.session.Session()
+    cloudformation = session.client('cloudformation')
+    s3 = session.client('s3')
+    lambdaClient = session.client('lambda')
+
     # Validate that the to-update stack does already exist. Describe the stack
     # using boto3 and expect it to throw a ClientError with code "ValidationError".
+    step("validating")
     try:
         res = cloudformation.describe_stacks(StackName=stackName)
     except ClientError as e:
         if e.response['Error']['Code'] != 'ValidationError':
-            sys.exit(f"Error: unexpected error describing stack {e}")
-        sys.exit(f"Error: stack {stackName} does not exists")
+            raise StackError(f"unexpected error describing stack {e}")
+        raise StackError(f"stack {stackName} does not exists")
 
     # Get S3 bucket for stack
-    bucketName = next(_ for _ in res['Stacks'][0]['Parameters'] if _['ParameterKey'] == 'bucketName')['ParameterValue']
-    lambdaZipFileNameOld = next(_ for _ in res['Stacks'][0]['Parameters'] if _['ParameterKey'] == 'zipfileName')['ParameterValue']
+    stackParameters = {_['ParameterKey']: _['ParameterValue'] for _ in res['Stacks'][0]['Parameters']}
+    bucketName = stackParameters['bucketName']
+    lambdaZipFileNameOld = stackParameters['zipfileName']
     lambdaArn = next(_ for _ in res['Stacks'][0]['Outputs'] if _['OutputKey'] == 'lambdaArn')['OutputValue']
 
-    # Validate each template exists, is readable, and is valid
-    if not os.access(templateFilename, os.R_OK):
-        sys.exit(f"Error: could not read template file {templateFilename}")
+    lambdaHash = base64.b64encode(hashlib.sha256(lambdaZip).digest()).decode()
 
-    # We pass the template body as a string to multiple future functions, so we read it in here.
-    with open(templateFilename) as f:
-        templateBody = f.read()
-    with open(lambdaFilename) as f:
-        lambdaBody = f.read()
+    # Validate the template and look up the hashes of the deployed
+    # artifacts concurrently. If validation doesn't raise an
+    # exception, it means the template is valid.
+    with ThreadPoolExecutor() as executor:
+        validation = executor.submit(cloudformation.validate_template, TemplateBody=templateBody)
+        deployedLambda = executor.submit(lambdaClient.get_function_configuration, FunctionName=lambdaArn)
+        deployedTemplate = executor.submit(cloudformation.get_template, StackName=stackName)
 
-    # Validate the template itself via CloudFormation. If we don't
-    # get an exception here, it means the tamplate is valid.
-    try:
-        cloudformation.validate_template(TemplateBody=templateBody)
-    except ClientError as e:
-        sys.exit(f"Error: {e.response['Error']['Message']}")
-
-    # Download existing lambda function python code
-    res = lambdaClient.get_function(FunctionName=lambdaArn)
-    lambdaUrl = res['Code']['Location']
-    lambdaContents = io.BytesIO(request.urlopen(lambdaUrl).read())
-
-    with ZipFile(lambdaContents) as archive:
-        lambdaText = archive.read(lambdaArcname)
-    lambdaUpdate = lambdaText.decode('utf-8') != lambdaBody
-        
-    if lambdaUpdate:
-        # Zip the python file of the lambda function into an in-memory zipfile
-        zipBuffer = io.BytesIO()
-        with ZipFile(zipBuffer, mode='a') as archive: archive.write(lambdaFilename, arcname=lambdaArcname)
-    else:
-        lambdaZipFilename = lambdaZipFileNameOld
+        try:
+            templateParameters = {_['ParameterKey'] for _ in validation.result()['Parameters']}
+        except ClientError as e:
+            raise StackError(e.response['Error']['Message'])
 
+        lambdaUpdate = deployedLambda.result()['CodeSha256'] != lambdaHash
+        templateUpdate = deployedTemplate.result()['TemplateBody'] != templateBody
+        layerUpdate = numpyLayer is not None and numpyLayer != stackParameters.get('numpyLayer', '')
 
-    # Upload all the CloudFormation templates to the AWS S3 bucket
+    if not lambdaUpdate and not templateUpdate and not layerUpdate:
+        return None
+
+    if not lambdaUpdate:
+        lambdaZipFilename = lambdaZipFileNameOld
+
+    # Upload the changed artifacts to the AWS S3 bucket
+    step("uploading")
     try:
-        s3.put_object(Bucket=bucketName, Body=templateBody, Key=templateFilename)
-        if lambdaUpdate:
-            s3.put_object(Bucket=bucketName, Body=zipBuffer.getvalue(), Key=lambdaZipFilename)
-            s3.delete_object(Bucket=bucketName, Key=lambdaZipFileNameOld)
+        with ThreadPoolExecutor() as executor:
+            uploads = []
+            if templateUpdate:
+                uploads.append(executor.submit(s3.put_object, Bucket=bucketName, Body=templateBody, Key=templateFilename))
+            if lambdaUpdate:
+                uploads.append(executor.submit(s3.put_object, Bucket=bucketName, Body=lambdaZip, Key=lambdaZipFilename))
+            for _ in uploads: _.result()
     except ClientError as e:
         # TODO: clean up AWS S3 bucket
-        sys.exit(f"Error: unexpected error uploading templates {e}")  # TODO: may leak S3 bucket
-
+        raise StackError(f"unexpected error uploading templates {e}")  # TODO: may leak S3 bucket
 
     # Create change set
+    step("creating change set")
     templateURL = f'https://s3.amazonaws.com/{bucketName}/{templateFilename}'
     parameters = [
         {'ParameterKey': 'bucketName',  'ParameterValue': bucketName},
         {'ParameterKey': 'zipfileName', 'ParameterValue': lambdaZipFilename},
     ]
+    if numpyLayer is not None:
+        parameters.append({'ParameterKey': 'numpyLayer', 'ParameterValue': numpyLayer})
+
+    # Any other parameters the stack was given keep their values
+    given = {_['ParameterKey'] for _ in parameters}
+    for key in sorted((stackParameters.keys() & templateParameters) - given):
+        parameters.append({'ParameterKey': key, 'UsePreviousValue': True})
+    # The uploaded template may be from a cancelled update, so it's
+    # only used when the template has changed
+    template = {'TemplateURL': templateURL} if templateUpdate else {'UsePreviousTemplate': True}
     cloudformation.create_change_set(
             StackName=stackName,
             ChangeSetName='update',
-            TemplateURL=templateURL,
             Capabilities=['CAPABILITY_NAMED_IAM'],
-            Parameters=parameters)
+            Parameters=parameters,
+            **template)
 
     # Wait for change set to be fully defined
     waiter = cloudformation.get_waiter('change_set_create_complete')
@@ -220,85 +330,88 @@ def command_stackUpdate(args):
     res = cloudformation.describe_change_set(
             StackName=stackName,
             ChangeSetName='update')
+    return {
+        'changes': res['Changes'],
+        'bucketName': bucketName,
+        'newZipfile': lambdaZipFilename if lambdaUpdate else None,
+        'oldZipfile': lambdaZipFileNameOld if lambdaUpdate else None,
+    }
 
-    # Get confirmation
-    changes = res['Changes']
-    print(f"Updating stack {stackName} with the following changes:")
-    for c in changes:
-        print(f"\t{c['ResourceChange']['Action']:<40}  {c['ResourceChange']['ResourceType']:<25}")
 
-    res = input("Continue? [y/N] ")
-    if res != 'y':
-        cloudformation.delete_change_set(
-            StackName=stackName,
-            ChangeSetName='update')
-        sys.exit("Cancelling update")
+def helper_executeUpdate(stackName, changeSet, step):
+    """
+    Executes a stack's "update" change set and waits for the update
+    to complete. The lambda zipfile the update replaced is deleted
+    only after it succeeds, as a rolled back stack still uses it.
+    Runs on a worker thread of helper_runStacks.
+
+    Params:
+        stackName = the name of the CloudFormation stack
+        changeSet = the stack's change set from helper_prepareUpdate
+        step = a function that reports the current step
+    """
+    session = boto3.session.Session()
+    cloudformation = session.client('cloudformation')
 
-    # Execute the change set
-    res = cloudformation.execute_change_set(
+    step("executing change set")
+    cloudformation.execute_change_set(
             StackName=stackName,
             ChangeSetName='update')
 
-    waiter = cloudformation.get_waiter('stack_update_complete')
-    waiter.wait(StackName=stackName)
-
-
-
+    step("waiting for stack")
+    try:
+        waiter = cloudformation.get_waiter('stack_update_complete')
+        waiter.wait(StackName=stackName)
+    except WaiterError as e:
+        raise StackError(f"unexpected error updating {e}")
 
+    if changeSet['oldZipfile']:
+        step("deleting old zipfile")
+        session.client('s3').delete_object(Bucket=changeSet['bucketName'], Key=changeSet['oldZipfile'])
 
-    
 
 def command_stackDelete(args):
     """
-    Deletes a CloudFormation stack.
+    Deletes CloudFormation stacks.
 
-    If the stack with the given name exists, this
-    command function will ask for confirmation, then
-    delete the stack.
+    If the stacks with the given names exist, this command
+    function will list their resources, ask for confirmation
+    once, then delete the stacks and their API keys concurrently.
 
     Params:
-       stackName = the name of the stack to delete
-
+       args.name = the name of the stack to delete
+       args.names = a comma separated list of stacks, if given
+       args.all = delete every tide gauge stack
     """
-    stackName = args.name
-
-    cloudformation = boto3.client('cloudformation')
-    apigateway = boto3.client('apigateway')
-
-    # Validate that the to-deploy stack does indeed exist.
-    # Describe the stack using boto3 and expect it to not
-    # throw any exceptions.
-    try:
-        res = cloudformation.describe_stacks(StackName=stackName)
-    except ClientError as e:
-        if e.response['Error']['Code'] == 'ValidationError':
-            sys.exit(f"Error: stack {stackName} does not exist")
-        else:
-            sys.exit(f"Error: unexpected error describing stack {e}")
-
-    # Get a list of stack resources that will be deleted
-    res = helper_stackResources(stackName)
-    if res is None: sys.exit()
+    stackNames = helper_stackNames(args)
+
+    # Get a list of stack resources that will be deleted. This
+    # also validates that the to-delete stacks do indeed exist.
+    with ThreadPoolExecutor(max_workers=len(stackNames)) as executor:
+        futures = {_: executor.submit(helper_stackResources, _) for _ in stackNames}
+    resources, errors = {}, []
+    for stackName, future in futures.items():
+        try:
+            resources[stackName] = future.result()
+        except StackError as e:
+            errors.append(str(e))
+    if errors: sys.exit("Error: " + "\nError: ".join(errors))
 
     # TODO: recursively print out substack resources
 
     # Print them out and get confirmation
-    print(f"Deleting stack {stackName} with the following resources:")
-    for resource in res:
-        print(f"\t{resource[0]:<40}  {resource[1]:<25}")
+    for stackName in stackNames:
+        print(f"Deleting stack {stackName} with the following resources:")
+        for resource in resources[stackName]:
+            print(f"\t{resource[0]:<40}  {resource[1]:<25}")
 
     res = input("Continue? [y/N] ")
     if res != 'y':
         sys.exit("Cancelling delete")
 
     # Do the delete
-    helper_deleteStack(stackName)
-
-    # TODO: delete API keys
-    res = apigateway.get_api_keys(nameQuery=args.name)
-    for key in res['items']:
-        keyId = key['id']
-        res = apigateway.delete_api_key(apiKey=keyId)
+    results = helper_runStacks(stackNames, helper_deleteStackAndKeys)
+    if len(results) < len(stackNames): sys.exit("Error: not all stacks were deleted")
 
     # Clean up deploy by deleting S3 bucket
     # TODO: move this to "delete"
@@ -317,6 +430,222 @@ def command_stackDelete(args):
 
     print("Delete complete")
 
+
+def helper_deleteStackAndKeys(stackName, step):
+    """
+    Deletes a stack and the API keys of its usage plan. The keys are
+    looked up through the usage plan (named after the stack) before
+    it is deleted, rather than by name prefix, which would also match
+    the keys of other stacks whose names start with this one. Runs
+    on a worker thread of helper_runStacks.
+    """
+    apigateway = boto3.session.Session().client('apigateway')
+
+    step("finding API keys")
+    keyIds = []
+    for page in apigateway.get_paginator('get_usage_plans').paginate():
+        for plan in page['items']:
+            if plan['name'] != stackName: continue
+            for keys in apigateway.get_paginator('get_usage_plan_keys').paginate(usagePlanId=plan['id']):
+                keyIds.extend(_['id'] for _ in keys['items'])
+
+    step("deleting stack")
+    helper_deleteStack(stackName)
+
+    # API Gateway throttles key deletes, so only a few run at once
+    step("deleting API keys")
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        for _ in executor.map(lambda _: apigateway.delete_api_key(apiKey=_), keyIds): pass
+
+
+def helper_stackNames(args):
+    """
+    Gets the names of the stacks a command applies to: the
+    "--names" list, every tide gauge stack for "--all", or
+    else the single "--name".
+    """
+    if getattr(args, 'all', False):
+        stackNames = helper_listStacks()
+        if not stackNames: sys.exit("Error: no stacks found")
+        return stackNames
+    if getattr(args, 'names', None) is not None:
+        stackNames = list(dict.fromkeys(_.strip() for _ in args.names.split(',') if _.strip()))
+        if not stackNames: sys.exit("Error: --names lists no stacks")
+        return stackNames
+    return [args.name]
+
+
+def helper_listStacks():
+    """
+    Lists the deployed tide gauge stacks, which are the stacks
+    that take the "bucketName" & "zipfileName" parameters.
+
+    Returns: a sorted list of stack names
+    """
+    cloudformation = boto3.client('cloudformation')
+    stackNames = []
+    for page in cloudformation.get_paginator('describe_stacks').paginate():
+        for stack in page['Stacks']:
+            parameters = {_['ParameterKey'] for _ in stack.get('Parameters', [])}
+            if {'bucketName', 'zipfileName'} <= parameters and stack['StackStatus'] != 'DELETE_COMPLETE':
+                stackNames.append(stack['StackName'])
+    return sorted(stackNames)
+
+
+def helper_readTemplate():
+    """
+    Reads the CloudFormation template.
+
+    Returns: the template body as a string
+    """
+    templateFilename = 'templates/template.yaml'
+
+    # Validate the template exists & is readable
+    if not os.access(templateFilename, os.R_OK):
+        sys.exit(f"Error: could not read template file {templateFilename}")
+
+    with open(templateFilename) as f:
+        return f.read()
+
+
+class StackError(Exception):
+    """
+    An error that stops the work on a single stack.
+    """
+
+
+def helper_runStacks(stackNames, func):
+    """
+    Runs a function for each stack concurrently on a thread pool,
+    showing the progress of every stack and then a summary of how
+    long each took. A failing stack doesn't stop the others.
+
+    Params:
+        stackNames = the names of the stacks
+        func = called as func(stackName, step), where step is a
+               function the stack calls with the name of each
+               step as it starts, for the progress view & timings
+
+    Returns: a dict of stack name to result for the stacks
+             that succeeded
+    """
+    progress = StackProgress(stackNames)
+    results = {}
+    with progress, ThreadPoolExecutor(max_workers=len(stackNames)) as executor:
+        futures = {executor.submit(func, _, progress.stepper(_)): _ for _ in stackNames}
+        for future in as_completed(futures):
+            stackName = futures[future]
+            try:
+                results[stackName] = future.result()
+                progress.finish(stackName, "done")
+            except (StackError, ClientError, WaiterError) as e:
+                progress.finish(stackName, f"failed: {e}")
+
+    progress.summary()
+    return results
+
+
+class StackProgress:
+    """
+    Tracks the current step of each stack & how long each step took.
+
+    On a terminal, a line per stack is redrawn in place a few times
+    a second. Otherwise each step is printed as it starts, so logs
+    stay readable.
+    """
+
+    def __init__(self, stackNames):
+        self.stackNames = list(stackNames)
+        self.width = max(map(len, self.stackNames))
+        self.steps = {_: [] for _ in self.stackNames}    # [(step, start time)]
+        self.status = {_: "waiting" for _ in self.stackNames}
+        self.finished = {}
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+        self.live = sys.stdout.isatty()
+        self.stopped = threading.Event()
+        self.drawn = 0
+
+    def __enter__(self):
+        if self.live:
+            self.thread = threading.Thread(target=self.redraw, daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.live:
+            self.stopped.set()
+            self.thread.join()
+            self.draw()
+
+    def stepper(self, stackName):
+        def step(name):
+            with self.lock:
+                self.steps[stackName].append((name, time.monotonic()))
+                self.status[stackName] = name
+            if not self.live: print(f"[{stackName}] {name}", flush=True)
+        return step
+
+    def finish(self, stackName, status):
+        with self.lock:
+            self.finished[stackName] = time.monotonic()
+            self.status[stackName] = status
+        if not self.live: print(f"[{stackName}] {status}", flush=True)
+
+    def redraw(self):
+        while not self.stopped.wait(0.2):
+            self.draw()
+
+    def draw(self):
+        now = time.monotonic()
+        with self.lock:
+            lines = [
+                f"{_:<{self.width}}  {self.finished.get(_, now) - self.start:7.1f}s  {self.status[_]}"
+                for _ in self.stackNames
+            ]
+        # Move back up over the previous drawing & clear each line
+        out = f"\x1b[{self.drawn}F" if self.drawn else ''
+        out += ''.join(f"\x1b[2K{_}\n" for _ in lines)
+        sys.stdout.write(out)
+        sys.stdout.flush()
+        self.drawn = len(lines)
+
+    def summary(self):
+        """
+        Prints the time each stack spent in each of its steps.
+        """
+        print()
+        for stackName in self.stackNames:
+            steps = self.steps[stackName]
+            end = self.finished.get(stackName, time.monotonic())
+            ends = [_[1] for _ in steps[1:]] + [end]
+            timings = ', '.join(f"{name} {stop - start:.1f}s" for (name, start), stop in zip(steps, ends))
+            print(f"{stackName:<{self.width}}  {end - self.start:7.1f}s  {self.status[stackName]}")
+            if timings: print(f"{'':<{self.width}}            {timings}")
+        print(f"Total: {time.monotonic() - self.start:.1f}s")
+
+
+def helper_lambdaZip():
+    """
+    Zips the lambda function code into an in-memory zipfile.
+
+    The zipfile is built deterministically: files are added in a
+    fixed order with fixed timestamps & permissions, so the same
+    code always produces the same bytes (and hash).
+
+    Returns: the contents of the zipfile as bytes
+    """
+    zipBuffer = io.BytesIO()
+    with ZipFile(zipBuffer, mode='w') as archive:
+        for arcname in sorted(LAMBDA_FILES):
+            info = ZipInfo(arcname, date_time=(1980, 1, 1, 0, 0, 0))
+            info.compress_type = ZIP_DEFLATED
+            info.external_attr = 0o644 << 16
+            with open(LAMBDA_FILES[arcname], 'rb') as f:
+                archive.writestr(info, f.read())
+    return zipBuffer.getvalue()
+
+
 # A helper function that retrieves a list of stack resources
 #
 # Params:
@@ -326,8 +655,11 @@ def command_stackDelete(args):
 #          represents an individual resource. The tuples
 #          are of the form (ResourceType, ResourceName)
 #
+# Raises: StackError if the stack can't be described. Errors are
+#         raised rather than printed as this runs on worker threads.
+#
 def helper_stackResources(stackName):
-    client = boto3.client('cloudformation')
+    client = boto3.session.Session().client('cloudformation')
 
     # Describe the stack resources using boto3 and parse the response.
     # Boto3 throws exceptions in certain cases, including when
@@ -335,8 +667,7 @@ def helper_stackResources(stackName):
     try:
         res = client.describe_stack_resources(StackName=stackName)
     except ClientError as e:
-        print(f"Error: unexpected error: {e}")
-        return None
+        raise StackError(f"could not describe stack {stackName}: {e}")
 
     info = []
     for resource in res['StackResources']:
@@ -344,21 +675,21 @@ def helper_stackResources(stackName):
 
     return info
 
+# Deletes a stack and waits for the delete to complete.
 #
-#
-#
+# Raises: StackError if the delete can't be started, or a
+#         WaiterError if the delete fails. Errors are raised
+#         rather than printed as this runs on worker threads.
 #
 def helper_deleteStack(stackName):
-    client = boto3.client('cloudformation')
+    client = boto3.session.Session().client('cloudformation')
 
-    # Describe the stack resources using boto3 and parse the response.
     # Boto3 throws exceptions in certain cases, including when
     # a requested CloudFormation stack is not found.
     try:
-        res = client.delete_stack(StackName=stackName)
+        client.delete_stack(StackName=stackName)
     except ClientError as e:
-        print(f"Error: unexpected error: {e}")
-        return None
+        raise StackError(f"could not delete stack {stackName}: {e}")
 
     # Wait for stack deletion to complete
     waiter = client.get_waiter('stack_delete_complete')
@@ -0,0 +1,115 @@
+#  _______ _     _         _____
+# |__   __(_)   | |       / ____|
+#    | |   _  __| | ___  | |  __  __ _ _   _  __ _  ___
+#    | |  | |/ _` |/ _ \ | | |_ |/ _` | | | |/ _` |/ _ \
+#    | |  | | (_| |  __/ | |__| | (_| | |_| | (_| |  __/
+#    |_|  |_|\__,_|\___|  \_____|\__,_|\__,_|\__, |\___|
+#                                             __/ |
+#                                            |___/
+# Author: Bryce Kellogg (bryce@kellogg.org)
+# Copyright: 2023 Bryce Kellogg
+# License: GPLv3
+#
+# Models of the limits set by an API Gateway usage plan (see
+# RestUsagePlan in templates/template.yaml): a token bucket for the
+# rate & burst limits and a quota of requests per day. Clocks can be
+# passed in so the limits can be driven by a fake clock in tests.
+import time
+import threading
+
+
+class TokenBucket:
+    """
+    A token bucket that refills at a fixed rate up to a maximum.
+    Each request takes a token; a request is throttled if the
+    bucket is empty. This is how API Gateway applies RateLimit
+    (the refill rate) and BurstLimit (the bucket size).
+
+    Params:
+        rate = the number of tokens added per second
+        burst = the maximum number of tokens in the bucket
+        clock = a function returning the current time in seconds
+    """
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, n=1):
+        """
+        Takes n tokens if they are available.
+
+        Returns: True if the tokens were taken
+        """
+        with self.lock:
+            self.refill()
+            if self.tokens < n: return False
+            self.tokens -= n
+            return True
+
+    def delay(self, n=1):
+        """
+        Returns: the number of seconds until n tokens are available
+        """
+        with self.lock:
+            self.refill()
+            return max(0, (n - self.tokens) / self.rate)
+
+
+class DailyQuota:
+    """
+    A limit on the number of requests per UTC day, the
+    way API Gateway applies a usage plan's Quota.
+
+    Params:
+        limit = the number of requests allowed per day
+        clock = a function returning the current Unix time
+    """
+
+    def __init__(self, limit, clock=time.time):
+        self.limit = limit
+        self.clock = clock
+        self.day = None
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def reset(self):
+        day = int(self.clock() // 86400)
+        if day != self.day:
+            self.day = day
+            self.used = 0
+
+    def take(self, n=1):
+        """
+        Uses n requests of the quota if they are available.
+
+        Returns: True if the requests were allowed
+        """
+        with self.lock:
+            self.reset()
+            if self.used + n > self.limit: return False
+            self.used += n
+            return True
+
+    def remaining(self):
+        """
+        Returns: the number of requests left today
+        """
+        with self.lock:
+            self.reset()
+            return self.limit - self.used
+
+    def secondsLeft(self):
+        """
+        Returns: the number of seconds until the quota resets
+        """
+        return 86400 - self.clock() % 86400
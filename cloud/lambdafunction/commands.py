@@ -17,9 +17,11 @@
 # formatting command inputs and lambda function outputs.
 import sys
 import json
+import time
 from tabulate import tabulate
 from collections import OrderedDict
-from . import *
+from .lambdafunction import *
+from admin.output import helper_emit
 
 def command_dbData(args):
     """
@@ -48,6 +50,7 @@ def command_dbData(args):
        args.timestamp = the timestamp query string
        args.limit = the maximum number of items to return or delete
        args.data = the data to post
+       args.format = the output format of GET, one of {'table', 'ndjson', 'csv'}
     """
     stackName = args.name
     deviceName = args.device
@@ -62,14 +65,17 @@ def command_dbData(args):
         op = next(iter(op))
         timestamp = args.timestamp.replace(op, '')
 
-        # Perform query using lambda function
-        res = getData(stackName, deviceName, timestamp, op, limit)
-        if res['statusCode'] != 200: sys.exit("ERROR: query error {res}")
+        # Perform query using lambda function code, keeping
+        # only the keys of each page in case we delete them.
+        keyList = []
+        def pages():
+            for page in iterData(stackName, deviceName, timestamp, op, limit):
+                if args.delete: keyList.extend((_['devicename'], _['timestamp']) for _ in page)
+                yield page
 
-        # Display returned data
-        data = json.loads(res['body'])
-        if len(data) == 0: return # skip printing or deleting if there's no data
-        print(tabulate(data, headers='keys'))
+        # Display returned data as it arrives
+        numRecords = helper_emit(pages(), args.format)
+        if numRecords == 0: return # skip deleting if there's no data
 
     # Delete data after confirmation. Note that
     # we need to query data before deletion for
@@ -77,10 +83,6 @@ def command_dbData(args):
     if args.delete:
         res = input("\nDelete above data? [y/N] ")
         if res != 'y': sys.exit("Cancelling delete")
-        
-        # Format keys to delete based on data read using GET
-        keyList = []
-        for item in data: keyList.append((item['devicename'], item['timestamp']))
 
         # Perform the deletion using lambda function code
         res = deleteData(stackName, keyList)
@@ -106,11 +108,16 @@ def command_dbConfig(args):
     """
     Command handler for interacting with the config table.
 
-    Params:
-       args.name
-       args.device
-       args.data
+    Data Format: as for command_dbData. A key with an empty value
+                 ("key=") removes that attribute.
 
+    Params:
+       args.name = the name of the CloudFormation stack to operate on
+       args.device = the name of the device, or None for all devices
+       args.data = the attributes to post
+       args.version = only post if the config is at this version
+       args.since_version = only get the device's config if it changed
+                            after this version (needs args.device)
     """
     stackName = args.name
     deviceName = args.device
@@ -118,7 +125,7 @@ def command_dbConfig(args):
     #
     if args.get or args.delete:
 
-        res = getConfig(stackName, deviceName)
+        res = getConfig(stackName, deviceName, args.since_version)
         if res['statusCode'] != 200: sys.exit("ERROR: query error {res}")
 
         # We want the devicename to the left of the table
@@ -146,9 +153,62 @@ def command_dbConfig(args):
         attributes = {}
         for a in args.data.split(';'):
             k,v = a.split('=')
-            attributes[k] = v
+            attributes[k] = v or None
 
         # Insert data using lambda function code
-        res = postConfig(stackName, deviceName, attributes)
+        res = postConfig(stackName, deviceName, attributes, args.version)
+        if res['statusCode'] == 409: sys.exit(f"ERROR: config is no longer at version {args.version}")
+        if res['statusCode'] != 200: sys.exit("ERROR: query error {res}")
+        print(f"Config is now at version {json.loads(res['body'])['configversion']}")
+
+
+
+def command_dbCoverage(args):
+    """
+    Command handler for showing the gaps in a device's data, read
+    from the coverage table instead of the data itself.
+
+    Params:
+       args.name = the name of the CloudFormation stack to operate on
+       args.device = the name of the device
+       args.start = the first Unix timestamp (default: a week ago)
+       args.end = the last Unix timestamp, exclusive (default: now)
+    """
+    end = args.end or int(time.time())
+    start = args.start or end - 7*86400
+
+    res = getCoverage(args.name, args.device, start, end)
+    if res['statusCode'] != 200: sys.exit("ERROR: query error {res}")
+    coverage = json.loads(res['body'])
+
+    # Display the gaps with readable times
+    utc = lambda _: time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(_))
+    rows = [[utc(a), utc(b), b - a] for a, b in coverage['gaps']]
+    print(tabulate(rows, headers=['gap start (UTC)', 'gap end (UTC)', 'seconds']))
+    print(f"\n{coverage['covered']} of {coverage['expected']} polling slots "
+          f"have data ({coverage['completeness']}%), {len(rows)} gaps")
+
+
+def command_dbCalibration(args):
+    """
+    Command handler for managing a device's calibration versions,
+    which convert sensor distances to water levels.
+
+    Params:
+       args.name = the name of the CloudFormation stack to operate on
+       args.device = the name of the device
+       args.post = add a calibration version
+       args.effective_from = the Unix timestamp the version applies from
+       args.mount_height = the height of the sensor above the datum in mm
+       args.datum_offset = an offset in mm to move to another datum
+       args.temperature = the air temperature at the gauge in C
+    """
+    if args.post:
+        res = postCalibration(args.name, args.device, args.effective_from,
+                              args.mount_height, args.datum_offset, args.temperature)
         if res['statusCode'] != 200: sys.exit("ERROR: query error {res}")
 
+    # Always show the resulting versions
+    config = helper_deviceConfig(args.name, args.device)
+    versions = json.loads(config.get('calibration', '[]'))
+    print(tabulate(versions, headers='keys'))
@@ -12,11 +12,37 @@
 #
 #
 import os
+import io
+import re
 import json
+import math
 import time
+import queue
+import threading
+import heapq
+import bisect
+import base64
+import struct
+import itertools
+import uuid
+import random
+import tempfile
+import pstats
+import cProfile
+import contextlib
+import tracemalloc
 from pprint import pprint
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
+from botocore.exceptions import ClientError
+
+# NumPy isn't part of the lambda runtime, so it's only used
+# when it's available (e.g. locally or from a lambda layer).
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # We need the stack name to get a reference to the AWS
 # DynamoDB table. We are assuming that the table name is
@@ -24,11 +50,98 @@ import boto3
 # should have made the stack name available to the
 # lambda function as an environment variable.
 
+# The default length of the time slots used to pick the shard
+# of a record, in seconds (see helper_shardKey).
+DEFAULT_SHARD_PERIOD = 1
+
+# The length of the buckets of the time index, in seconds, and the
+# most buckets read in parallel for one page (see getWindow).
+HOUR_BUCKET_SECONDS = 3600
+TIME_INDEX_FANOUT = 8
+
+# How much more than its even share of a page each shard of a
+# device is asked for (see helper_scatterPage), to allow for
+# uneven runs of records between the shards.
+SHARD_LIMIT_SLACK = 1.25
+
+# Attributes used internally that are left out of responses
+HIDDEN_ATTRIBUTES = ['hourbucket', 'alertstate']
+
+# The alert rules evaluated on ingest (see helper_evaluateAlerts).
+# Each rule compares a statistic of an attribute to a threshold
+# from the device's config, or the default if it isn't set. Rules
+# with no threshold are skipped. Slopes are in units per hour.
+ALERT_RULES = [
+    # rule              attribute          stat     op   config key                default
+    ('low-battery',     'battery-percent', 'ewma',  '<', 'alertBatteryBelow',      '20'),
+    ('battery-drain',   'battery-percent', 'slope', '<', 'alertBatterySlopeBelow', None),
+    ('queue-backlog',   'queue-size',      'last',  '>', 'alertQueueAbove',        '50'),
+    ('queue-growing',   'queue-size',      'slope', '>', 'alertQueueSlopeAbove',   None),
+    ('flood',           'distance',        'last',  '<', 'alertDistanceBelow',     None),
+]
+
+# The defaults for the time constant of the EWMA & slope
+# and the shortest time between two alerts of a rule, in
+# seconds. Devices can override them in their config.
+DEFAULT_ALERT_SMOOTHING = 3600
+DEFAULT_ALERT_INTERVAL = 3600
+
+# The polling period assumed for devices without a
+# "sensorPollingPeriod" config, in ms (as in the firmware),
+# and the number of tries to merge a coverage bitmap.
+DEFAULT_POLLING_PERIOD = 30*1000
+COVERAGE_RETRIES = 5
+
+# The number of times BatchGetItem is retried for unprocessed keys,
+# and the delay before the first retry in seconds, which doubles
+# after each one (see helper_batchGet).
+BATCH_GET_RETRIES = 6
+BATCH_GET_BACKOFF = 0.05
+
+# The speed of sound in air at 0 C (m/s), used to correct sensor
+# distances for the air temperature, and the air temperature that
+# the sensor's distances assume unless a calibration says otherwise.
+SPEED_OF_SOUND_0C = 331.3
+DEFAULT_REFERENCE_TEMPERATURE = 20
+
+# Device configs & calibrations are cached for this long (in seconds,
+# env "ConfigTTL") so warm invocations can skip reading them again.
+DEFAULT_CONFIG_TTL = 300
+CONFIG_CACHE = {}
+
+# With the "IngestMode" env var set to "async", POST /data only
+# checks & queues the body (see acceptData). Bodies too large for
+# an SQS message are written right away instead. The consumer
+# writes up to INGEST_WRITERS devices in parallel.
+MAX_QUEUED_BODY = 256 * 1024
+INGEST_WRITERS = 8
+
 def process(event, context):
     """
-    The main handler for the lambda function. Extracts the needed data
-    from the HTTP event and calls one of the helper functions based on
-    the path and HTTP method. If there is no match, return an error.
+    The main handler for the lambda function. Decides whether this
+    invocation should be profiled and then hands the event off to
+    the router. Profiling is requested per-request via the
+    "X-Profile" header (value of "cpu", "memory", or "cpu,memory")
+    or sampled across requests via the "ProfileRate" environment
+    variable (a fraction between 0 and 1).
+    """
+    # Batches of queued ingest bodies come from SQS, not API Gateway
+    if 'Records' in event:
+        return consumeData(event['Records'])
+
+    modes = helper_profileModes(event)
+    if not modes:
+        return helper_route(event)
+
+    with helper_profile(modes, label=f"{event['httpMethod']} {event['path']}"):
+        return helper_route(event)
+
+
+def helper_route(event):
+    """
+    Extracts the needed data from the HTTP event and calls one of
+    the helper functions based on the path and HTTP method. If there
+    is no match, return an error.
     """
 
     # Extract request data
@@ -43,9 +156,23 @@ def process(event, context):
     # server error being returned.
     # body = json.loads(body)
 
+    # GET method on /data without a device name
+    # /data?from=10&to=12&limit=100
+    # /data?from=10&to=12&limit=100&cursor=<cursor>
+    if url == '/data' and method == 'GET' and 'name' not in (queryStringParams or {}):
+
+        stackName = os.environ['StackName']
+        start = int(queryStringParams['from'])
+        end = int(queryStringParams['to'])
+        limit = int(queryStringParams['limit'])
+        cursor = queryStringParams.get('cursor')
+        return getWindow(stackName, start, end, limit, cursor)
+
     # GET method on /data
     # /data?name=<id>&timestamp_eq=12&limit=100
     # /data?name=<id>&timestamp_lt=12&limit=100
+    # /data?name=<id>&timestamp_lt=12&limit=100&cursor=<cursor>
+    # /data?name=<id>&timestamp_gte=10&timestamp_lt=12&limit=100
     if url == '/data' and method == 'GET':
 
         stackName = os.environ['StackName']
@@ -54,21 +181,25 @@ def process(event, context):
         # delete them to make processing easier
         deviceName = queryStringParams['name']
         limit = int(queryStringParams['limit'])
+        cursor = queryStringParams.get('cursor')
         del queryStringParams['name']
         del queryStringParams['limit']
+        queryStringParams.pop('cursor', None)
 
-        # The only remaining supported query
-        # parameter is the 'timestamp_*' param.
-        timestampQuery = next(iter(queryStringParams))
-        timestamp = int(queryStringParams[timestampQuery])
+        # The only remaining supported query parameters are
+        # the 'timestamp_*' params, which become the operator
+        # used in the dynamodb query
+        try:
+            op, timestamp = helper_parseBounds(queryStringParams)
+        except ValueError as e:
+            return {'statusCode': 400, 'body': f'Bad Request: {e}'}
 
-        # We use this to convert from query string params to
-        # the operator used in the dynamodb query.
-        _, op = timestampQuery.split('_')
-        op = {'eq': '=', 'lt': '<', 'gt': '>', 'lte': '<=', 'gte': '>='}[op]
+        # A range with nothing in it can't be queried
+        if op == 'between' and timestamp[0] > timestamp[1]:
+            return {'statusCode': 200, 'headers': {}, 'body': '[]'}
 
         # Get the actual results from the helper function
-        return getData(stackName, deviceName, timestamp, op, limit)
+        return getData(stackName, deviceName, timestamp, op, limit, cursor)
 
     # POST method on /data
     #
@@ -80,23 +211,122 @@ def process(event, context):
     #
     #
     # }
+    #
+    # The data may instead be a base64 string of packed
+    # binary records (see helper_decodeRecords).
+    #
+    # Batches from several devices can be combined as
+    # {devices = [{name = '???', data = [...]}, ...]}
     if url == '/data' and method == 'POST':
 
+        if os.environ.get('IngestMode', 'sync') == 'async' and len(body or '') <= MAX_QUEUED_BODY:
+            return acceptData(body)
+
         body = json.loads(body)
         stackName = os.environ['StackName']
-        deviceName = body['name']
-        return postData(stackName, deviceName, body['data'])
+        res = {'statusCode': 200, 'body': 'OK'}
+        for device in body.get('devices', [body]):
+            deviceName = device['name']
+            dataList = device['data']
+            if isinstance(dataList, str): dataList = helper_decodeRecords(dataList)
+            res = postData(stackName, deviceName, dataList)
+            if res['statusCode'] != 200: return res
+        return res
+
+    # GET method on /data/latest
+    # /data/latest
+    # /data/latest?name=<id1>,<id2>
+    if url == '/data/latest' and method == 'GET':
+        stackName = os.environ['StackName']
+        deviceNames = (queryStringParams or {}).get('name')
+        deviceNames = deviceNames.split(',') if deviceNames else None
+        return getLatest(stackName, deviceNames)
+
+    # GET method on /coverage
+    # /coverage?name=<id>&from=10&to=12
+    if url == '/coverage' and method == 'GET':
+        stackName = os.environ['StackName']
+        deviceName = queryStringParams['name']
+        start = int(queryStringParams['from'])
+        end = int(queryStringParams['to'])
+        return getCoverage(stackName, deviceName, start, end)
 
     # GET method on /config
+    # /config
+    # /config?name=<id1>,<id2>
+    # /config?name=<id>&since_version=12
     if url == '/config' and method == 'GET':
-        pass
+        stackName = os.environ['StackName']
+        params = queryStringParams or {}
+        deviceNames = params['name'].split(',') if params.get('name') else None
+        sinceVersion = int(params['since_version']) if 'since_version' in params else None
+        return getConfig(stackName, deviceNames, sinceVersion)
+
+    # POST method on /config
+    #
+    # {
+    #   name = '???',
+    #   config = {key1 = value1, key2 = null},
+    #   version = 12,   (optional)
+    # }
+    if url == '/config' and method == 'POST':
+        body = json.loads(body)
+        stackName = os.environ['StackName']
+        return postConfig(stackName, body['name'], body['config'], body.get('version'))
 
     # If we make it here, something is wrong
     return {'statusCode': 400, 'body': 'Bad Request'}
 
 
-def getData(stackName, deviceName, timestamp, op, limit):
+def helper_parseBounds(params):
+    """
+    Converts the "timestamp_*" query string params of GET /data to
+    the operator & timestamp of a query. A single bound is used as
+    it is; a lower & an upper bound together form an inclusive
+    range, which may be empty (start after end).
+
+    Params:
+        params = a dict of "timestamp_<op>" params to their values
+
+    Returns: a tuple of (op, timestamp), where the timestamp is a
+             tuple of (start, end) if op is 'between'
+
+    Raises: ValueError if a param is unknown or not an integer, or
+            the bounds don't form a single bound or a range
+    """
+    ops = {'eq': '=', 'lt': '<', 'gt': '>', 'lte': '<=', 'gte': '>='}
+    bounds = {}
+    for k,v in params.items():
+        op = ops.get(k[len('timestamp_'):]) if k.startswith('timestamp_') else None
+        if op is None: raise ValueError(f"unknown param {k}")
+        try:
+            bounds[op] = int(v)
+        except ValueError:
+            raise ValueError(f"{k} must be an integer") from None
+
+    if len(bounds) == 1:
+        return next(iter(bounds.items()))
+
+    lower, upper = bounds.keys() & {'>', '>='}, bounds.keys() & {'<', '<='}
+    if len(bounds) != 2 or len(lower) != 1 or len(upper) != 1:
+        raise ValueError("expected one timestamp bound, or a lower & an upper bound")
+    start = bounds['>='] if '>=' in bounds else bounds['>'] + 1
+    end = bounds['<='] if '<=' in bounds else bounds['<'] - 1
+    return 'between', (start, end)
+
+
+def getData(stackName, deviceName, timestamp, op, limit, cursor=None):
     """
+    Gets a single page of data for a device.
+
+    If the device's data is sharded, every shard is queried in
+    parallel and the results are merged (see helper_scatterPage).
+    Records with a distance get a "water-level" from the device's
+    calibration (see helper_calibrate).
+
+    If there is more data matching the query, the response includes
+    an "X-Next-Cursor" header. Passing its value back as the cursor
+    continues the query where this page stopped.
 
     Params:
        stackName = The name of the CloudFormation stack
@@ -106,47 +336,283 @@ def getData(stackName, deviceName, timestamp, op, limit):
                    in the format of the number of seconds since
                    00:00:00 UTC on 1 January 1970 (Unix Time)
        op = The operation to apply to the timestamp. This can be one
-            of ('=', '<', '>', '<=', '>=').
+            of ('=', '<', '>', '<=', '>=', 'between'). For 'between',
+            the timestamp is an inclusive (start, end) tuple.
        limit = the number of records to be returned. Note that less than
                the limit may be returned.
+       cursor = the cursor returned with the previous page, if any
 
-    Returns: ???
+    Returns: a response whose body is a JSON list of records
     """
 
     # TODO: Validate Inputs
 
+    partitions = helper_partitions(stackName, deviceName)
+    data, cursor = helper_scatterPage(stackName, partitions, timestamp, op, limit, cursor)
+    helper_calibrate(data, helper_cachedConfig(stackName, deviceName)['calibration'])
+
+    headers = {'X-Next-Cursor': cursor} if cursor else {}
+    return {'statusCode': 200, 'headers': headers, 'body': json.dumps(data)}
+
+
+def iterData(stackName, deviceName, timestamp, op, limit=None, pageSize=None):
+    """
+    Gets data for a device one page at a time. Pages are yielded as
+    they are read from the database so callers can process large
+    queries without holding all of the data in memory.
+
+    Params:
+       stackName, deviceName, timestamp, op = as for getData
+       limit = the maximum total number of records, or None for all
+       pageSize = the maximum number of records per page, or None
+                  to let DynamoDB decide (up to 1 MB per page)
+
+    Yields: lists of records
+    """
+    cursor = None
+    partitions = helper_partitions(stackName, deviceName)
+    calibration = helper_cachedConfig(stackName, deviceName)['calibration']
+    while limit is None or limit > 0:
+        sizes = [_ for _ in [limit, pageSize] if _]
+        pageLimit = min(sizes) if sizes else None
+        data, cursor = helper_scatterPage(stackName, partitions, timestamp, op, pageLimit, cursor)
+        helper_calibrate(data, calibration)
+        if data: yield data
+        if limit is not None: limit -= len(data)
+        if cursor is None: break
+
+
+def helper_scatterPage(stackName, partitions, timestamp, op, limit, cursor):
+    """
+    Makes one query to each of a device's partitions in parallel
+    and merges the results into a single page.
+
+    Each partition returns its records in timestamp order, so a k-way
+    merge keeps the page in order. A partition that has more data
+    bounds the page: records past its last timestamp may still be
+    waiting in it, so the page stops there. The cursor is a timestamp
+    and so continues every partition from the same place.
+
+    Shards take turns by time slot, so each holds about an even share
+    of a run of records and is only asked for that share of the page
+    (plus SHARD_LIMIT_SLACK). The plain device name holds the records
+    from before sharding, which don't overlap the shards' in time, so
+    it is asked for the whole limit. When the shards are uneven a page
+    comes up a little short, rather than every shard being read for
+    the whole limit.
+
+    Params:
+       partitions = the data table partition keys of the device
+       timestamp, op, limit, cursor = as for getData
+
+    Returns: a tuple of (records, cursor) as for helper_queryPage
+    """
+    # The first partition is the plain device name (see helper_partitions)
+    # and records from the shards are labelled with it
+    if len(partitions) == 1:
+        return helper_queryPage(stackName, partitions[0], timestamp, op, limit, cursor)
+
+    client = boto3.client('dynamodb')
+    shardLimit = math.ceil(limit * SHARD_LIMIT_SLACK / (len(partitions) - 1)) if limit else limit
+    limits = [limit] + [shardLimit] * (len(partitions) - 1)
+    query = lambda _, limit: helper_queryPage(stackName, _, timestamp, op, limit, cursor, client)
+    with ThreadPoolExecutor(max_workers=len(partitions)) as executor:
+        results = list(executor.map(query, partitions, limits))
+
+    # Descending queries come back newest first
+    reverse = op not in ['>', '>=', 'between']
+    bounds = [page[-1]['timestamp'] for page, more in results if more]
+    bound = (max if reverse else min)(bounds) if bounds else None
+    pastBound = lambda t: bound is not None and (t < bound if reverse else t > bound)
+
+    data = []
+    truncated = bound is not None
+    for item in heapq.merge(*(page for page, _ in results), key=lambda _: _['timestamp'], reverse=reverse):
+        if pastBound(item['timestamp']) or (limit and len(data) == limit):
+            truncated = True
+            break
+        item['devicename'] = partitions[0]
+        data.append(item)
+
+    return data, str(data[-1]['timestamp']) if truncated and data else None
+
+
+def helper_queryPage(stackName, partition, timestamp, op, limit, cursor, client=None):
+    """
+    Makes one query to a single partition of the data table.
+
+    Params:
+       partition = the partition key, which is the device name
+                   or one of its shards (see helper_shardKey)
+       client = the DynamoDB client to use, if shared
+
+    Returns: a tuple of (records, cursor) where the cursor is the
+             timestamp to continue from, or None on the last page
+    """
+    params = {}
+    if limit: params['Limit'] = limit
+    if cursor:
+        params['ExclusiveStartKey'] = {'devicename': {'S': partition}, 'timestamp': {'N': str(cursor)}}
+
+    values = {':devicename': {'S': partition}}
+    if op == 'between':
+        condition = '#timestamp BETWEEN :timestamp AND :timestampEnd'
+        values[':timestamp'] = {'N': str(timestamp[0])}
+        values[':timestampEnd'] = {'N': str(timestamp[1])}
+    else:
+        condition = f'#timestamp {op} :timestamp'
+        values[':timestamp'] = {'N': str(timestamp)}
+
     # Make query to database table
-    res = boto3.client('dynamodb').query(
+    res = (client or boto3.client('dynamodb')).query(
             TableName=f'{stackName}-data-table',
-            Limit=limit,
-            ScanIndexForward=op in ['>', '>='],
-            KeyConditionExpression=f'#devicename = :devicename AND #timestamp {op} :timestamp',
+            ScanIndexForward=op in ['>', '>=', 'between'],
+            KeyConditionExpression=f'#devicename = :devicename AND {condition}',
             ExpressionAttributeNames={
                 '#timestamp': 'timestamp',
                 '#devicename': 'devicename'
             },
+            ExpressionAttributeValues=values,
+            **params,
+        )
+
+    # Format data for response
+    data = [helper_formatItem(_) for _ in res['Items']]
+
+    lastKey = res.get('LastEvaluatedKey')
+    return data, lastKey['timestamp']['N'] if lastKey else None
+
+
+def getWindow(stackName, start, end, limit, cursor=None):
+    """
+    Gets a single page of data from every device in a time window.
+
+    Records are read from the TimeIndex of the data table, which is
+    partitioned by UTC hour, so the cost is proportional to the size
+    of the window instead of the number of devices. The hours of the
+    window are read in order, and only while the page has room, so no
+    record is read twice across pages. To keep sparse windows fast,
+    the next few hours are queried in parallel when the hours read so
+    far suggest they will all fit in the page. Records are in
+    timestamp order; records of different devices with the same
+    timestamp are in no particular order.
+
+    If there is more data in the window, the response includes an
+    "X-Next-Cursor" header, which is opaque and should be passed back
+    as the cursor to continue.
+
+    Params:
+       stackName = the name of the CloudFormation stack
+       start = the first Unix timestamp of the window (inclusive)
+       end = the last Unix timestamp of the window (exclusive)
+       limit = the maximum number of records to be returned
+       cursor = the cursor returned with the previous page, if any
+
+    Returns: a response whose body is a JSON list of records
+    """
+    buckets = range(start // HOUR_BUCKET_SECONDS, (end - 1) // HOUR_BUCKET_SECONDS + 1)
+    bucket, startKey = helper_decodeCursor(cursor) if cursor else (buckets.start, None)
+
+    client = boto3.client('dynamodb')
+    items, nextCursor, fanout = [], None, 1
+    numFull, numFullItems = 0, 0
+    with ThreadPoolExecutor(max_workers=TIME_INDEX_FANOUT) as executor:
+        while bucket < buckets.stop and nextCursor is None:
+            room = limit - len(items)
+            todo = list(range(bucket, min(bucket + fanout, buckets.stop)))
+            startKeys = [startKey] + [None] * (len(todo) - 1)
+            query = lambda b, k: helper_queryBucket(client, stackName, b, start, end, room, k)
+            results = list(executor.map(query, todo, startKeys))
+
+            # Fill the page from the earliest hour on. The page ends at
+            # the first hour that has more records than were read (or fit).
+            for b, k, (bucketItems, lastKey) in zip(todo, startKeys, results):
+                room = limit - len(items)
+                if room < len(bucketItems):
+                    bucketItems = bucketItems[:room]
+                    lastKey = helper_indexKey(bucketItems[-1]) if bucketItems else k
+                items.extend(bucketItems)
+                if lastKey is not None:
+                    nextCursor = helper_encodeCursor(b, lastKey)
+                    break
+                if k is None:
+                    numFull, numFullItems = numFull + 1, numFullItems + len(bucketItems)
+                if len(items) == limit:
+                    if b + 1 < buckets.stop: nextCursor = helper_encodeCursor(b + 1, None)
+                    break
+
+            # Query as many hours next as should fill the rest of the
+            # page at the rate of records per hour read so far
+            bucket, startKey = todo[-1] + 1, None
+            if numFull:
+                perBucket = numFullItems / numFull
+                wanted = -(-(limit - len(items)) // perBucket) if perBucket else TIME_INDEX_FANOUT
+                fanout = int(min(max(wanted, 1), TIME_INDEX_FANOUT))
+
+    data = [helper_formatItem(_) for _ in items]
+    devices = {_: helper_partitionDevice(stackName, _) for _ in {_['devicename'] for _ in data}}
+    for item in data:
+        item['devicename'] = devices[item['devicename']]
+    for deviceName in set(devices.values()):
+        records = [_ for _ in data if _['devicename'] == deviceName]
+        helper_calibrate(records, helper_cachedConfig(stackName, deviceName)['calibration'])
+
+    headers = {'X-Next-Cursor': nextCursor} if nextCursor else {}
+    return {'statusCode': 200, 'headers': headers, 'body': json.dumps(data)}
+
+
+def helper_queryBucket(client, stackName, bucket, start, end, limit, startKey):
+    """
+    Makes one query to a single hour of the time index.
+
+    Returns: a tuple of (raw items, last evaluated key or None)
+    """
+    params = {'ExclusiveStartKey': startKey} if startKey else {}
+    res = client.query(
+            TableName=f'{stackName}-data-table',
+            IndexName='TimeIndex',
+            Limit=limit,
+            KeyConditionExpression='#hourbucket = :hourbucket AND #timestamp BETWEEN :start AND :end',
+            ExpressionAttributeNames={
+                '#hourbucket': 'hourbucket',
+                '#timestamp': 'timestamp',
+            },
             ExpressionAttributeValues={
-                ':devicename': {'S': deviceName},
-                ':timestamp':  {'N': str(timestamp)},
+                ':hourbucket': {'N': str(bucket)},
+                ':start': {'N': str(start)},
+                ':end': {'N': str(end - 1)},
             },
+            **params,
         )
+    return res['Items'], res.get('LastEvaluatedKey')
 
-    # Format data for response
-    data = []
-    for attributes in res['Items']:
-        # The two keys are always returned
-        deviceName = str(attributes.pop('devicename')['S'])
-        timestamp  = int(attributes.pop('timestamp')['N'])
-        item = {'devicename': deviceName, 'timestamp': timestamp}
-
-        # All other attributes are retreived, all as strings
-        for k,v in attributes.items(): item[k] = v['S']
-        data.append(item)
 
-    return {'statusCode': 200, 'body': json.dumps(data)}
+def helper_indexKey(item):
+    """
+    Returns: the time index key of a raw data item, which is
+             what DynamoDB uses as the position in the index
+    """
+    return {k: item[k] for k in ['hourbucket', 'timestamp', 'devicename']}
+
+
+def helper_encodeCursor(bucket, key):
+    """
+    Encodes a position in the time index as an opaque, URL safe cursor.
+    """
+    return base64.urlsafe_b64encode(json.dumps([bucket, key]).encode('utf-8')).decode('ascii')
+
+
+def helper_decodeCursor(cursor):
+    """
+    Decodes a cursor made by helper_encodeCursor.
+
+    Returns: a tuple of (bucket, key)
+    """
+    bucket, key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    return int(bucket), key
 
 
-def postData(stackName, deviceName, dataList):
+def postData(stackName, deviceName, dataList, session=boto3):
     """
     A helper function that saves sensor data to the AWS database.
     The param "body" is expected to be a string of JSON of the form
@@ -157,108 +623,1357 @@ def postData(stackName, deviceName, dataList):
     object are written to the AWS DynamoDB database each element in
     each metric becomes a single database record.
 
+    An attribute value may be a list of samples taken at the same
+    timestamp, in which case it is reduced to summary statistics
+    (see helper_reduceSamples) before being written.
+
+    If the device's config has "shards" above one, each record is
+    written to the shard for its time slot (see helper_shardKey) to
+    spread the writes of fast sampling or backfills over partitions.
+
+    Every record also gets an "hourbucket" (the UTC hour since the
+    Unix epoch) so that it appears in the TimeIndex (see getWindow).
+    Hours rather than days keep a day's writes from all devices off
+    a single index partition.
+
+    The new records are then run through the alert rules (see
+    helper_evaluateAlerts), whose state is kept with the device's
+    latest-value record, and marked in the device's coverage
+    bitmaps (see helper_updateCoverage).
+
     Params:
         dataList = [(timestamp, {k,v}), ]
+        session = the boto3 session to make clients from, as the
+                  default session isn't safe to share between threads
 
     """
 
     # Get config data
-    res = boto3.client('dynamodb').query(
-            TableName=f'{stackName}-config-table',
-            KeyConditionExpression=f'#devicename = :devicename',
-            ExpressionAttributeNames={'#devicename': 'devicename'},
-            ExpressionAttributeValues={':devicename': {'S': deviceName}},
-        )
+    config = helper_deviceConfig(stackName, deviceName, session)
+    keepRaw = config.get('keepRawSamples', 'false').lower() == 'true'
+    shards, period = helper_shardConfig(config)
+
+    # Summarize bursts of samples
+    dataList = helper_reduceSamples(dataList, keepRaw)
 
     # The structure of the JSON allows us to iterate over all
     # the metrics one by one and batch write all the new data.
     # If there's an error, Python should throw an exception and
     # we'll return an internal server error.
-    table = boto3.resource('dynamodb').Table(f'{stackName}-data-table')
+    table = session.resource('dynamodb').Table(f'{stackName}-data-table')
     with table.batch_writer() as batch:
         for timestamp, attributes in dataList:
-            item={'devicename': deviceName, 'timestamp': timestamp}
+            partition = helper_shardKey(deviceName, timestamp, shards, period)
+            item={'devicename': partition, 'timestamp': timestamp}
+            item['hourbucket'] = int(timestamp) // HOUR_BUCKET_SECONDS
             for k,v in attributes.items():
-                item[k] = str(v)  # must be string because floats not supported
+                item[k] = helper_toAttribute(v)
             batch.put_item(Item=item)
 
+    # Mark the polling slots that now have data
+    helper_updateCoverage(stackName, deviceName, [_[0] for _ in dataList], config, session)
+
+    # Check the new records against the alert rules
+    alertState = helper_evaluateAlerts(stackName, deviceName, dataList, config, session)
+
+    # Keep the latest-value record up to date
+    if dataList:
+        timestamp, attributes = max(dataList, key=lambda _: int(_[0]))
+        helper_putLatest(stackName, deviceName, timestamp, attributes, alertState, session)
+
     # Data write was a success, return success code
     return {'statusCode': 200, 'body': 'OK'}
 
 
+def acceptData(body):
+    """
+    Checks a POST /data body and queues it to be written later by
+    consumeData, so the response doesn't wait on the database. The
+    queue is the SQS queue in the "IngestQueueUrl" env var, or an
+    in-process queue drained by a background thread if it isn't set
+    (a local stand-in for running the function outside of AWS).
+
+    Returns: a 202 response once queued, or a 400 if the body
+             isn't a valid POST /data body
+    """
+    try:
+        helper_parseIngest(body)
+    except (ValueError, KeyError, TypeError) as e:
+        return {'statusCode': 400, 'body': f'Bad Request: {e}'}
+
+    queueUrl = os.environ.get('IngestQueueUrl')
+    if queueUrl:
+        boto3.client('sqs').send_message(QueueUrl=queueUrl, MessageBody=body)
+    else:
+        helper_localIngestQueue().put(body)
+
+    return {'statusCode': 202, 'body': 'Accepted'}
+
+
+def consumeData(records):
+    """
+    Writes a batch of queued POST /data bodies.
+
+    The records of all the bodies are merged by device, dropping
+    repeated timestamps (the last one queued wins), so each device
+    costs one postData call per batch however many publishes it
+    made. Devices are written in parallel, each writer thread with
+    its own boto3 session. SQS delivers messages at least once,
+    which is safe as every write is idempotent. A malformed body
+    only fails its own message, which SQS retries and then moves
+    to the dead-letter queue.
+
+    Params:
+        records = the SQS event records, each with a 'messageId'
+                  and a 'body'
+
+    Returns: the SQS partial batch response, listing the malformed
+             messages and the messages of any device whose write
+             failed so they are retried
+    """
+    stackName = os.environ['StackName']
+    devices = {}
+    messageIds = {}
+    malformed = set()
+    for record in records:
+        try:
+            parsed = helper_parseIngest(record['body'])
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"Error: message {record['messageId']} is malformed ({e!r})")
+            malformed.add(record['messageId'])
+            continue
+        for deviceName, dataList in parsed:
+            merged = devices.setdefault(deviceName, {})
+            merged.update((int(t), a) for t, a in dataList)
+            messageIds.setdefault(deviceName, set()).add(record['messageId'])
+
+    sessions = threading.local()
+    def write(deviceName):
+        if not hasattr(sessions, 'session'): sessions.session = boto3.session.Session()
+        try:
+            postData(stackName, deviceName, sorted(devices[deviceName].items()), sessions.session)
+            return set()
+        except Exception as e:
+            print(f"Error: writing {deviceName} failed ({e!r})")
+            return messageIds[deviceName]
+
+    with ThreadPoolExecutor(max_workers=min(len(devices), INGEST_WRITERS) or 1) as executor:
+        failed = malformed.union(*executor.map(write, devices))
+
+    return {'batchItemFailures': [{'itemIdentifier': _} for _ in sorted(failed)]}
+
+
+def helper_parseIngest(body):
+    """
+    Parses a POST /data body, decoding packed binary records.
+
+    Returns: a list of (deviceName, dataList) tuples
+
+    Raises: ValueError, KeyError or TypeError if the body is malformed
+    """
+    if body is None: raise ValueError("missing body")
+    body = json.loads(body)
+    if not isinstance(body, dict): raise ValueError("body must be an object")
+    devices = []
+    for device in body.get('devices', [body]):
+        if not isinstance(device, dict): raise ValueError("each device must be an object")
+        deviceName, dataList = device['name'], device['data']
+        if not isinstance(deviceName, str) or not deviceName:
+            raise ValueError("device name must be a non-empty string")
+        if isinstance(dataList, str): dataList = helper_decodeRecords(dataList)
+        for timestamp, attributes in dataList:
+            int(timestamp)
+            if not isinstance(attributes, dict): raise ValueError("record attributes must be an object")
+        devices.append((deviceName, dataList))
+    return devices
+
+
+# The local stand-in for the ingest queue, created on first use
+LOCAL_INGEST_QUEUE = None
+LOCAL_INGEST_LOCK = threading.Lock()
+
+def helper_localIngestQueue():
+    """
+    Returns the in-process ingest queue, starting the thread that
+    drains it on first use. The thread passes whatever has queued
+    up to consumeData as one batch, the way SQS batches messages.
+    """
+    global LOCAL_INGEST_QUEUE
+    with LOCAL_INGEST_LOCK:
+        if LOCAL_INGEST_QUEUE is None:
+            LOCAL_INGEST_QUEUE = queue.Queue()
+
+            def drain():
+                while True:
+                    bodies = [LOCAL_INGEST_QUEUE.get()]
+                    while len(bodies) < 100:
+                        try:
+                            bodies.append(LOCAL_INGEST_QUEUE.get(timeout=0.1))
+                        except queue.Empty:
+                            break
+                    records = [{'messageId': str(uuid.uuid4()), 'body': _} for _ in bodies]
+                    try:
+                        consumeData(records)
+                    except Exception as e:
+                        print(f"Error: local ingest failed ({e!r})")
+
+            threading.Thread(target=drain, daemon=True).start()
+    return LOCAL_INGEST_QUEUE
+
+
+def helper_putLatest(stackName, deviceName, timestamp, attributes, alertState=None, session=boto3):
+    """
+    Upserts the latest-value record for a device. The write is
+    conditional on the new timestamp being newer than the stored
+    one, so late or out-of-order data never replaces a newer reading.
+
+    Params:
+        stackName = the name of the CloudFormation stack
+        deviceName = the name of the device the reading is from
+        timestamp = the Unix timestamp of the reading
+        attributes = the reading's attributes as a dict
+        alertState = the device's alert state to store, if any
+        session = the boto3 session to make clients from
+    """
+    item = {'devicename': deviceName, 'timestamp': int(timestamp)}
+    for k,v in attributes.items():
+        item[k] = helper_toAttribute(v)
+    if alertState is not None:
+        item['alertstate'] = json.dumps(alertState, separators=(',', ':'))
+
+    table = session.resource('dynamodb').Table(f'{stackName}-latest-table')
+    try:
+        table.put_item(
+            Item=item,
+            ConditionExpression='attribute_not_exists(#timestamp) OR #timestamp < :timestamp',
+            ExpressionAttributeNames={'#timestamp': 'timestamp'},
+            ExpressionAttributeValues={':timestamp': int(timestamp)},
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException': raise
+
+
+def getLatest(stackName, deviceNames=None):
+    """
+    Gets the most recent reading for a set of devices.
+
+    The readings come from the latest-value table maintained by
+    postData, so this costs a single BatchGetItem per 100 devices
+    instead of one data table query per device. If no device names
+    are given, the (small, one item per device) latest-value table
+    is scanned instead.
+
+    Params:
+        stackName = the name of the CloudFormation stack
+        deviceNames = a list of device names, or None for all devices
+
+    Returns: a response whose body is a JSON list of readings
+    """
+    client = boto3.client('dynamodb')
+    tableName = f'{stackName}-latest-table'
+
+    items = []
+    if deviceNames is None:
+        for page in client.get_paginator('scan').paginate(TableName=tableName):
+            items.extend(page['Items'])
+    else:
+        items = helper_batchGet(client, tableName, deviceNames)
+
+    data = sorted((helper_formatItem(_) for _ in items), key=lambda _: _['devicename'])
+    return {'statusCode': 200, 'body': json.dumps(data)}
+
+
+def helper_batchGet(client, tableName, deviceNames):
+    """
+    Reads the items of a set of devices from a table keyed by
+    devicename. BatchGetItem is limited to 100 keys per request and
+    hands back unprocessed keys when it is throttled; these are
+    retried with exponential backoff and jitter.
+
+    Returns: the raw items that were found, in no particular order
+    """
+    items = []
+    deviceNames = list(dict.fromkeys(deviceNames))
+    for i in range(0, len(deviceNames), 100):
+        keys = [{'devicename': {'S': _}} for _ in deviceNames[i:i+100]]
+        requestItems = {tableName: {'Keys': keys}}
+        for attempt in range(BATCH_GET_RETRIES + 1):
+            if attempt: time.sleep(random.uniform(0, BATCH_GET_BACKOFF * 2**attempt))
+            res = client.batch_get_item(RequestItems=requestItems)
+            items.extend(res['Responses'].get(tableName, []))
+            requestItems = res.get('UnprocessedKeys')
+            if not requestItems: break
+        else:
+            raise RuntimeError(f"BatchGetItem on {tableName} left keys unprocessed after {BATCH_GET_RETRIES} retries")
+    return items
+
+
+def helper_formatItem(attributes):
+    """
+    Converts a DynamoDB data item into a plain dict for a response.
+    The two keys are always returned, with the device name as it is
+    stored (see helper_partitionDevice for removing shard suffixes);
+    all other attributes are retrieved as strings, except for packed
+    sample bursts which are returned as lists of samples. Internal
+    attributes are left out.
+    """
+    item = {
+        'devicename': attributes['devicename']['S'],
+        'timestamp':  int(attributes['timestamp']['N']),
+    }
+    for k,v in attributes.items():
+        if k in item or k in HIDDEN_ATTRIBUTES: continue
+        item[k] = helper_unpackSamples(v['B']) if 'B' in v else v['S']
+    return item
+
+
+def helper_toAttribute(value):
+    """
+    Converts a value to the type stored in a data item. Everything
+    is stored as a string because floats are not supported, except
+    packed sample bursts which are stored as binary.
+    """
+    return value if isinstance(value, bytes) else str(value)
+
+
+def helper_deviceConfig(stackName, deviceName, session=boto3):
+    """
+    Reads the config record of a single device.
+
+    Returns: the config attributes as a dict of strings, which
+             is empty if the device has no config record
+    """
+    res = session.client('dynamodb').get_item(
+            TableName=f'{stackName}-config-table',
+            Key={'devicename': {'S': deviceName}},
+        )
+    return {k: v.get('S', v.get('N')) for k,v in res.get('Item', {}).items()}
+
+
+def helper_cachedConfig(stackName, deviceName):
+    """
+    Reads a device's config through CONFIG_CACHE, which lives as long
+    as the lambda container, so warm invocations reuse it until it is
+    older than the "ConfigTTL" env var. The parsed calibration is
+    cached along with it.
+
+    Returns: a dict with the 'config' as a dict of strings and the
+             'calibration' as parsed by helper_parseCalibration
+    """
+    key = (stackName, deviceName)
+    cached = CONFIG_CACHE.get(key)
+    if cached and cached['expires'] > time.monotonic(): return cached
+
+    config = helper_deviceConfig(stackName, deviceName)
+    CONFIG_CACHE[key] = {
+        'expires': time.monotonic() + float(os.environ.get('ConfigTTL', DEFAULT_CONFIG_TTL)),
+        'config': config,
+        'calibration': helper_parseCalibration(config),
+    }
+    return CONFIG_CACHE[key]
+
+
+def helper_parseCalibration(config):
+    """
+    Parses the "calibration" config of a device, a JSON list of
+    versions (see postCalibration), into parallel arrays ordered
+    by the time each version took effect. The temperature of each
+    version becomes a scale factor for distances: the speed of sound
+    at the actual temperature over the one the sensor assumes.
+
+    Returns: a tuple of (effectiveFrom, mountHeight, datumOffset,
+             scale) arrays (NumPy if available), or None if the
+             device isn't calibrated
+    """
+    versions = json.loads(config.get('calibration', '[]'))
+    if not versions: return None
+    versions.sort(key=lambda _: _['effectiveFrom'])
+
+    def scale(version):
+        temperature = version.get('temperature')
+        if temperature is None: return 1.0
+        reference = version.get('referenceTemperature', DEFAULT_REFERENCE_TEMPERATURE)
+        return math.sqrt((273.15 + float(temperature)) / (273.15 + float(reference)))
+
+    columns = (
+        [int(_['effectiveFrom']) for _ in versions],
+        [float(_['mountHeight']) for _ in versions],
+        [float(_.get('datumOffset', 0)) for _ in versions],
+        [scale(_) for _ in versions],
+    )
+    return tuple(map(np.array, columns)) if np is not None else columns
+
+
+def helper_calibrate(data, calibration):
+    """
+    Adds a "water-level" to each record with a distance, in mm above
+    the datum: mountHeight - distance * scale + datumOffset, using
+    the calibration version in effect at the record's timestamp.
+    Records from before the first version are left as they are.
+
+    With NumPy, a whole page is converted in one vectorized pass;
+    otherwise each record is converted in turn.
+
+    Params:
+        data = a list of records, updated in place
+        calibration = the device's calibration, from helper_parseCalibration
+    """
+    if calibration is None or not data: return
+    effectiveFrom, mountHeight, datumOffset, scale = calibration
+    timestamps = [_['timestamp'] for _ in data]
+    distances = [helper_toFloat(_.get('distance')) for _ in data]
+
+    if np is not None:
+        version = np.searchsorted(effectiveFrom, np.array(timestamps, dtype='i8'), side='right') - 1
+        i = np.maximum(version, 0)
+        levels = mountHeight[i] - np.array(distances, dtype='f8') * scale[i] + datumOffset[i]
+        levels = np.where(version >= 0, np.round(levels, 1), np.nan).tolist()
+    else:
+        levels = []
+        for t, d in zip(timestamps, distances):
+            i = bisect.bisect_right(effectiveFrom, t) - 1
+            levels.append(round(mountHeight[i] - d * scale[i] + datumOffset[i], 1) if i >= 0 else math.nan)
+
+    for record, level in zip(data, levels):
+        if not math.isnan(level): record['water-level'] = level
+
+
+def helper_toFloat(value):
+    """
+    Returns: the value as a float, or NaN if it isn't a number
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+def postCalibration(stackName, deviceName, effectiveFrom, mountHeight, datumOffset=0, temperature=None):
+    """
+    Adds a calibration version to a device's config. Versions apply
+    to every record from their effectiveFrom timestamp until the next
+    version's, so calibration changes (including ones back-dated to
+    fix a survey) apply to stored data without rewriting it. A version
+    with the same effectiveFrom as an existing one replaces it.
+
+    The list is updated conditionally on the old value so concurrent
+    changes are not lost.
+
+    Params:
+        effectiveFrom = the Unix timestamp the version applies from
+        mountHeight = the height of the sensor above the datum in mm
+        datumOffset = an offset added to move to another datum in mm
+        temperature = the air temperature at the gauge in C, if the
+                      distances should be corrected for it
+    """
+    client = boto3.client('dynamodb')
+    tableName = f'{stackName}-config-table'
+    while True:
+        old = helper_deviceConfig(stackName, deviceName).get('calibration')
+        versions = [_ for _ in json.loads(old or '[]') if _['effectiveFrom'] != int(effectiveFrom)]
+
+        version = {'version': max([_['version'] for _ in versions], default=0) + 1,
+                   'effectiveFrom': int(effectiveFrom),
+                   'mountHeight': float(mountHeight),
+                   'datumOffset': float(datumOffset)}
+        if temperature is not None: version['temperature'] = float(temperature)
+        versions = sorted(versions + [version], key=lambda _: _['effectiveFrom'])
+
+        values = {':new': {'S': json.dumps(versions)}, ':one': {'N': '1'}}
+        if old is None:
+            condition = 'attribute_not_exists(calibration)'
+        else:
+            condition = 'calibration = :old'
+            values[':old'] = {'S': old}
+        try:
+            client.update_item(
+                TableName=tableName,
+                Key={'devicename': {'S': deviceName}},
+                UpdateExpression='SET calibration = :new ADD configversion :one',
+                ConditionExpression=condition,
+                ExpressionAttributeValues=values,
+            )
+            break
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException': raise
+
+    CONFIG_CACHE.pop((stackName, deviceName), None)
+    return {'statusCode': 200, 'body': 'OK'}
+
+
+def helper_shardConfig(config):
+    """
+    Reads the write sharding settings from a device's config.
+
+    Returns: a tuple of (shards, period) where shards is the number
+             of partitions to spread the device's data over and
+             period is the length of each time slot in seconds
+    """
+    shards = int(config.get('shards', 1))
+    period = int(config.get('shardPeriod', DEFAULT_SHARD_PERIOD))
+    return max(1, shards), max(1, period)
+
+
+def helper_shardKey(deviceName, timestamp, shards, period):
+    """
+    Picks the data table partition key of a record. Unsharded devices
+    use the device name. Sharded devices use "<devicename>#<shard>",
+    where consecutive time slots of the given period take turns
+    across the shards, so a burst of writes is spread evenly.
+    """
+    if shards <= 1: return deviceName
+    return f'{deviceName}#{int(timestamp) // period % shards}'
+
+
+def helper_partitions(stackName, deviceName):
+    """
+    Lists the data table partition keys that may hold a device's
+    data. The plain device name is always included so data written
+    before sharding was turned on is still found. Note that lowering
+    "shards" hides data in the removed shards, so only raise it.
+    """
+    shards, _ = helper_shardConfig(helper_cachedConfig(stackName, deviceName)['config'])
+    if shards <= 1: return [deviceName]
+    return [deviceName] + [f'{deviceName}#{_}' for _ in range(shards)]
+
+
+def helper_partitionDevice(stackName, partition):
+    """
+    Returns: the name of the device a data table partition key belongs
+             to. A "<devicename>#<shard>" key is only taken to be a
+             shard if the device is configured with that many shards,
+             so device names that happen to end in "#<n>" are kept.
+    """
+    match = re.fullmatch(r'(.+)#\d+', partition)
+    if match and partition in helper_partitions(stackName, match[1]): return match[1]
+    return partition
+
+
+def helper_evaluateAlerts(stackName, deviceName, dataList, config, session=boto3):
+    """
+    Evaluates the alert rules against a batch of new records.
+
+    Rather than querying the device's history, each rule works from
+    a compact state per attribute (the last value, an EWMA and an
+    EWMA of the slope) that is updated record by record. Records no
+    newer than the state are skipped, so retried or late batches
+    don't count twice. A rule fires once when it becomes true and
+    not again until it has cleared, and never more often than the
+    "alertMinInterval" config (see DEFAULT_ALERT_INTERVAL). Fired
+    alerts are sent to the sink named by the "AlertSink" env var.
+
+    Params:
+        dataList = [(timestamp, {k,v}), ] as written
+        config = the device's config as a dict of strings
+        session = the boto3 session to make clients from
+
+    Returns: the new alert state, or None if no rules apply
+    """
+    rules = [
+        (rule, attribute, stat, op, float(config.get(key, default)))
+        for rule, attribute, stat, op, key, default in ALERT_RULES
+        if config.get(key, default) is not None
+    ]
+    sinkName = os.environ.get('AlertSink', 'table')
+    if not rules or not dataList or sinkName == 'none': return None
+
+    smoothing = float(config.get('alertSmoothing', DEFAULT_ALERT_SMOOTHING))
+    minInterval = float(config.get('alertMinInterval', DEFAULT_ALERT_INTERVAL))
+    attributes = {_[1] for _ in rules}
+
+    state = helper_getAlertState(stackName, deviceName, session)
+    alerts = []
+    for timestamp, values in sorted(dataList, key=lambda _: int(_[0])):
+        timestamp = int(timestamp)
+        if timestamp <= state['t']: continue
+        helper_updateAlertState(state, timestamp, values, attributes, smoothing)
+
+        for rule, attribute, stat, op, threshold in rules:
+            value = state['stats'].get(attribute, {}).get(stat)
+            firing = value is not None and (value < threshold if op == '<' else value > threshold)
+
+            # Only the transition into the firing state alerts
+            if not firing:
+                if rule in state['active']: state['active'].remove(rule)
+                continue
+            if rule in state['active']: continue
+            state['active'].append(rule)
+
+            # Flapping rules are limited to one alert per interval
+            if timestamp - state['fired'].get(rule, -math.inf) < minInterval: continue
+            state['fired'][rule] = timestamp
+
+            alerts.append({
+                'devicename': deviceName,
+                'timestamp': timestamp,
+                'rule': rule,
+                'attribute': attribute,
+                'stat': stat,
+                'value': helper_formatNumber(round(value, 3)),
+                'threshold': helper_formatNumber(threshold),
+            })
+
+    if alerts: ALERT_SINKS[sinkName](stackName, alerts, session)
+    return state
+
+
+def helper_updateAlertState(state, timestamp, values, attributes, smoothing):
+    """
+    Updates the alert state with one record. The EWMA and slope use a
+    time based weight, 1 - exp(-dt/smoothing), so irregular reporting
+    intervals are weighted correctly.
+
+    Params:
+        state = the alert state, updated in place
+        timestamp = the timestamp of the record
+        values = the record's attributes
+        attributes = the attributes that are tracked
+        smoothing = the EWMA time constant in seconds
+    """
+    for k in attributes & values.keys():
+        try:
+            value = float(values[k])
+        except (TypeError, ValueError):
+            continue
+
+        stats = state['stats'].get(k)
+        if stats is None:
+            state['stats'][k] = {'t': timestamp, 'last': value, 'ewma': value, 'slope': 0.0}
+            continue
+
+        dt = timestamp - stats['t']
+        if dt <= 0: continue
+        alpha = 1 - math.exp(-dt / smoothing)
+        slope = (value - stats['last']) / dt * 3600
+        stats['ewma'] += alpha * (value - stats['ewma'])
+        stats['slope'] += alpha * (slope - stats['slope'])
+        stats['t'], stats['last'] = timestamp, value
+
+    state['t'] = timestamp
+
+
+def helper_getAlertState(stackName, deviceName, session=boto3):
+    """
+    Reads a device's alert state from its latest-value record.
+
+    Returns: the alert state, which is empty for a new device
+    """
+    res = session.client('dynamodb').get_item(
+            TableName=f'{stackName}-latest-table',
+            Key={'devicename': {'S': deviceName}},
+            ProjectionExpression='alertstate',
+        )
+    state = res.get('Item', {}).get('alertstate')
+    return json.loads(state['S']) if state else {'t': -1, 'stats': {}, 'active': [], 'fired': {}}
+
+
+def helper_alertTable(stackName, alerts, session=boto3):
+    """
+    An alert sink that writes alerts to the alert table. The key
+    of an alert is made from its timestamp & rule, so a retried
+    batch overwrites its alerts instead of repeating them.
+    """
+    table = session.resource('dynamodb').Table(f'{stackName}-alert-table')
+    with table.batch_writer() as batch:
+        for alert in alerts:
+            item = {k: str(v) for k,v in alert.items()}
+            item['timestamp'] = alert['timestamp']
+            item['alertkey'] = f"{alert['timestamp']:010d}#{alert['rule']}"
+            batch.put_item(Item=item)
+
+
+def helper_alertLog(stackName, alerts, session=boto3):
+    """
+    An alert sink that prints alerts to the log.
+    """
+    for alert in alerts:
+        print(f"ALERT {json.dumps(alert)}")
+
+
+# Alerts sent to the memory sink, a local stand-in for
+# the alert table when running the function locally.
+ALERT_MEMORY = []
+
+def helper_alertMemory(stackName, alerts, session=boto3):
+    """
+    An alert sink that keeps alerts in ALERT_MEMORY.
+    """
+    ALERT_MEMORY.extend(alerts)
+
+
+# The alert sinks, by the name set in the "AlertSink" env var. Each
+# is called as sink(stackName, alerts, session).
+ALERT_SINKS = {
+    'table': helper_alertTable,
+    'log': helper_alertLog,
+    'memory': helper_alertMemory,
+}
+
+
+def helper_reduceSamples(dataList, keepRaw=False):
+    """
+    Reduces bursts of samples to summary statistics.
+
+    Any attribute whose value is a list is treated as a burst of
+    samples taken at one timestamp. The attribute is replaced by its
+    median, and "<key>-mean", "<key>-std", "<key>-min", "<key>-max"
+    and "<key>-count" attributes are added. Each statistic is computed
+    as a column across the whole batch. If keepRaw is set, the burst
+    itself is also kept in a packed binary "<key>-samples" attribute.
+
+    With NumPy, the bursts of a key are padded with NaN into one array
+    and each statistic is a single call along its rows; otherwise each
+    burst is summarized in turn.
+
+    Params:
+        dataList = [(timestamp, {k,v}), ]
+        keepRaw = whether to keep the raw samples
+
+    Returns: [(timestamp, {k,v}), ] with the bursts reduced
+    """
+    dataList = [(t, dict(a)) for t, a in dataList]
+    keys = {k for _, a in dataList for k,v in a.items() if isinstance(v, list)}
+
+    for key in keys:
+        rows = [a for _, a in dataList if isinstance(a.get(key), list)]
+        raws = [list(map(float, a.pop(key))) for a in rows]
+
+        # Records with an empty burst have nothing to summarize
+        rows = [a for a, r in zip(rows, raws) if r]
+        raws = [r for r in raws if r]
+        if not raws: continue
+        counts = list(map(len, raws))
+
+        if np is not None:
+            lengths = np.array(counts)
+            padded = np.full((len(raws), lengths.max()), np.nan)
+            padded[np.arange(lengths.max()) < lengths[:, None]] = np.concatenate(raws)
+            medians = np.nanmedian(padded, axis=1).tolist()
+            means = np.nanmean(padded, axis=1).tolist()
+            stds = np.nanstd(padded, axis=1).tolist()
+            mins = np.nanmin(padded, axis=1).tolist()
+            maxs = np.nanmax(padded, axis=1).tolist()
+        else:
+            bursts = list(map(sorted, raws))
+            means = list(map(lambda b, n: math.fsum(b)/n, bursts, counts))
+            medians = list(map(lambda b, n: (b[(n-1)//2] + b[n//2])/2, bursts, counts))
+            stds = list(map(lambda b, m, n: math.sqrt(math.fsum((x-m)**2 for x in b)/n), bursts, means, counts))
+            mins = [_[0] for _ in bursts]
+            maxs = [_[-1] for _ in bursts]
+
+        for i, a in enumerate(rows):
+            a[key] = helper_formatNumber(medians[i])
+            a[f'{key}-mean'] = helper_formatNumber(means[i])
+            a[f'{key}-std'] = helper_formatNumber(stds[i])
+            a[f'{key}-min'] = helper_formatNumber(mins[i])
+            a[f'{key}-max'] = helper_formatNumber(maxs[i])
+            a[f'{key}-count'] = counts[i]
+            if keepRaw: a[f'{key}-samples'] = helper_packSamples(raws[i])
+
+    return dataList
+
+
+def helper_formatNumber(value):
+    """
+    Formats a float without a trailing ".0" when it is whole and
+    rounded to 3 decimal places otherwise.
+    """
+    return int(value) if value == int(value) else round(value, 3)
+
+
+def helper_packSamples(samples):
+    """
+    Packs a burst of samples into bytes. Samples that are all whole
+    numbers that fit are stored as uint16 (like the sensor's mm
+    readings), anything else as float32. The first byte is the
+    struct format character of the samples.
+    """
+    code = 'H' if all(_ == int(_) and 0 <= _ < 2**16 for _ in samples) else 'f'
+    values = [int(_) for _ in samples] if code == 'H' else samples
+    return code.encode('ascii') + struct.pack(f'<{len(samples)}{code}', *values)
+
+
+def helper_unpackSamples(packed):
+    """
+    Unpacks a burst of samples packed by helper_packSamples.
+    """
+    code = chr(packed[0])
+    count = (len(packed) - 1) // struct.calcsize(code)
+    return list(struct.unpack_from(f'<{count}{code}', packed, 1))
+
+
+# The binary record format sent by the firmware. All values are
+# little-endian. The header is followed by one array per field
+# (column-major) so each field can be unpacked in one call:
+#
+#     uint8   version       always RECORD_FORMAT_VERSION
+#     uint8   flags         reserved, must be 0
+#     uint16  count         number of records (N)
+#     uint32  timestamp     base Unix timestamp
+#     uint16  delta[N]      seconds since the previous record
+#     uint16  distance[N]   sensor distance in mm
+#     uint8   queuesize[N]  size of the device's record queue
+#     uint16  battery[N]    battery percent in tenths of a percent
+#
+# Each record costs 7 bytes instead of ~70 bytes of JSON.
+RECORD_FORMAT_VERSION = 1
+RECORD_HEADER = struct.Struct('<BBHI')
+
+
+def helper_decodeRecords(payload):
+    """
+    Decodes a base64 string of packed binary records into the same
+    list of (timestamp, attributes) tuples posted as JSON.
+
+    Params:
+        payload = the base64 encoded records
+
+    Returns: [(timestamp, {k,v}), ]
+
+    Raises: ValueError if the payload isn't valid base64 or doesn't
+            match the format
+    """
+    buffer = base64.b64decode(payload, validate=True)
+    if len(buffer) < RECORD_HEADER.size:
+        raise ValueError(f"expected a {RECORD_HEADER.size} byte header, got {len(buffer)} bytes")
+    version, flags, count, base = RECORD_HEADER.unpack_from(buffer)
+    if version != RECORD_FORMAT_VERSION:
+        raise ValueError(f"unsupported record format version {version}")
+    if flags != 0:
+        raise ValueError(f"unsupported record flags {flags:#04x}")
+    if len(buffer) != RECORD_HEADER.size + 7*count:
+        raise ValueError(f"expected {count} records, got {len(buffer)} bytes")
+
+    # Unpack each column with a single call
+    offset = RECORD_HEADER.size
+    deltas = struct.unpack_from(f'<{count}H', buffer, offset);   offset += 2*count
+    distances = struct.unpack_from(f'<{count}H', buffer, offset); offset += 2*count
+    queueSizes = struct.unpack_from(f'<{count}B', buffer, offset); offset += count
+    batteries = struct.unpack_from(f'<{count}H', buffer, offset)
+
+    timestamps = itertools.accumulate(deltas, initial=base)
+    next(timestamps)  # skip the base, the first delta applies to it
+
+    return [
+        (t, {'distance': d, 'queue-size': q, 'battery-percent': b/10})
+        for t, d, q, b in zip(timestamps, distances, queueSizes, batteries)
+    ]
+
+
+def helper_encodeRecords(dataList):
+    """
+    Encodes a list of records into the packed binary record format.
+    This mirrors what the firmware sends and is used for testing.
+
+    Params:
+        dataList = [(timestamp, {k,v}), ] sorted by timestamp
+
+    Returns: the base64 encoded records as a string
+    """
+    timestamps = [int(_[0]) for _ in dataList]
+    base = timestamps[0] if timestamps else 0
+    deltas = [b - a for a, b in zip([base] + timestamps, timestamps)]
+    count = len(dataList)
+
+    buffer = RECORD_HEADER.pack(RECORD_FORMAT_VERSION, 0, count, base)
+    buffer += struct.pack(f'<{count}H', *deltas)
+    buffer += struct.pack(f'<{count}H', *(int(_[1]['distance']) for _ in dataList))
+    buffer += struct.pack(f'<{count}B', *(int(_[1]['queue-size']) for _ in dataList))
+    buffer += struct.pack(f'<{count}H', *(round(float(_[1]['battery-percent'])*10) for _ in dataList))
+    return base64.b64encode(buffer).decode('ascii')
+
+
+def helper_pollingSeconds(config):
+    """
+    Returns: the length of a device's polling slots in seconds, from
+             its "sensorPollingPeriod" config (in ms)
+    """
+    period = int(config.get('sensorPollingPeriod', DEFAULT_POLLING_PERIOD))
+    return max(1, period // 1000)
+
+
+def helper_updateCoverage(stackName, deviceName, timestamps, config, session=boto3):
+    """
+    Sets the bits of a device's coverage bitmaps for the polling
+    slots of the given timestamps.
+
+    There is one item per device per UTC day, holding a bitmap (bit i
+    of the little-endian bytes is slot i of the day) along with the
+    slot period and a version. Bits are merged with a read & a write
+    conditional on the version, retried if another write got there
+    first. If nothing new is set, nothing is written.
+
+    Params:
+        timestamps = the timestamps of the new records
+        config = the device's config as a dict of strings
+        session = the boto3 session to make clients from
+    """
+    period = helper_pollingSeconds(config)
+    days = {}
+    for timestamp in map(int, timestamps):
+        day, second = divmod(timestamp, 86400)
+        days[day] = days.get(day, 0) | 1 << (second // period)
+
+    client = session.client('dynamodb')
+    tableName = f'{stackName}-coverage-table'
+    for day, bits in days.items():
+        key = {'devicename': {'S': deviceName}, 'day': {'N': str(day)}}
+        for attempt in range(COVERAGE_RETRIES):
+            item = client.get_item(TableName=tableName, Key=key, ConsistentRead=True).get('Item')
+            old, version = helper_readBitmap(item, period) if item else (0, 0)
+
+            new = old | bits
+            if new == old and version: break
+            try:
+                client.put_item(
+                    TableName=tableName,
+                    Item={
+                        **key,
+                        'bitmap': {'B': new.to_bytes((-(-86400 // period) + 7) // 8, 'little')},
+                        'period': {'N': str(period)},
+                        'version': {'N': str(version + 1)},
+                    },
+                    ConditionExpression='attribute_not_exists(version) OR version = :version',
+                    ExpressionAttributeValues={':version': {'N': str(version)}},
+                )
+                break
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException': raise
+                if attempt == COVERAGE_RETRIES - 1: raise
+
+
+def helper_readBitmap(item, period):
+    """
+    Reads the bitmap of a coverage item as an int, converting it to
+    the given slot period if the device's polling period changed.
+    A slot of the new period is set if any part of it had data.
+
+    Returns: a tuple of (bitmap, version)
+    """
+    bitmap = int.from_bytes(item['bitmap']['B'], 'little')
+    oldPeriod = int(item['period']['N'])
+    version = int(item['version']['N'])
+    if oldPeriod == period: return bitmap, version
+
+    converted = 0
+    for i, bit in enumerate(reversed(format(bitmap, 'b'))):
+        if bit == '1': converted |= 1 << (i * oldPeriod // period)
+    return converted, version
+
+
+def getCoverage(stackName, deviceName, start, end):
+    """
+    Summarizes how complete a device's data is over a time window,
+    using only its coverage bitmaps (see helper_updateCoverage).
+
+    Params:
+        stackName = the name of the CloudFormation stack
+        deviceName = the name of the device
+        start = the first Unix timestamp of the window (inclusive)
+        end = the last Unix timestamp of the window (exclusive)
+
+    Returns: a response whose body is a JSON object with the number
+             of expected & covered polling slots, the completeness
+             as a percentage, and a list of [start, end) gaps
+    """
+    end = min(end, int(time.time()))
+    firstDay, lastDay = start // 86400, (end - 1) // 86400
+    period = helper_pollingSeconds(helper_deviceConfig(stackName, deviceName))
+
+    items = {}
+    paginator = boto3.client('dynamodb').get_paginator('query')
+    pages = paginator.paginate(
+            TableName=f'{stackName}-coverage-table',
+            KeyConditionExpression='#devicename = :devicename AND #day BETWEEN :first AND :last',
+            ExpressionAttributeNames={'#devicename': 'devicename', '#day': 'day'},
+            ExpressionAttributeValues={
+                ':devicename': {'S': deviceName},
+                ':first': {'N': str(firstDay)},
+                ':last': {'N': str(lastDay)},
+            },
+        )
+    for page in pages:
+        items.update({int(_['day']['N']): _ for _ in page['Items']})
+
+    expected, covered, gaps = 0, 0, []
+    for day in range(firstDay, lastDay + 1):
+        dayStart = day * 86400
+        dayPeriod = int(items[day]['period']['N']) if day in items else period
+        numSlots = -(-86400 // dayPeriod)
+
+        # The slots of the day that overlap the window
+        lo = max(0, (start - dayStart) // dayPeriod)
+        hi = min(numSlots, -(-(end - dayStart) // dayPeriod))
+        if day in items:
+            bitmap = int.from_bytes(items[day]['bitmap']['B'], 'little')
+            slots = format(bitmap, f'0{numSlots}b')[::-1][lo:hi]
+        else:
+            slots = '0' * (hi - lo)
+
+        expected += len(slots)
+        covered += slots.count('1')
+        for m in re.finditer('0+', slots):
+            gapStart = max(start, dayStart + (lo + m.start()) * dayPeriod)
+            gapEnd = min(end, dayStart + (lo + m.end()) * dayPeriod)
+            if gaps and gaps[-1][1] == gapStart:
+                gaps[-1][1] = gapEnd
+            else:
+                gaps.append([gapStart, gapEnd])
+
+    data = {
+        'devicename': deviceName,
+        'from': start,
+        'to': end,
+        'expected': expected,
+        'covered': covered,
+        'completeness': round(100 * covered / expected, 2) if expected else 100.0,
+        'gaps': gaps,
+    }
+    return {'statusCode': 200, 'body': json.dumps(data)}
+
+
 def deleteData(stackName, keyList):
     """
+    Deletes records from the data table. Records of sharded devices
+    are deleted from their shard, as well as from the plain device
+    name in case they were written before sharding was turned on.
 
+    Params:
+        keyList = [(deviceName, timestamp), ]
     """
+    shardConfigs = {}
     table = boto3.resource('dynamodb').Table(f'{stackName}-data-table')
     with table.batch_writer() as batch:
         for deviceName, timestamp in keyList:
-            item={'devicename': deviceName, 'timestamp': timestamp}
-            batch.delete_item(Key=item)
+            if deviceName not in shardConfigs:
+                shardConfigs[deviceName] = helper_shardConfig(helper_deviceConfig(stackName, deviceName))
+            shards, period = shardConfigs[deviceName]
+            for partition in dict.fromkeys([deviceName, helper_shardKey(deviceName, timestamp, shards, period)]):
+                item={'devicename': partition, 'timestamp': timestamp}
+                batch.delete_item(Key=item)
 
     # Delete was a success, return success code
     return {'statusCode': 200, 'body': 'OK'}
 
 
-def getConfig(stackName, deviceName = None):
+def getConfig(stackName, deviceName=None, sinceVersion=None):
     """
+    Gets the config of one, several, or all devices.
+
+    A single device is read with GetItem, several with BatchGetItem
+    (100 keys per request) and all of them with a paginated scan.
+    Every config has a "configversion" that goes up by one on each
+    change of that config, so a device can pass the last version it
+    saw as sinceVersion and only get its config when it changed.
+    The versions of different devices are separate counters, so
+    sinceVersion is only allowed with a single device name.
+
+    Params:
+        stackName = the name of the CloudFormation stack
+        deviceName = a device name, a list of them, or None for all
+        sinceVersion = only return the config if it has a higher version
 
+    Returns: a response whose body is a JSON list of configs, or a
+             400 response if sinceVersion is given without a single
+             device name
     """
-    # TODO: Validate Inputs
+    client = boto3.client('dynamodb')
+    tableName = f'{stackName}-config-table'
+    deviceNames = [deviceName] if isinstance(deviceName, str) else deviceName
 
-    if deviceName:
+    if sinceVersion is not None and (deviceNames is None or len(deviceNames) != 1):
+        return {'statusCode': 400, 'body': 'since_version needs a single device name'}
 
-        # Make query to database table
-        res = boto3.client('dynamodb').query(
-                TableName=f'{stackName}-config-table',
-                KeyConditionExpression=f'#devicename = :devicename',
-                ExpressionAttributeNames={'#devicename': 'devicename'},
-                ExpressionAttributeValues={':devicename': {'S': deviceName}},
-            )
+    # Reading every config scans (and is billed for) the whole
+    # table, so pollers should name the devices they want.
+    items = []
+    if deviceNames is None:
+        for page in client.get_paginator('scan').paginate(TableName=tableName):
+            items.extend(page['Items'])
+    elif len(deviceNames) == 1:
+        res = client.get_item(TableName=tableName, Key={'devicename': {'S': deviceNames[0]}})
+        items.extend([res['Item']] if 'Item' in res else [])
     else:
-        res = boto3.client('dynamodb').scan(TableName=f'{stackName}-config-table')
+        items = helper_batchGet(client, tableName, deviceNames)
 
-    # Format data for response
-    data = []
-    for attributes in res['Items']:
-        # The two keys are always returned
-        item = {}
+    data = [helper_formatConfig(_) for _ in items]
+    if sinceVersion is not None:
+        data = [_ for _ in data if _['configversion'] > sinceVersion]
+    data.sort(key=lambda _: _['devicename'])
+    return {'statusCode': 200, 'body': json.dumps(data)}
 
-        # All other attributes are retreived, all as strings
-        for k,v in attributes.items(): item[k] = v['S']
-        data.append(item)
 
-    return {'statusCode': 200, 'body': json.dumps(data)}
+def helper_formatConfig(attributes):
+    """
+    Converts a config item into a plain dict for a response. The
+    version is an int (0 for configs written before versioning);
+    all other attributes are strings.
+    """
+    item = {k: v['S'] for k,v in attributes.items() if 'S' in v}
+    item['configversion'] = int(attributes.get('configversion', {'N': '0'})['N'])
+    return item
 
 
-def postConfig(stackName, deviceName, attributes):
+def postConfig(stackName, deviceName, attributes, version=None):
     """
+    Updates some of a device's config attributes, leaving the others
+    as they are. Attributes with a value of None are removed. Each
+    update adds one to the device's "configversion".
+
+    If a version is given, the update only succeeds if the config is
+    still at that version, so read-modify-write changes from several
+    clients can't overwrite each other.
 
+    Params:
+        stackName = the name of the CloudFormation stack
+        deviceName = the name of the device
+        attributes = a dict of the attributes to set or remove
+        version = the expected current version, if any
+
+    Returns: a response whose body is a JSON object with the new
+             version, or a 409 if the version didn't match
     """
-    # The structure of the JSON allows us to iterate over all
-    # the metrics one by one and batch write all the new data.
-    # If there's an error, Python should throw an exception and
-    # we'll return an internal server error.
-    table = boto3.resource('dynamodb').Table(f'{stackName}-config-table')
-    with table.batch_writer() as batch:
-            item={'devicename': deviceName}
-            for k,v in attributes.items():
-                item[k] = str(v)  # must be string because floats not supported
-            batch.put_item(Item=item)
+    names = {'#configversion': 'configversion'}
+    values = {':one': {'N': '1'}}
+    sets, removes = [], []
+    for i, (k,v) in enumerate(attributes.items()):
+        if k in ['devicename', 'configversion']: continue
+        names[f'#a{i}'] = k
+        if v is None:
+            removes.append(f'#a{i}')
+        else:
+            values[f':v{i}'] = {'S': str(v)}  # must be string because floats not supported
+            sets.append(f'#a{i} = :v{i}')
 
-    # Data write was a success, return success code
-    return {'statusCode': 200, 'body': 'OK'}
+    expression = 'ADD #configversion :one'
+    if sets: expression = f"SET {', '.join(sets)} {expression}"
+    if removes: expression += f" REMOVE {', '.join(removes)}"
+
+    params = {}
+    if version is not None:
+        if int(version) == 0:
+            params['ConditionExpression'] = 'attribute_not_exists(#configversion)'
+        else:
+            params['ConditionExpression'] = '#configversion = :version'
+            values[':version'] = {'N': str(int(version))}
+
+    try:
+        res = boto3.client('dynamodb').update_item(
+                TableName=f'{stackName}-config-table',
+                Key={'devicename': {'S': deviceName}},
+                UpdateExpression=expression,
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=values,
+                ReturnValues='UPDATED_NEW',
+                **params,
+            )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException': raise
+        return {'statusCode': 409, 'body': 'Conflict'}
+
+    CONFIG_CACHE.pop((stackName, deviceName), None)
+    newVersion = int(res['Attributes']['configversion']['N'])
+    return {'statusCode': 200, 'body': json.dumps({'devicename': deviceName, 'configversion': newVersion})}
 
 
 def deleteConfig(stackName, deviceName):
     """
-
+    Deletes a device's config record.
     """
-    table = boto3.resource('dynamodb').Table(f'{stackName}-config-table')
-    with table.batch_writer() as batch:
-        batch.delete_item(Key={'devicename': deviceName})
+    boto3.client('dynamodb').delete_item(
+            TableName=f'{stackName}-config-table',
+            Key={'devicename': {'S': deviceName}},
+        )
+    CONFIG_CACHE.pop((stackName, deviceName), None)
 
     # Delete was a success, return success code
     return {'statusCode': 200, 'body': 'OK'}
 
 
+
+
+def helper_profileModes(event):
+    """
+    Determines which profilers (if any) should run for a request.
+
+    An explicit "X-Profile" request header always wins. Otherwise a
+    random fraction of requests, set by the "ProfileRate" environment
+    variable, are profiled with the modes in "ProfileModes".
+
+    Params:
+        event = the API Gateway proxy event
+
+    Returns: a set containing any of {'cpu', 'memory'}
+    """
+    headers = {k.lower(): v for k,v in (event.get('headers') or {}).items()}
+    if 'x-profile' in headers:
+        return helper_parseProfileModes(headers['x-profile'])
+
+    rate = float(os.environ.get('ProfileRate', 0))
+    if rate > 0 and random.random() < rate:
+        return helper_parseProfileModes(os.environ.get('ProfileModes', 'cpu'))
+
+    return set()
+
+
+def helper_parseProfileModes(value):
+    """
+    Parses a comma separated list of profile modes. The values
+    "1", "true", and "on" are shorthand for CPU profiling only.
+    """
+    modes = {_.strip().lower() for _ in value.split(',') if _.strip()}
+    if modes & {'1', 'true', 'on'}: modes = (modes - {'1', 'true', 'on'}) | {'cpu'}
+    return modes & {'cpu', 'memory'}
+
+
+# tracemalloc is process-wide and only one cProfile.Profile can be
+# enabled at a time (Python 3.12+), so profiled blocks run one at a
+# time when requests are handled on threads (see admin/server.py).
+PROFILE_LOCK = threading.Lock()
+
+@contextlib.contextmanager
+def helper_profile(modes, label='profile', outDir=None, fmt=None, top=None):
+    """
+    A context manager that runs the enclosed code under cProfile and/or
+    tracemalloc. When the block exits, the results are written to files
+    in the output directory and a top-N summary is printed to the log.
+
+    Profiled blocks are serialized by PROFILE_LOCK, so concurrent
+    profiled requests wait their turn. Unprofiled requests still run
+    alongside, and their allocations show up in memory snapshots.
+
+    The output directory may be an s3://<bucket>/<prefix> URL, as a
+    lambda function's /tmp is lost with its container. The results
+    are then written to the temp directory and uploaded from there.
+
+    Params:
+        modes = a set containing any of {'cpu', 'memory'}
+        label = a name for the profiled block, used in file names & logs
+        outDir = where to write the results (env "ProfileDir")
+        fmt = one of {'pstats', 'speedscope', 'both'} (env "ProfileFormat")
+        top = the number of summary lines to log (env "ProfileTop")
+    """
+    outDir = outDir or os.environ.get('ProfileDir') or os.path.join(tempfile.gettempdir(), 'profiles')
+    fmt = fmt or os.environ.get('ProfileFormat', 'pstats')
+    top = int(top or os.environ.get('ProfileTop', 20))
+
+    s3Url = outDir if outDir.startswith('s3://') else None
+    if s3Url: outDir = os.path.join(tempfile.gettempdir(), 'profiles')
+
+    with PROFILE_LOCK:
+        profiler = cProfile.Profile() if 'cpu' in modes else None
+        if 'memory' in modes: tracemalloc.start()
+        if profiler: profiler.enable()
+
+        try:
+            yield
+        finally:
+            if profiler: profiler.disable()
+            snapshot = tracemalloc.take_snapshot() if 'memory' in modes else None
+            if snapshot: tracemalloc.stop()
+
+            # File names share a prefix so the results of one run sort together
+            os.makedirs(outDir, exist_ok=True)
+            name = re.sub(r'[^A-Za-z0-9_.-]+', '_', label).strip('_')
+            prefix = os.path.join(outDir, f"{time.strftime('%Y%m%dT%H%M%S')}-{name}-{uuid.uuid4().hex[:8]}")
+
+            if profiler:
+                stats = pstats.Stats(profiler)
+                if fmt in ['pstats', 'both']:
+                    stats.dump_stats(f'{prefix}.pstats')
+                    print(f"Profile written to {helper_saveProfile(f'{prefix}.pstats', s3Url)}")
+                if fmt in ['speedscope', 'both']:
+                    with open(f'{prefix}.speedscope.json', 'w') as f:
+                        json.dump(helper_speedscope(stats, label), f)
+                    print(f"Profile written to {helper_saveProfile(f'{prefix}.speedscope.json', s3Url)}")
+
+                summary = io.StringIO()
+                stats.stream = summary
+                stats.sort_stats('cumulative').print_stats(top)
+                print(f"Top {top} functions by cumulative time for {label}:")
+                print(summary.getvalue())
+
+            if snapshot:
+                snapshot.dump(f'{prefix}.tracemalloc')
+                print(f"Memory snapshot written to {helper_saveProfile(f'{prefix}.tracemalloc', s3Url)}")
+                print(f"Top {top} allocations for {label}:")
+                for stat in snapshot.statistics('lineno')[:top]:
+                    print(f"\t{stat}")
+
+
+def helper_saveProfile(path, s3Url=None):
+    """
+    Uploads a results file of helper_profile to S3, if given an
+    s3://<bucket>/<prefix> URL, and removes the local copy. A failed
+    upload is logged and leaves the file where it is, so profiling
+    never fails the request.
+
+    Returns: where the file ended up
+    """
+    if not s3Url: return path
+    bucket, _, prefix = s3Url[len('s3://'):].partition('/')
+    key = '/'.join(_ for _ in [prefix.strip('/'), os.path.basename(path)] if _)
+    try:
+        boto3.client('s3').upload_file(path, bucket, key)
+    except Exception as e:
+        print(f"Error: uploading profile to s3://{bucket}/{key} failed ({e!r})")
+        return path
+    os.remove(path)
+    return f's3://{bucket}/{key}'
+
+
+def helper_speedscope(stats, label):
+    """
+    Converts pstats results into the speedscope file format.
+
+    cProfile only records caller/callee edges, not full stacks, so
+    each function's own time is attributed to a single stack built
+    by following its most expensive caller back to the root. This is
+    enough to read hot spots off a flame graph.
+
+    Params:
+        stats = a pstats.Stats object
+        label = the name of the profile
+
+    Returns: a dict that can be saved as a speedscope JSON file
+    """
+    frames = []
+    frameIndex = {}
+    def frame(func):
+        if func not in frameIndex:
+            filename, line, name = func
+            frameIndex[func] = len(frames)
+            frames.append({'name': name, 'file': filename, 'line': line})
+        return frameIndex[func]
+
+    samples = []
+    weights = []
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        if tt <= 0: continue
+
+        # Walk up the heaviest callers, stopping on recursion
+        stack = [func]
+        while callers:
+            caller = max(callers, key=lambda _: callers[_][3])
+            if caller in stack: break
+            stack.append(caller)
+            callers = stats.stats[caller][4] if caller in stats.stats else {}
+
+        samples.append([frame(_) for _ in reversed(stack)])
+        weights.append(tt)
+
+    return {
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'shared': {'frames': frames},
+        'profiles': [{
+            'type': 'sampled',
+            'name': label,
+            'unit': 'seconds',
+            'startValue': 0,
+            'endValue': sum(weights),
+            'samples': samples,
+            'weights': weights,
+        }],
+        'name': label,
+        'exporter': 'tide-gauge',
+    }
@@ -15,16 +15,13 @@
 
 # TODO: add config-table clears, writes, & reads
 
-# Insert new test data using db commands
+# Insert new test data using db commands. All the
+# inserts run as a batch in a single admin.py process.
 numInserts=5
+start=`date +%s`
 for run in $(seq $numInserts); do
-    ./admin.py db-data         \
-        --device test-device   \
-        --post                 \
-        --timestamp `date +%s` \
-        --data "source=db-data;run=$run;data=[1,2,3]"
-    sleep 1.5
-done
+    echo "db-data --device test-device --post --timestamp $(($start+$run)) --data 'source=db-data;run=$run;data=[1,2,3]'"
+done | ./admin.py batch
 
 # List current data using db commands
 res=$(./admin.py db-data       \
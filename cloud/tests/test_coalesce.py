@@ -0,0 +1,126 @@
+#  _______ _     _         _____
+# |__   __(_)   | |       / ____|
+#    | |   _  __| | ___  | |  __  __ _ _   _  __ _  ___
+#    | |  | |/ _` |/ _ \ | | |_ |/ _` | | | |/ _` |/ _ \
+#    | |  | | (_| |  __/ | |__| | (_| | |_| | (_| |  __/
+#    |_|  |_|\__,_|\___|  \_____|\__,_|\__,_|\__, |\___|
+#                                             __/ |
+#                                            |___/
+# Author: Bryce Kellogg (bryce@kellogg.org)
+# Copyright: 2023 Bryce Kellogg
+# License: GPLv3
+#
+# Tests of the ingest coalescer's pacing & bisection. The usage plan
+# limits run on a fake clock and posts go to a fake API.
+import pytest
+
+from admin.coalesce import Coalescer
+
+
+class FakeClock:
+    def __init__(self, now=19000 * 86400):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class Rejected(Exception):
+    """
+    A failed post, shaped like the HTTPError of a requests.Response.
+    """
+
+    def __init__(self, status):
+        super().__init__(f"{status} error")
+        self.response = type('Response', (), {'status_code': status})()
+
+
+class FakeApi:
+    """
+    Records posted batches, rejecting any batch that
+    contains one of the bad devices with a 400.
+    """
+
+    def __init__(self, bad=()):
+        self.bad = set(bad)
+        self.batches = []
+
+    def __call__(self, devices):
+        names = [_['name'] for _ in devices]
+        self.batches.append(names)
+        if self.bad & set(names): raise Rejected(400)
+
+
+def publishes(names, timestamp=1):
+    return [{'name': _, 'data': [[timestamp, {'distance': 1000}]]} for _ in names]
+
+
+def test_postsArePacedToTheQuota():
+    clock, api = FakeClock(), FakeApi()
+    coalescer = Coalescer(api, quota=3000, rate=2, burst=10, reserve=0.1, clock=clock)
+    assert coalescer.interval() == pytest.approx(86400 / 2700)
+
+    coalescer.add(publishes(['a'])[0])
+    coalescer.add(publishes(['a', 'b'], timestamp=2)[1])
+    clock.now += 30
+    assert not coalescer.flush()
+    clock.now += 3
+    assert coalescer.flush()
+    assert api.batches == [['a', 'b']]
+    assert not coalescer.buffer and coalescer.numBytes == 0
+
+
+def test_fullBufferIsPostedRightAway():
+    clock, api = FakeClock(), FakeApi()
+    coalescer = Coalescer(api, maxBytes=100, clock=clock)
+    for publish in publishes('abcdef'):
+        coalescer.add(publish)
+    assert coalescer.flush()
+    assert api.batches == [list('abcdef')]
+
+
+def test_rejectedDeviceIsBisectedOut():
+    clock, api = FakeClock(), FakeApi(bad=['c'])
+    coalescer = Coalescer(api, rate=1, burst=10, clock=clock)
+    acks = []
+    for publish in publishes('abcdefgh'):
+        coalescer.add(publish, lambda: acks.append(1))
+
+    assert coalescer.flush(force=True)
+    assert api.batches == [list('abcdefgh'), list('abcd'), ['a', 'b'], ['c', 'd'], ['c'], ['d'], list('efgh')]
+    assert [_['name'] for _, error in coalescer.deadLetters] == ['c']
+    assert not coalescer.buffer and len(acks) == 8
+
+
+def test_bisectionWaitsForTheUsagePlan():
+    clock, api = FakeClock(), FakeApi(bad=['c'])
+    coalescer = Coalescer(api, rate=1, burst=3, clock=clock)
+    acks = []
+    for publish in publishes('abcdefgh'):
+        coalescer.add(publish, lambda: acks.append(1))
+
+    # The burst runs out part way down the bisection
+    assert coalescer.flush(force=True)
+    assert api.batches == [list('abcdefgh'), list('abcd'), ['a', 'b']]
+    assert sorted(coalescer.buffer) == list('cdefgh') and not acks
+    assert not coalescer.flush(force=True)
+
+    # The rest of the halves are posted as the bucket refills,
+    # and the publishes only acked once all of them are
+    while coalescer.buffer:
+        clock.now += 1
+        coalescer.flush(force=True)
+    assert api.batches[3:] == [['c', 'd'], ['c'], ['d'], list('efgh')]
+    assert [_['name'] for _, error in coalescer.deadLetters] == ['c']
+    assert len(acks) == 8
+
+
+def test_serverErrorsAreRetried():
+    clock = FakeClock()
+    def post(devices): raise Rejected(500)
+    coalescer = Coalescer(post, clock=clock)
+    coalescer.add(publishes('a')[0])
+
+    assert not coalescer.flush(force=True)
+    assert list(coalescer.buffer) == ['a'] and coalescer.retryAt == clock.now + 2
+    assert not coalescer.due()
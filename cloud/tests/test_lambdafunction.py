@@ -0,0 +1,486 @@
+#  _______ _     _         _____
+# |__   __(_)   | |       / ____|
+#    | |   _  __| | ___  | |  __  __ _ _   _  __ _  ___
+#    | |  | |/ _` |/ _ \ | | |_ |/ _` | | | |/ _` |/ _ \
+#    | |  | | (_| |  __/ | |__| | (_| | |_| | (_| |  __/
+#    |_|  |_|\__,_|\___|  \_____|\__,_|\__,_|\__, |\___|
+#                                             __/ |
+#                                            |___/
+# Author: Bryce Kellogg (bryce@kellogg.org)
+# Copyright: 2023 Bryce Kellogg
+# License: GPLv3
+#
+# Tests of the lambda function's data paths. DynamoDB is replaced by
+# small in-memory fakes of the client calls each path makes, so the
+# tests run without AWS credentials or a deployed stack.
+import re
+import json
+import math
+import base64
+import operator
+import pytest
+
+from lambdafunction import lambdafunction as lf
+
+
+class FakeDataTable:
+    """
+    An in-memory data table that answers the client.query calls
+    made by helper_queryPage & helper_queryBucket.
+
+    Params:
+        items = raw DynamoDB items
+    """
+
+    OPS = {'=': operator.eq, '<': operator.lt, '>': operator.gt, '<=': operator.le, '>=': operator.ge}
+
+    def __init__(self, items):
+        self.items = items
+        self.numRead = 0
+
+    def query(self, **kwargs):
+        values = kwargs['ExpressionAttributeValues']
+        if kwargs.get('IndexName') == 'TimeIndex':
+            key = lambda _: (int(_['timestamp']['N']), _['devicename']['S'])
+            match = lambda _: (_['hourbucket'] == values[':hourbucket'] and
+                               int(values[':start']['N']) <= int(_['timestamp']['N']) <= int(values[':end']['N']))
+        else:
+            key = lambda _: int(_['timestamp']['N'])
+            if 'BETWEEN' in kwargs['KeyConditionExpression']:
+                inRange = lambda t: int(values[':timestamp']['N']) <= t <= int(values[':timestampEnd']['N'])
+            else:
+                op = self.OPS[re.search(r'#timestamp (\S+) :timestamp', kwargs['KeyConditionExpression'])[1]]
+                inRange = lambda t: op(t, int(values[':timestamp']['N']))
+            match = lambda _: _['devicename'] == values[':devicename'] and inRange(int(_['timestamp']['N']))
+
+        reverse = not kwargs.get('ScanIndexForward', True)
+        rows = sorted(filter(match, self.items), key=key, reverse=reverse)
+        if 'ExclusiveStartKey' in kwargs:
+            after = key(kwargs['ExclusiveStartKey'])
+            rows = [_ for _ in rows if (key(_) < after if reverse else key(_) > after)]
+
+        limit = kwargs.get('Limit')
+        page = rows[:limit] if limit else rows
+        self.numRead += len(page)
+        res = {'Items': page}
+        if limit and len(rows) > limit:
+            res['LastEvaluatedKey'] = {k: page[-1][k] for k in ['devicename', 'timestamp', 'hourbucket'] if k in page[-1]}
+        return res
+
+
+class FakeCoverageTable:
+    """
+    An in-memory coverage table that answers the paginated
+    query made by getCoverage.
+    """
+
+    def __init__(self, items):
+        self.items = items
+
+    def get_paginator(self, name):
+        return self
+
+    def paginate(self, **kwargs):
+        values = kwargs['ExpressionAttributeValues']
+        first, last = int(values[':first']['N']), int(values[':last']['N'])
+        return [{'Items': [_ for _ in self.items if first <= int(_['day']['N']) <= last]}]
+
+
+class FakeConfigTable:
+    """
+    An in-memory config table that answers the update_item,
+    get_item & scan calls made by postConfig, postCalibration
+    & getConfig.
+    """
+
+    def __init__(self):
+        self.items = {}
+        self.numScanned = 0
+
+    def update_item(self, **kwargs):
+        names, values = kwargs.get('ExpressionAttributeNames', {}), kwargs['ExpressionAttributeValues']
+        name = lambda _: names.get(_, _)
+        deviceName = kwargs['Key']['devicename']['S']
+        item = dict(self.items.get(deviceName) or {'devicename': {'S': deviceName}})
+
+        condition = kwargs.get('ConditionExpression', '')
+        missing = re.fullmatch(r'attribute_not_exists\((#?\w+)\)', condition)
+        equal = re.fullmatch(r'(#?\w+) = (:\w+)', condition)
+        if (missing and name(missing[1]) in item) or (equal and item.get(name(equal[1])) != values[equal[2]]):
+            raise lf.ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'UpdateItem')
+
+        expression = kwargs['UpdateExpression']
+        for key, value in re.findall(r'(#?\w+) = (:\w+)', expression):
+            item[name(key)] = values[value]
+        for key in re.findall(r'#\w+', expression.partition('REMOVE')[2]):
+            item.pop(name(key), None)
+        version = int(item.get('configversion', {'N': '0'})['N']) + 1
+        item['configversion'] = {'N': str(version)}
+        self.items[deviceName] = item
+        return {'Attributes': {'configversion': item['configversion']}}
+
+    def get_item(self, **kwargs):
+        item = self.items.get(kwargs['Key']['devicename']['S'])
+        return {'Item': item} if item else {}
+
+    def get_paginator(self, name):
+        return self
+
+    def paginate(self, **kwargs):
+        self.numScanned += len(self.items)
+        return [{'Items': list(self.items.values())}]
+
+
+def record(partition, timestamp, **attributes):
+    """
+    Returns: a raw data table item
+    """
+    item = {
+        'devicename': {'S': partition},
+        'timestamp': {'N': str(timestamp)},
+        'hourbucket': {'N': str(timestamp // lf.HOUR_BUCKET_SECONDS)},
+    }
+    item.update({k: {'S': str(v)} for k,v in attributes.items()})
+    return item
+
+
+@pytest.fixture
+def deviceConfigs(monkeypatch):
+    """
+    Serves device configs from a dict of device name to config
+    instead of the config table.
+    """
+    configs = {}
+    monkeypatch.setattr(lf, 'helper_cachedConfig', lambda stackName, deviceName: {
+        'config': configs.get(deviceName, {}),
+        'calibration': None,
+    })
+    monkeypatch.setattr(lf, 'helper_deviceConfig', lambda stackName, deviceName, session=None: configs.get(deviceName, {}))
+    return configs
+
+
+def useClient(monkeypatch, client):
+    monkeypatch.setattr(lf.boto3, 'client', lambda *args, **kwargs: client)
+
+
+RECORDS = [
+    (1700000000, {'distance': 1234, 'queue-size': 0, 'battery-percent': 87.5}),
+    (1700000030, {'distance': 1240, 'queue-size': 3, 'battery-percent': 87.4}),
+    (1700000090, {'distance': 65535, 'queue-size': 255, 'battery-percent': 0.0}),
+]
+
+
+def test_encodeRecordsRoundTrip():
+    assert lf.helper_decodeRecords(lf.helper_encodeRecords(RECORDS)) == RECORDS
+
+
+def test_encodeRecordsEmpty():
+    assert lf.helper_decodeRecords(lf.helper_encodeRecords([])) == []
+
+
+@pytest.mark.parametrize('payload', [
+    'AAA=',                                                                   # shorter than the header
+    base64.b64encode(base64.b64decode(lf.helper_encodeRecords(RECORDS))[:-1]).decode(),  # last record cut short
+    base64.b64encode(b'\x02' + base64.b64decode(lf.helper_encodeRecords(RECORDS))[1:]).decode(),  # unknown version
+    base64.b64encode(b'\x01\x01' + base64.b64decode(lf.helper_encodeRecords(RECORDS))[2:]).decode(),  # reserved flags set
+    'not base64!',
+])
+def test_decodeRecordsRejectsBadPayloads(payload):
+    with pytest.raises(ValueError):
+        lf.helper_decodeRecords(payload)
+
+
+def test_shardedIterDataIsInOrder(monkeypatch, deviceConfigs):
+    # Records spread over the plain name (written before sharding) & 3 shards
+    deviceConfigs['gauge'] = {'shards': '3'}
+    timestamps = list(range(1000, 1300, 3))
+    items = [record('gauge', _, distance=_) for _ in timestamps[:10]]
+    items += [record(lf.helper_shardKey('gauge', _, 3, 1), _, distance=_) for _ in timestamps[10:]]
+    useClient(monkeypatch, FakeDataTable(items))
+
+    for op, timestamp, expected in [('>=', 0, timestamps), ('<', 2000, timestamps[::-1]), ('between', (1030, 1100), timestamps[10:34])]:
+        pages = list(lf.iterData('stack', 'gauge', timestamp, op, pageSize=7))
+        data = [_ for page in pages for _ in page]
+        assert [_['timestamp'] for _ in data] == expected
+        assert {_['devicename'] for _ in data} == {'gauge'}
+        assert all(len(page) <= 7 for page in pages)
+
+
+def getEvent(**params):
+    """
+    Returns: an API Gateway proxy event for GET /data
+    """
+    return {'path': '/data', 'httpMethod': 'GET', 'body': None, 'queryStringParameters': params}
+
+
+@pytest.mark.parametrize('params, expected', [
+    ({'timestamp_gte': '1010'}, list(range(1010, 1020))),
+    ({'timestamp_gt': '1010', 'timestamp_lte': '1012'}, [1011, 1012]),
+    ({'timestamp_gte': '1005', 'timestamp_lt': '1006'}, [1005]),
+    ({'timestamp_gte': '1005', 'timestamp_lt': '1005'}, []),
+    ({'timestamp_gt': '1005', 'timestamp_lt': '1006'}, []),
+    ({'timestamp_gte': '1009', 'timestamp_lte': '1001'}, []),
+])
+def test_routeTimestampRanges(monkeypatch, deviceConfigs, params, expected):
+    monkeypatch.setenv('StackName', 'stack')
+    useClient(monkeypatch, FakeDataTable([record('gauge', _) for _ in range(1000, 1020)]))
+    res = lf.helper_route(getEvent(name='gauge', limit='100', **params))
+    assert res['statusCode'] == 200
+    assert [_['timestamp'] for _ in json.loads(res['body'])] == expected
+
+
+@pytest.mark.parametrize('params', [
+    {},
+    {'timestamp_gt': '1', 'timestamp_gte': '1'},
+    {'timestamp_lt': '5', 'timestamp_lte': '5', 'timestamp_gt': '1'},
+    {'timestamp_eq': '5', 'timestamp_lt': '9'},
+    {'timestamp_lt': '5', 'timestamp_lte': '9'},
+    {'timestamp_between': '5'},
+    {'since': '5'},
+    {'timestamp_gte': 'soon'},
+])
+def test_routeRejectsBadBounds(monkeypatch, params):
+    monkeypatch.setenv('StackName', 'stack')
+    res = lf.helper_route(getEvent(name='gauge', limit='100', **params))
+    assert res['statusCode'] == 400
+
+
+def test_shardedPagesReadAboutTheLimit(monkeypatch, deviceConfigs):
+    deviceConfigs['gauge'] = {'shards': '4'}
+    items = [record('gauge', _) for _ in range(0, 200)]
+    items += [record(lf.helper_shardKey('gauge', _, 4, 1), _) for _ in range(200, 1000)]
+    table = FakeDataTable(items)
+    useClient(monkeypatch, table)
+
+    pages = list(lf.iterData('stack', 'gauge', 0, '>=', pageSize=50))
+    assert [_['timestamp'] for page in pages for _ in page] == list(range(1000))
+    # Every partition read for the whole page would be 5x
+    assert len(pages) <= 22
+    assert table.numRead <= 1.5 * 1000
+
+
+def test_getWindowPagesEveryRecordOnce(monkeypatch, deviceConfigs):
+    deviceConfigs['b'] = {'shards': '2'}
+    items = []
+    for timestamp in range(0, 3 * 86400, 600):
+        items += [record('a#7', timestamp), record(lf.helper_shardKey('b', timestamp, 2, 1), timestamp)]
+    table = FakeDataTable(items)
+    useClient(monkeypatch, table)
+
+    data, cursor = [], None
+    while True:
+        res = lf.getWindow('stack', 1000, 2 * 86400 + 77, 100, cursor)
+        data += json.loads(res['body'])
+        cursor = res['headers'].get('X-Next-Cursor')
+        if not cursor: break
+
+    keys = [(_['timestamp'], _['devicename']) for _ in data]
+    assert keys == sorted((t, d) for t in range(1200, 2 * 86400 + 77, 600) for d in ['a#7', 'b'])
+    assert table.numRead <= 1.1 * len(data)
+
+
+def test_getCoverageGaps(monkeypatch, deviceConfigs):
+    deviceConfigs['gauge'] = {'sensorPollingPeriod': '60000'}
+    day = 19000
+    slots = [i for i in range(1440) if not 60 <= i < 90 and i != 1439]
+    bitmap = sum(1 << _ for _ in slots)
+    nextDay = 1  # only the first minute of the next day
+    useClient(monkeypatch, FakeCoverageTable([
+        {'devicename': {'S': 'gauge'}, 'day': {'N': str(day)}, 'period': {'N': '60'},
+         'bitmap': {'B': bitmap.to_bytes(180, 'little')}, 'version': {'N': '1'}},
+        {'devicename': {'S': 'gauge'}, 'day': {'N': str(day + 1)}, 'period': {'N': '60'},
+         'bitmap': {'B': nextDay.to_bytes(180, 'little')}, 'version': {'N': '1'}},
+    ]))
+
+    start = day * 86400
+    res = lf.getCoverage('stack', 'gauge', start, start + 86400 + 600)
+    data = json.loads(res['body'])
+
+    assert data['expected'] == 1440 + 10
+    assert data['covered'] == len(slots) + 1
+    assert data['gaps'] == [
+        [start + 3600, start + 5400],
+        [start + 86340, start + 86400],
+        [start + 86460, start + 86400 + 600],
+    ]
+
+
+def test_reduceSamplesMatchesWithoutNumpy(monkeypatch):
+    pytest.importorskip('numpy')
+    dataList = [
+        (1, {'distance': [1012, 1010, 1011, 1300], 'battery-percent': '80'}),
+        (2, {'distance': [5.5, 2.25]}),
+        (3, {'distance': []}),
+        (4, {'distance': 1000}),
+    ]
+    reduced = lf.helper_reduceSamples(dataList, keepRaw=True)
+    monkeypatch.setattr(lf, 'np', None)
+    assert lf.helper_reduceSamples(dataList, keepRaw=True) == reduced
+
+    attributes = reduced[0][1]
+    assert attributes['distance'] == 1011.5
+    assert (attributes['distance-min'], attributes['distance-max'], attributes['distance-count']) == (1010, 1300, 4)
+    assert lf.helper_unpackSamples(attributes['distance-samples']) == [1012, 1010, 1011, 1300]
+    assert reduced[2][1] == {} and reduced[3][1] == {'distance': 1000}
+
+
+def test_postConfigIsConditionalOnVersion(monkeypatch):
+    table = FakeConfigTable()
+    useClient(monkeypatch, table)
+    post = lambda attributes, version=None: lf.postConfig('stack', 'gauge', attributes, version)
+
+    assert post({'a': 1}, version=1)['statusCode'] == 409  # no config yet
+    assert json.loads(post({'a': 1, 'b': 2}, version=0)['body'])['configversion'] == 1
+    assert post({'a': 3}, version=0)['statusCode'] == 409
+    assert json.loads(post({'a': 3, 'b': None}, version=1)['body'])['configversion'] == 2
+    assert post({'a': 4}, version=1)['statusCode'] == 409   # a stale read-modify-write
+    assert json.loads(post({'c': 5})['body'])['configversion'] == 3
+
+    config, = json.loads(lf.getConfig('stack', 'gauge')['body'])
+    assert config == {'devicename': 'gauge', 'a': '3', 'c': '5', 'configversion': 3}
+
+
+def test_getConfigSinceVersion(monkeypatch):
+    table = FakeConfigTable()
+    useClient(monkeypatch, table)
+    lf.postConfig('stack', 'gauge', {'a': 1})
+    lf.postConfig('stack', 'other', {'a': 1})
+    lf.postConfig('stack', 'other', {'a': 2})
+
+    assert json.loads(lf.getConfig('stack', 'gauge', sinceVersion=1)['body']) == []
+    assert [_['configversion'] for _ in json.loads(lf.getConfig('stack', 'gauge', sinceVersion=0)['body'])] == [1]
+
+    # Versions are per device, so they can't be compared across devices
+    assert lf.getConfig('stack', None, sinceVersion=1)['statusCode'] == 400
+    assert lf.getConfig('stack', ['gauge', 'other'], sinceVersion=1)['statusCode'] == 400
+    assert table.numScanned == 0
+
+
+def test_consumeDataOnlyFailsMalformedMessages(monkeypatch):
+    monkeypatch.setenv('StackName', 'stack')
+    monkeypatch.setattr(lf.boto3.session, 'Session', object)
+    written = {}
+    def postData(stackName, deviceName, dataList, session):
+        if deviceName == 'broken': raise RuntimeError("throttled")
+        written[deviceName] = dataList
+    monkeypatch.setattr(lf, 'postData', postData)
+
+    records = [
+        {'messageId': '1', 'body': json.dumps({'name': 'g', 'data': [[2, {'distance': 5}]]})},
+        {'messageId': '2', 'body': json.dumps({'name': 'g', 'data': '!!'})},
+        {'messageId': '3', 'body': '{'},
+        {'messageId': '4', 'body': json.dumps({'devices': [{'name': 'g', 'data': [[1, {'distance': 4}]]},
+                                                           {'name': 'broken', 'data': []}]})},
+    ]
+    res = lf.consumeData(records)
+    assert res == {'batchItemFailures': [{'itemIdentifier': _} for _ in ['2', '3', '4']]}
+    assert written == {'g': [(1, {'distance': 4}), (2, {'distance': 5})]}
+
+
+class FakeAlertSession:
+    """
+    A boto3 session whose latest-value table holds the
+    alert state of a single device.
+    """
+
+    def __init__(self):
+        self.state = None
+
+    def client(self, name):
+        return self
+
+    def get_item(self, **kwargs):
+        return {'Item': {'alertstate': {'S': json.dumps(self.state)}}} if self.state else {}
+
+    def evaluate(self, dataList, config):
+        self.state = lf.helper_evaluateAlerts('stack', 'gauge', dataList, config, self)
+
+
+@pytest.fixture
+def alertMemory(monkeypatch):
+    monkeypatch.setenv('AlertSink', 'memory')
+    alerts = []
+    monkeypatch.setattr(lf, 'ALERT_MEMORY', alerts)
+    return alerts
+
+
+def test_alertsFireOnceUntilCleared(alertMemory):
+    session = FakeAlertSession()
+    config = {'alertQueueAbove': '10'}
+    queueSizes = [(0, 5), (100, 20), (200, 25), (300, 3), (400, 30), (5000, 2), (6000, 40)]
+    session.evaluate([(t, {'queue-size': q}) for t, q in queueSizes], config)
+
+    # 400 is within alertMinInterval of the alert at 100
+    assert [(_['timestamp'], _['rule'], _['value']) for _ in alertMemory] == [(100, 'queue-backlog', 20), (6000, 'queue-backlog', 40)]
+    assert session.state['active'] == ['queue-backlog']
+
+
+def test_alertsAreNotRepeatedByRetries(alertMemory):
+    config = {'alertQueueAbove': '10', 'alertMinInterval': '0'}
+    dataList = [(t, {'queue-size': q}) for t, q in [(0, 5), (100, 20), (200, 3), (300, 30)]]
+
+    whole = FakeAlertSession()
+    whole.evaluate(dataList, config)
+    expected = list(alertMemory)
+    assert [_['timestamp'] for _ in expected] == [100, 300]
+
+    # The same records in two batches, each delivered twice & the
+    # second batch before a retry of the first
+    alertMemory.clear()
+    split = FakeAlertSession()
+    for batch in [dataList[:2], dataList[:2], dataList[2:], dataList[:2], dataList[2:]]:
+        split.evaluate(batch, config)
+    assert alertMemory == expected
+    assert split.state == whole.state
+
+
+def test_alertEwmaIsTimeWeighted(alertMemory):
+    session = FakeAlertSession()
+    session.evaluate([(0, {'battery-percent': 100}), (3600, {'battery-percent': 0})], {})
+    assert session.state['stats']['battery-percent']['ewma'] == pytest.approx(100 * math.exp(-1))
+    assert not alertMemory
+
+    session.evaluate([(7200, {'battery-percent': 0})], {})
+    alert, = alertMemory
+    assert (alert['rule'], alert['timestamp'], alert['value']) == ('low-battery', 7200, round(100 * math.exp(-2), 3))
+
+
+def test_calibrateUsesTheVersionInEffect(monkeypatch):
+    config = {'calibration': json.dumps([
+        {'version': 2, 'effectiveFrom': 2000, 'mountHeight': 5100, 'datumOffset': 10, 'temperature': 0},
+        {'version': 1, 'effectiveFrom': 1000, 'mountHeight': 5000},
+    ])}
+    data = [{'timestamp': t, 'distance': d} for t, d in [(500, 1000), (1000, 1000), (1999, 1234), (2000, 1000), (3000, 2000)]]
+    data.append({'timestamp': 3000, 'battery-percent': 50})
+
+    scale = math.sqrt(273.15 / 293.15)
+    expected = [None, 4000, 3766, round(5100 - 1000*scale + 10, 1), round(5100 - 2000*scale + 10, 1), None]
+    for numpy in [lf.np, None]:
+        monkeypatch.setattr(lf, 'np', numpy)
+        records = [dict(_) for _ in data]
+        lf.helper_calibrate(records, lf.helper_parseCalibration(config))
+        assert [_.get('water-level') for _ in records] == expected
+    assert lf.helper_parseCalibration({}) is None
+
+
+def test_postCalibrationVersions(monkeypatch):
+    table = FakeConfigTable()
+    useClient(monkeypatch, table)
+    lf.postConfig('stack', 'gauge', {'sensorPollingPeriod': '30000'})
+    lf.postCalibration('stack', 'gauge', 1000, 5000)
+    lf.postCalibration('stack', 'gauge', 3000, 5200, datumOffset=-5)
+
+    # A concurrent change makes the next write retry on top of it
+    update = table.update_item
+    def racingUpdate(**kwargs):
+        table.update_item = update
+        lf.postCalibration('stack', 'gauge', 2000, 5100)
+        return update(**kwargs)
+    table.update_item = racingUpdate
+    lf.postCalibration('stack', 'gauge', 1000, 4900, temperature=10)   # replaces the version from 1000
+
+    config = lf.helper_deviceConfig('stack', 'gauge')
+    versions = json.loads(config['calibration'])
+    assert [(_['effectiveFrom'], _['mountHeight'], _['version']) for _ in versions] == [(1000, 4900, 4), (2000, 5100, 3), (3000, 5200, 2)]
+    assert versions[0]['temperature'] == 10 and versions[2]['datumOffset'] == -5
+    assert config['sensorPollingPeriod'] == '30000' and config['configversion'] == '5'
@@ -0,0 +1,58 @@
+#  _______ _     _         _____
+# |__   __(_)   | |       / ____|
+#    | |   _  __| | ___  | |  __  __ _ _   _  __ _  ___
+#    | |  | |/ _` |/ _ \ | | |_ |/ _` | | | |/ _` |/ _ \
+#    | |  | | (_| |  __/ | |__| | (_| | |_| | (_| |  __/
+#    |_|  |_|\__,_|\___|  \_____|\__,_|\__,_|\__, |\___|
+#                                             __/ |
+#                                            |___/
+# Author: Bryce Kellogg (bryce@kellogg.org)
+# Copyright: 2023 Bryce Kellogg
+# License: GPLv3
+#
+# Tests of the output formats shared by the record printing commands.
+import io
+import csv
+import json
+
+from admin import output
+
+
+def test_csvColumnsComeFromTheLookahead(monkeypatch):
+    monkeypatch.setattr(output, 'CSV_LOOKAHEAD', 3)
+    pages = [
+        [],
+        [{'timestamp': 1, 'devicename': 'a', 'distance': 10}],
+        [{'timestamp': 2, 'devicename': 'a', 'distance': 11, 'water-level': 5}],
+        [{'timestamp': 3, 'devicename': 'a', 'distance': 12}],
+    ]
+    out = io.StringIO()
+    assert output.helper_emit(pages, 'csv', out) == 3
+
+    rows = list(csv.DictReader(io.StringIO(out.getvalue())))
+    assert list(rows[0]) == ['devicename', 'timestamp', 'distance', 'water-level']
+    assert [_['water-level'] for _ in rows] == ['', '5', '']
+
+
+def test_csvWarnsAboutLateColumns(monkeypatch, capsys):
+    monkeypatch.setattr(output, 'CSV_LOOKAHEAD', 1)
+    pages = [
+        [{'timestamp': 1, 'devicename': 'a', 'distance': 10}],
+        [{'timestamp': 2, 'devicename': 'a', 'distance-mean': 11}],
+        [{'timestamp': 3, 'devicename': 'a', 'distance-mean': 12}],
+    ]
+    out = io.StringIO()
+    assert output.helper_emit(pages, 'csv', out) == 3
+    assert out.getvalue().splitlines()[0] == 'devicename,timestamp,distance'
+    assert capsys.readouterr().err.count('distance-mean') == 1
+
+    # ndjson keeps every key
+    out = io.StringIO()
+    output.helper_emit(pages, 'ndjson', out)
+    assert [json.loads(_) for _ in out.getvalue().splitlines()] == [_ for page in pages for _ in page]
+
+
+def test_csvWithNoRecords():
+    out = io.StringIO()
+    assert output.helper_emit([[], []], 'csv', out) == 0
+    assert out.getvalue() == ''
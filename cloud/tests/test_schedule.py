@@ -0,0 +1,86 @@
+#  _______ _     _         _____
+# |__   __(_)   | |       / ____|
+#    | |   _  __| | ___  | |  __  __ _ _   _  __ _  ___
+#    | |  | |/ _` |/ _ \ | | |_ |/ _` | | | |/ _` |/ _ \
+#    | |  | | (_| |  __/ | |__| | (_| | |_| | (_| |  __/
+#    |_|  |_|\__,_|\___|  \_____|\__,_|\__,_|\__, |\___|
+#                                             __/ |
+#                                            |___/
+# Author: Bryce Kellogg (bryce@kellogg.org)
+# Copyright: 2023 Bryce Kellogg
+# License: GPLv3
+#
+# Tests of tide-phase aware sampling schedules: the tide fit, run
+# merging & the "sensorSchedule" encoding.
+import pytest
+
+np = pytest.importorskip('numpy')
+from admin import schedule
+
+
+def expand(entries):
+    """
+    Returns: the period of each minute of a schedule
+    """
+    return [period for minutes, period in entries for _ in range(minutes)]
+
+
+def test_runs():
+    periods = np.array([30, 30, 60, 60, 60, 30, 600])
+    assert schedule.helper_runs(periods) == [(2, 30), (3, 60), (1, 30), (1, 600)]
+
+
+@pytest.mark.parametrize('entries', [
+    [(20, 600), (3, 30), (20, 600)],
+    [(4, 30), (30, 300), (2, 60), (2, 120), (30, 600)],
+    [(30, 600), (5, 60), (1, 300), (30, 30), (9, 600)],
+    [(3, 300)],
+])
+def test_mergeRunsKeepsEverySample(entries):
+    merged = schedule.helper_mergeRuns(entries, minRun=10)
+
+    # Same length, no minute sampled less often, and runs are long &
+    # distinct unless the schedule is too short for that
+    before, after = expand(entries), expand(merged)
+    assert len(after) == len(before)
+    assert all(a <= b for a, b in zip(after, before))
+    assert all(n >= 10 for n, _ in merged) or len(merged) == 1
+    assert all(a[1] != b[1] for a, b in zip(merged, merged[1:]))
+
+
+def test_scheduleEncoding():
+    entries = [(45, 30), (120, 300), (90, 30)]
+    encoded = schedule.helper_encodeSchedule(1700000000.7, entries)
+    assert encoded == '1700000000;45x30,120x300,90x30'
+    assert schedule.helper_decodeSchedule(encoded) == (1700000000, entries)
+    assert schedule.helper_decodeSchedule('1700000000;') == (1700000000, [])
+    assert schedule.helper_entryStarts(1700000000, entries) == [1700000000, 1700002700, 1700009900]
+
+
+def test_planFollowsTheTide():
+    # 20 days of a noisy M2 & K1 tide every 10 minutes
+    start = 19000 * 86400
+    t = start + 600 * np.arange(20 * 144)
+    omega = schedule.helper_omega(['M2', 'K1'])
+    levels = 3000 + 800 * np.cos(omega[0] * t + 0.3) + 200 * np.sin(omega[1] * t)
+    levels += np.random.default_rng(1).normal(0, 5, len(t))
+    levels[::50] = np.nan
+
+    model = schedule.fitTideModel(t, levels)
+    assert model['constituents'] == list(schedule.CONSTITUENTS)
+    assert model['mean'] == pytest.approx(3000, abs=2) and model['rms'] < 6
+    fitted, _ = schedule.predictTide(model, t)
+    assert np.nanmax(np.abs(fitted - levels)) < 30
+
+    entries, turningPoints = schedule.planSchedule(model, t[-1], 24 * 3600, resolution=20, window=45*60)
+    periods = np.array(expand(entries))
+    minutes = t[-1] + 60 * np.arange(len(periods))
+    assert len(periods) == 24 * 60 and set(periods) <= set(schedule.PERIOD_STEPS)
+
+    # Dense around each high & low water, sparse somewhere in between
+    assert 3 <= len(turningPoints) <= 5
+    for tp in turningPoints:
+        near = np.abs(minutes - tp) <= 45 * 60
+        assert (periods[near] == schedule.PERIOD_STEPS[0]).all()
+    assert periods.max() > schedule.PERIOD_STEPS[0]
+    assert len(schedule.helper_encodeSchedule(t[-1], entries)) <= 622
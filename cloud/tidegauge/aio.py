@@ -0,0 +1,174 @@
+#  _______ _     _         _____
+# |__   __(_)   | |       / ____|
+#    | |   _  __| | ___  | |  __  __ _ _   _  __ _  ___
+#    | |  | |/ _` |/ _ \ | | |_ |/ _` | | | |/ _` |/ _ \
+#    | |  | | (_| |  __/ | |__| | (_| | |_| | (_| |  __/
+#    |_|  |_|\__,_|\___|  \_____|\__,_|\__,_|\__, |\___|
+#                                             __/ |
+#                                            |___/
+# Author: Bryce Kellogg (bryce@kellogg.org)
+# Copyright: 2023 Bryce Kellogg
+# License: GPLv3
+#
+# The asyncio client. It mirrors the synchronous client in
+# client.py, with every request method being a coroutine.
+#
+#     >>> async with AsyncClient(apikey='...') as client:
+#     ...     data = await client.getRange('tide-guage-1', start, end)
+#
+import os
+import json
+import asyncio
+
+from .client import (DEFAULT_URL, DEFAULT_PAGE_SIZE, RETRY_STATUS_CODES,
+                     helper_queryParams, helper_configParams, helper_splitRange,
+                     helper_backoff, helper_columns)
+
+
+class AsyncClient:
+    """
+    An asyncio client for the Tide Gauge REST API, backed by a
+    pooled httpx.AsyncClient. Takes the same params as Client.
+    """
+
+    def __init__(self, url=None, apikey=None, poolSize=10, retries=5, backoff=0.5, timeout=30):
+        import httpx
+
+        self.url = (url or os.environ.get('TIDEGAUGE_URL', DEFAULT_URL)).rstrip('/')
+        self.retries = retries
+        self.backoff = backoff
+        self.poolSize = poolSize
+
+        self.client = httpx.AsyncClient(
+                headers={'x-api-key': apikey or os.environ.get('TIDEGAUGE_APIKEY', '')},
+                limits=httpx.Limits(max_connections=poolSize, max_keepalive_connections=poolSize),
+                timeout=timeout)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        await self.client.aclose()
+
+    async def request(self, method, path, **kwargs):
+        """
+        Makes a request, retrying throttled & failed requests.
+
+        Returns: the httpx.Response
+        """
+        import httpx
+
+        for attempt in range(self.retries + 1):
+            try:
+                res = await self.client.request(method, f'{self.url}{path}', **kwargs)
+            except httpx.TransportError:
+                if attempt == self.retries: raise
+                await asyncio.sleep(helper_backoff(attempt, self.backoff))
+                continue
+
+            if res.status_code not in RETRY_STATUS_CODES or attempt == self.retries: break
+            await asyncio.sleep(helper_backoff(attempt, self.backoff, res.headers.get('Retry-After')))
+
+        res.raise_for_status()
+        return res
+
+    async def iterPages(self, deviceName, start=None, end=None, limit=None, pageSize=DEFAULT_PAGE_SIZE):
+        """
+        Gets a device's data one page at a time, as for Client.iterPages.
+        """
+        params = helper_queryParams(deviceName, start, end)
+        while limit is None or limit > 0:
+            params['limit'] = min(limit or pageSize, pageSize)
+            res = await self.request('GET', '/data', params=params)
+
+            data = res.json()
+            if data: yield data
+            if limit is not None: limit -= len(data)
+
+            params['cursor'] = res.headers.get('X-Next-Cursor')
+            if not params['cursor']: break
+
+    async def iterData(self, deviceName, start=None, end=None, limit=None, pageSize=DEFAULT_PAGE_SIZE):
+        """
+        Gets a device's data one record at a time, as for Client.iterData.
+        """
+        async for page in self.iterPages(deviceName, start, end, limit, pageSize):
+            for record in page:
+                yield record
+
+    async def getData(self, deviceName, start=None, end=None, limit=None, pageSize=DEFAULT_PAGE_SIZE, columnar=False):
+        """
+        Gets all of a device's data in a window, as for Client.getData.
+        """
+        data = [_ async for _ in self.iterData(deviceName, start, end, limit, pageSize)]
+        return helper_columns(data) if columnar else data
+
+    async def getRange(self, deviceName, start, end, splits=4, pageSize=DEFAULT_PAGE_SIZE, columnar=False):
+        """
+        Gets all of a device's data in a large window by reading smaller
+        windows concurrently, as for Client.getRange.
+        """
+        windows = helper_splitRange(start, end, splits)
+        results = await asyncio.gather(*(self.getData(deviceName, *_, pageSize=pageSize) for _ in windows))
+        data = [record for result in results for record in result]
+        return helper_columns(data) if columnar else data
+
+    async def iterWindow(self, start, end, pageSize=DEFAULT_PAGE_SIZE):
+        """
+        Gets the data of every device in a window one page at a
+        time, as for Client.iterWindow.
+        """
+        params = {'from': int(start), 'to': int(end), 'limit': pageSize}
+        while True:
+            res = await self.request('GET', '/data', params=params)
+            data = res.json()
+            if data: yield data
+
+            params['cursor'] = res.headers.get('X-Next-Cursor')
+            if not params['cursor']: break
+
+    async def getWindow(self, start, end, pageSize=DEFAULT_PAGE_SIZE):
+        """
+        Gets all the data of every device in a window, as for Client.getWindow.
+        """
+        return [record async for page in self.iterWindow(start, end, pageSize) for record in page]
+
+    async def getLatest(self, deviceNames=None):
+        """
+        Gets the latest reading of each device.
+        """
+        params = {'name': ','.join(deviceNames)} if deviceNames else None
+        res = await self.request('GET', '/data/latest', params=params)
+        return res.json()
+
+    async def postData(self, deviceName, dataList):
+        """
+        Posts records for a device.
+        """
+        body = json.dumps({'name': deviceName, 'data': dataList})
+        await self.request('POST', '/data', content=body)
+
+    async def postBatch(self, devices):
+        """
+        Posts records for several devices in a single request.
+        """
+        await self.request('POST', '/data', content=json.dumps({'devices': devices}))
+
+    async def getConfig(self, deviceNames=None, sinceVersion=None):
+        """
+        Gets device configs, as for Client.getConfig.
+        """
+        params = helper_configParams(deviceNames, sinceVersion)
+        res = await self.request('GET', '/config', params=params)
+        return res.json()
+
+    async def postConfig(self, deviceName, attributes, version=None):
+        """
+        Updates some of a device's config, as for Client.postConfig.
+        """
+        body = json.dumps({'name': deviceName, 'config': attributes, 'version': version})
+        res = await self.request('POST', '/config', content=body)
+        return res.json()['configversion']
@@ -0,0 +1,329 @@
+#  _______ _     _         _____
+# |__   __(_)   | |       / ____|
+#    | |   _  __| | ___  | |  __  __ _ _   _  __ _  ___
+#    | |  | |/ _` |/ _ \ | | |_ |/ _` | | | |/ _` |/ _ \
+#    | |  | | (_| |  __/ | |__| | (_| | |_| | (_| |  __/
+#    |_|  |_|\__,_|\___|  \_____|\__,_|\__,_|\__, |\___|
+#                                             __/ |
+#                                            |___/
+# Author: Bryce Kellogg (bryce@kellogg.org)
+# Copyright: 2023 Bryce Kellogg
+# License: GPLv3
+#
+# The synchronous client, along with the helpers that are shared
+# with the asyncio client in aio.py.
+#
+#     >>> client = Client(apikey='...')
+#     >>> for record in client.iterData('tide-guage-1', start=1689817855):
+#     ...     print(record)
+#
+import os
+import json
+import time
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_URL = 'https://api.warmbeachtides.org'
+
+# The number of records requested per page
+DEFAULT_PAGE_SIZE = 1000
+
+# HTTP status codes that are worth retrying: throttling by
+# the API usage plan and errors from the gateway or lambda.
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+# The columns returned by columnar reads, as a mapping of
+# column name to (record attribute, numpy dtype).
+COLUMNS = {
+    'timestamp': ('timestamp', 'i8'),
+    'distance':  ('distance', 'f8'),
+    'battery':   ('battery-percent', 'f8'),
+    'water_level': ('water-level', 'f8'),
+}
+
+
+class Client:
+    """
+    A client for the Tide Gauge REST API.
+
+    Requests share a pooled requests.Session, so connections are
+    reused. Requests that are throttled (429) or fail with a 5xx
+    error are retried with exponential backoff.
+
+    Params:
+        url = the base URL of the API (env "TIDEGAUGE_URL")
+        apikey = the API key to send (env "TIDEGAUGE_APIKEY")
+        poolSize = the maximum number of open connections
+        retries = the number of times to retry a failed request
+        backoff = the delay before the first retry, in seconds
+        timeout = the timeout of each request, in seconds
+    """
+
+    def __init__(self, url=None, apikey=None, poolSize=10, retries=5, backoff=0.5, timeout=30):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.url = (url or os.environ.get('TIDEGAUGE_URL', DEFAULT_URL)).rstrip('/')
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.poolSize = poolSize
+
+        self.session = requests.Session()
+        self.session.headers['x-api-key'] = apikey or os.environ.get('TIDEGAUGE_APIKEY', '')
+        adapter = HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.session.close()
+
+    def request(self, method, path, **kwargs):
+        """
+        Makes a request, retrying throttled & failed requests.
+
+        Returns: the requests.Response
+        """
+        import requests
+
+        for attempt in range(self.retries + 1):
+            try:
+                res = self.session.request(method, f'{self.url}{path}', timeout=self.timeout, **kwargs)
+            except requests.ConnectionError:
+                if attempt == self.retries: raise
+                time.sleep(helper_backoff(attempt, self.backoff))
+                continue
+
+            if res.status_code not in RETRY_STATUS_CODES or attempt == self.retries: break
+            time.sleep(helper_backoff(attempt, self.backoff, res.headers.get('Retry-After')))
+
+        res.raise_for_status()
+        return res
+
+    def iterPages(self, deviceName, start=None, end=None, limit=None, pageSize=DEFAULT_PAGE_SIZE):
+        """
+        Gets a device's data one page at a time, following the
+        cursor of each page until there is no more data.
+
+        Params:
+            deviceName = the name of the device
+            start = the first timestamp to get (inclusive)
+            end = the last timestamp to get (exclusive)
+            limit = the maximum total number of records
+            pageSize = the maximum number of records per request
+
+        Yields: lists of records
+        """
+        params = helper_queryParams(deviceName, start, end)
+        while limit is None or limit > 0:
+            params['limit'] = min(limit or pageSize, pageSize)
+            res = self.request('GET', '/data', params=params)
+
+            data = res.json()
+            if data: yield data
+            if limit is not None: limit -= len(data)
+
+            params['cursor'] = res.headers.get('X-Next-Cursor')
+            if not params['cursor']: break
+
+    def iterData(self, deviceName, start=None, end=None, limit=None, pageSize=DEFAULT_PAGE_SIZE):
+        """
+        Gets a device's data one record at a time. Pages are
+        requested as needed. Takes the same params as iterPages.
+        """
+        for page in self.iterPages(deviceName, start, end, limit, pageSize):
+            yield from page
+
+    def getData(self, deviceName, start=None, end=None, limit=None, pageSize=DEFAULT_PAGE_SIZE, columnar=False):
+        """
+        Gets all of a device's data in a window. Takes the same
+        params as iterPages.
+
+        Returns: a list of records, or a dict of numpy arrays
+                 (see COLUMNS) if columnar is set
+        """
+        data = list(self.iterData(deviceName, start, end, limit, pageSize))
+        return helper_columns(data) if columnar else data
+
+    def getRange(self, deviceName, start, end, splits=4, pageSize=DEFAULT_PAGE_SIZE, columnar=False):
+        """
+        Gets all of a device's data in a large window by splitting it
+        into smaller windows that are read concurrently.
+
+        Params:
+            deviceName = the name of the device
+            start = the first timestamp to get (inclusive)
+            end = the last timestamp to get (exclusive)
+            splits = the number of concurrent windows
+            pageSize = the maximum number of records per request
+            columnar = return a dict of numpy arrays
+
+        Returns: the records in timestamp order, as for getData
+        """
+        windows = helper_splitRange(start, end, splits)
+        with ThreadPoolExecutor(max_workers=min(len(windows), self.poolSize) or 1) as executor:
+            results = executor.map(lambda _: self.getData(deviceName, *_, pageSize=pageSize), windows)
+            data = [record for result in results for record in result]
+        return helper_columns(data) if columnar else data
+
+    def iterWindow(self, start, end, pageSize=DEFAULT_PAGE_SIZE):
+        """
+        Gets the data of every device in a window one page at a
+        time, following the cursor of each page.
+
+        Params:
+            start = the first timestamp to get (inclusive)
+            end = the last timestamp to get (exclusive)
+            pageSize = the maximum number of records per request
+
+        Yields: lists of records in timestamp order
+        """
+        params = {'from': int(start), 'to': int(end), 'limit': pageSize}
+        while True:
+            res = self.request('GET', '/data', params=params)
+            data = res.json()
+            if data: yield data
+
+            params['cursor'] = res.headers.get('X-Next-Cursor')
+            if not params['cursor']: break
+
+    def getWindow(self, start, end, pageSize=DEFAULT_PAGE_SIZE):
+        """
+        Gets all the data of every device in a window. Takes the
+        same params as iterWindow.
+
+        Returns: a list of records in timestamp order
+        """
+        return [record for page in self.iterWindow(start, end, pageSize) for record in page]
+
+    def getLatest(self, deviceNames=None):
+        """
+        Gets the latest reading of each device.
+
+        Params:
+            deviceNames = a list of device names, or None for all
+        """
+        params = {'name': ','.join(deviceNames)} if deviceNames else None
+        return self.request('GET', '/data/latest', params=params).json()
+
+    def postData(self, deviceName, dataList):
+        """
+        Posts records for a device.
+
+        Params:
+            deviceName = the name of the device
+            dataList = [(timestamp, {k,v}), ]
+        """
+        body = json.dumps({'name': deviceName, 'data': dataList})
+        self.request('POST', '/data', data=body)
+
+    def postBatch(self, devices):
+        """
+        Posts records for several devices in a single request.
+
+        Params:
+            devices = [{'name': <device name>, 'data': dataList}, ]
+        """
+        self.request('POST', '/data', data=json.dumps({'devices': devices}))
+
+    def getConfig(self, deviceNames=None, sinceVersion=None):
+        """
+        Gets device configs. A poller of a single device can pass
+        the last "configversion" it saw to only get changes.
+
+        Params:
+            deviceNames = a list of device names, or None for all
+            sinceVersion = only get the config if it has a higher
+                           version; needs a single device name
+        """
+        params = helper_configParams(deviceNames, sinceVersion)
+        return self.request('GET', '/config', params=params).json()
+
+    def postConfig(self, deviceName, attributes, version=None):
+        """
+        Updates some of a device's config. Attributes set to None
+        are removed. If a version is given, the update fails with
+        a 409 error if the config has changed since.
+
+        Returns: the new config version
+        """
+        body = json.dumps({'name': deviceName, 'config': attributes, 'version': version})
+        return self.request('POST', '/config', data=body).json()['configversion']
+
+
+def helper_configParams(deviceNames=None, sinceVersion=None):
+    """
+    Builds the query string params for reading configs.
+
+    Raises: ValueError if sinceVersion is given without a
+            single device name, as versions are per device
+    """
+    if sinceVersion is not None and len(deviceNames or []) != 1:
+        raise ValueError("sinceVersion needs a single device name")
+    params = {}
+    if deviceNames: params['name'] = ','.join(deviceNames)
+    if sinceVersion is not None: params['since_version'] = int(sinceVersion)
+    return params
+
+
+def helper_queryParams(deviceName, start=None, end=None):
+    """
+    Builds the query string params for a window of data. The
+    window is [start, end) and either side may be left open.
+    """
+    params = {'name': deviceName, 'timestamp_gte': int(start or 0)}
+    if end is not None: params['timestamp_lt'] = int(end)
+    return params
+
+
+def helper_splitRange(start, end, splits):
+    """
+    Splits the window [start, end) into at most the given
+    number of equal, non-empty windows.
+
+    Returns: a list of (start, end) tuples in order
+    """
+    start, end = int(start), int(end)
+    splits = max(1, min(splits, end - start))
+    edges = [start + (end - start) * i // splits for i in range(splits + 1)]
+    return [(a, b) for a, b in zip(edges, edges[1:]) if a < b]
+
+
+def helper_backoff(attempt, backoff, retryAfter=None):
+    """
+    Returns how long to wait before retrying a request. Uses the
+    server's Retry-After header when given, otherwise exponential
+    backoff with full jitter.
+    """
+    if retryAfter is not None:
+        try:
+            return float(retryAfter)
+        except ValueError:
+            pass
+    return random.uniform(0, backoff * 2**attempt)
+
+
+def helper_columns(records):
+    """
+    Converts a list of records into a dict of numpy arrays, one per
+    column in COLUMNS. Missing or non-numeric values become NaN.
+    """
+    import numpy as np
+
+    def number(value):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return float('nan')
+
+    columns = {}
+    for column, (attribute, dtype) in COLUMNS.items():
+        values = (number(_.get(attribute)) for _ in records)
+        columns[column] = np.fromiter(values, dtype=dtype, count=len(records))
+    return columns